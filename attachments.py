@@ -0,0 +1,165 @@
+"""筆記附件 (圖片與檔案) 的內容定址儲存
+
+用戶傳來的圖片或檔案以串流從 LINE 下載，邊寫入暫存檔邊計算 SHA-256，完成後以雜湊值為檔名存放，
+相同內容只保存一份。縮圖在第一次被要求時才由原檔產生並快取，筆記輪播只引用縮圖網址，不會重新下載原檔。
+
+目錄結構 (ATTACHMENT_DIR):
+    objects/ab/abcdef...          原檔
+    thumbnails/ab/abcdef....jpg   縮圖
+    tmp/                          下載中的暫存檔
+
+原檔與縮圖的網址以 SHA-256 識別，只有拿到網址 (筆記擁有者) 才能取得內容。
+"""
+import hashlib
+import os
+import re
+import threading
+import uuid
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attachments'))
+# 下載用戶傳送內容的 API 位址 (與一般 API 不同的網域)
+LINE_DATA_API_HOST = os.getenv('LINE_DATA_API_HOST', 'https://api-data.line.me')
+# 每次從連線讀取並寫入的大小
+DOWNLOAD_CHUNK = 64 * 1024
+# 下載逾時 (連線, 讀取) 秒數
+DOWNLOAD_TIMEOUT = (5, 60)
+# 附件大小上限，超過時放棄下載
+MAX_ATTACHMENT_BYTES = int(os.getenv('MAX_ATTACHMENT_BYTES', str(50 * 1024 * 1024)))
+# 縮圖的最大寬高 (Flex 訊息的 hero 圖片) 與 JPEG 品質
+THUMBNAIL_SIZE = (600, 600)
+THUMBNAIL_QUALITY = 80
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class AttachmentTooLarge(ValueError):
+    """附件超過 MAX_ATTACHMENT_BYTES"""
+
+
+def is_digest(value):
+    """是否為 SHA-256 的十六進位字串 (網址參數先檢查，避免路徑穿越)"""
+    return bool(value and _DIGEST_RE.match(value))
+
+
+class AttachmentStore:
+    """以 SHA-256 為檔名的附件儲存，相同內容只存一份"""
+
+    def __init__(self, root=ATTACHMENT_DIR):
+        self.root = root
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def thumbnail_path(self, digest):
+        return os.path.join(self.root, 'thumbnails', digest[:2], f"{digest}.jpg")
+
+    def exists(self, digest):
+        return is_digest(digest) and os.path.exists(self.object_path(digest))
+
+    def save(self, chunks, max_bytes=MAX_ATTACHMENT_BYTES):
+        """把逐塊產生的內容寫入儲存 (不會整份載入記憶體)
+        Returns:
+            tuple: (SHA-256, 位元組數)
+        Raises:
+            AttachmentTooLarge: 超過 max_bytes (已寫入的暫存檔會刪除)
+        """
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise AttachmentTooLarge(f"附件超過 {max_bytes // (1024 * 1024)} MB")
+                    sha256.update(chunk)
+                    f.write(chunk)
+            digest = sha256.hexdigest()
+            path = self.object_path(digest)
+            if os.path.exists(path):
+                # 已有相同內容，不再保存第二份
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return digest, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def thumbnail(self, digest):
+        """取得縮圖路徑，第一次要求時才由原檔產生；原檔不存在或不是圖片時回傳 None"""
+        if not self.exists(digest):
+            return None
+        path = self.thumbnail_path(digest)
+        if os.path.exists(path):
+            return path
+        from PIL import Image, ImageOps  # 只有產生縮圖時才需要
+        try:
+            with Image.open(self.object_path(digest)) as image:
+                # draft 讓 JPEG 以縮小的尺寸解碼，不必先解出整張原圖
+                image.draft('RGB', THUMBNAIL_SIZE)
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail(THUMBNAIL_SIZE)
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 先寫暫存檔再換名，同時產生同一張縮圖的請求不會讀到寫一半的檔案
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                image.save(tmp_path, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+                os.replace(tmp_path, path)
+        except (OSError, ValueError) as e:
+            logger.warning("無法產生縮圖: %s", e, extra={'digest': digest})
+            return None
+        return path
+
+
+class ContentDownloader:
+    """以串流下載用戶傳來的圖片或檔案，第一次使用時才載入 SDK"""
+
+    def __init__(self):
+        self._api_client = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_client(self):
+        if self._api_client is None:
+            with self._lock:
+                if self._api_client is None:
+                    from linebot.v3.messaging import ApiClient, Configuration
+                    self._api_client = ApiClient(Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN')))
+        return self._api_client
+
+    def download(self, message_id, store, max_bytes=MAX_ATTACHMENT_BYTES):
+        """下載訊息內容並存入 store
+        SDK 的 get_message_content 會把整份內容讀進記憶體，這裡直接以 SDK 的連線池發出不預先讀取的請求，逐塊寫入
+        Returns:
+            tuple: (SHA-256, MIME 類型, 位元組數)
+        """
+        client = self.api_client
+        response = client.request(
+            'GET', f"{LINE_DATA_API_HOST}/v2/bot/message/{message_id}/content",
+            headers={'Authorization': f"Bearer {client.configuration.access_token}"},
+            _preload_content=False, _request_timeout=DOWNLOAD_TIMEOUT,
+        )
+        try:
+            length = response.headers.get('Content-Length')
+            if length and int(length) > max_bytes:
+                raise AttachmentTooLarge(f"附件超過 {max_bytes // (1024 * 1024)} MB")
+            content_type = (response.headers.get('Content-Type') or 'application/octet-stream').split(';')[0].strip()
+            digest, size = store.save(response.stream(DOWNLOAD_CHUNK), max_bytes)
+        finally:
+            response.release_conn()
+        logger.info("已保存附件", extra={'message_id': message_id, 'bytes': size, 'content_type': content_type})
+        return digest, content_type, size
+
+
+attachment_store = AttachmentStore()
+content_downloader = ContentDownloader()
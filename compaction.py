@@ -0,0 +1,173 @@
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+from database import add_column_if_missing
+from sharding import DATABASE, dict_factory, shard_paths
+from logger import get_logger
+from green import run_blocking
+from timeutil import to_epoch, now_epoch
+import timeutil
+
+logger = get_logger(__name__)
+
+# 過期多久的行程與提醒要搬到封存表
+ARCHIVE_AFTER_DAYS = 1
+# 每個交易搬移的筆數，保持交易短小以免長時間鎖住寫入
+BATCH_SIZE = 500
+# 批次之間暫停的秒數，讓 webhook 的寫入有機會取得鎖
+BATCH_PAUSE = 0.05
+# 每次增量 VACUUM 最多釋放的頁數
+VACUUM_PAGES = 1000
+# 背景壓縮的執行間隔 (秒)
+COMPACTION_INTERVAL = 3600
+
+# (資料表, 時間欄位)
+ARCHIVED_TABLES = [
+    ('schedules', 'scheduled_time'),
+    ('reminders', 'remind_time'),
+]
+
+
+def _columns(db, table):
+    return [row['name'] for row in db.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def ensure_archive_tables(db):
+    """建立封存表，並補上來源表後來新增的欄位"""
+    for table, _ in ARCHIVED_TABLES:
+        archive = f'{table}_archive'
+        db.execute(f'CREATE TABLE IF NOT EXISTS {archive} (id INTEGER PRIMARY KEY, archived_at DATETIME NOT NULL)')
+        for column in _columns(db, table):
+            add_column_if_missing(db, archive, column, '')
+    db.commit()
+
+
+def archive_table(db, table, time_column, cutoff, batch_size=BATCH_SIZE):
+    """把時間早於 cutoff 的非重複項目分批搬到封存表
+    Returns:
+        int: 搬移的筆數
+    """
+    columns = ', '.join(_columns(db, table))
+    archived_at = now_epoch()
+    total = 0
+    while True:
+        ids = [row['id'] for row in db.execute(f'''
+            SELECT id FROM {table}
+            WHERE rrule IS NULL AND {time_column} < ?
+            LIMIT ?
+        ''', (to_epoch(cutoff), batch_size)).fetchall()]
+        if not ids:
+            return total
+
+        placeholders = ', '.join('?' * len(ids))
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(f'''
+                INSERT OR REPLACE INTO {table}_archive ({columns}, archived_at)
+                SELECT {columns}, ? FROM {table} WHERE id IN ({placeholders})
+            ''', (archived_at, *ids))
+            db.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+            # 一直沒被掃描到的待提醒項目也一起移除
+            db.execute(f'DELETE FROM due_items WHERE source_table = ? AND source_id IN ({placeholders})', (table, *ids))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        total += len(ids)
+        time.sleep(BATCH_PAUSE)
+
+
+def _freelist_bytes(db):
+    page_size = db.execute('PRAGMA page_size').fetchone()['page_size']
+    freelist = db.execute('PRAGMA freelist_count').fetchone()['freelist_count']
+    return page_size * freelist
+
+
+def compact(db_path=DATABASE, archive_after_days=ARCHIVE_AFTER_DAYS):
+    """封存過期的行程與提醒，並以增量 VACUUM 釋放空間
+    Returns:
+        dict: {'archived': {資料表: 筆數}, 'reclaimed_bytes': 釋放的位元組}
+    """
+    # isolation_level=None：由 archive_table 自行控制交易範圍
+    db = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+    db.row_factory = dict_factory
+    try:
+        ensure_archive_tables(db)
+        cutoff = timeutil.now() - timedelta(days=archive_after_days)
+        archived = {
+            table: archive_table(db, table, time_column, cutoff)
+            for table, time_column in ARCHIVED_TABLES
+        }
+
+        reclaimed = 0
+        auto_vacuum = db.execute('PRAGMA auto_vacuum').fetchone()['auto_vacuum']
+        if auto_vacuum == 2:
+            before = _freelist_bytes(db)
+            db.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+            reclaimed = before - _freelist_bytes(db)
+        elif any(archived.values()):
+            logger.info("資料庫未啟用增量 VACUUM，請執行 python compaction.py --vacuum 轉換一次")
+        db.execute('PRAGMA optimize')
+
+        report = {'archived': archived, 'reclaimed_bytes': reclaimed}
+        logger.info("資料庫壓縮完成", extra=report)
+        return report
+    finally:
+        db.close()
+
+
+def enable_incremental_vacuum(db_path=DATABASE):
+    """把既有資料庫轉換為增量 VACUUM 模式 (需要一次完整 VACUUM，期間會鎖住資料庫)"""
+    db = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+    finally:
+        db.close()
+
+
+class Compactor:
+    """定期在背景執行壓縮"""
+
+    def __init__(self, interval=COMPACTION_INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        """啟動背景壓縮"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """停止背景壓縮"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            # 分片逐一壓縮，避免同時對多個檔案做大量 I/O
+            for path in shard_paths():
+                try:
+                    run_blocking(compact, path)
+                except Exception as e:
+                    logger.error("資料庫壓縮錯誤: %s", e, extra={'db_path': path})
+
+
+compactor = Compactor()
+
+
+if __name__ == "__main__":
+    import sys
+
+    for path in shard_paths():
+        if '--vacuum' in sys.argv:
+            enable_incremental_vacuum(path)
+            print(f"{path}: 已轉換為增量 VACUUM 模式")
+        report = compact(path)
+        print(f"{path}: 封存筆數: {report['archived']}，釋放空間: {report['reclaimed_bytes']} bytes")
@@ -1,88 +1,235 @@
-from PIL import Image, ImageDraw, ImageFont
+"""圖文選單圖片產生器
+
+依 rich_menu.MENUS 繪製每個選單的圖片，按鈕位置與選單的點擊範圍共用 rich_menu.button_bounds。
+圖片內嵌版面雜湊值 (按鈕、尺寸、樣式與字型)，沒有變更時直接沿用既有的檔案，不重新繪製。
+輸出會壓縮到 LINE 的 1 MB 上限以內：先試調色盤 PNG，仍太大時改用 JPEG (檔名不變，上傳時依內容判斷格式)。
+
+用法:
+    python create_menu_image.py            # 產生所有選單的圖片 (沒有變更時跳過)
+    python create_menu_image.py --force    # 一律重新繪製
+
+字型依序從 MENU_FONT 環境變數、專案的 fonts/ 目錄、fontconfig (fc-list) 與各平台的字型目錄尋找支援中文的字型。
+"""
+import argparse
+import functools
+import glob
+import hashlib
+import io
+import json
 import os
+import shutil
+import subprocess
+import sys
 
-def create_rich_menu_image():
-    # 創建一個新的圖片
-    width = 2500
-    height = 1686
-    image = Image.new('RGB', (width, height), 'white')
+from logger import get_logger
+from rich_menu import MENUS, MENU_DIR, MENU_WIDTH, MENU_HEIGHT, button_bounds
+
+logger = get_logger(__name__)
+
+# 改變繪製方式時遞增，讓既有的圖片失效
+RENDER_VERSION = 1
+# LINE 圖文選單圖片的大小上限
+MAX_IMAGE_BYTES = 1024 * 1024
+# 調色盤 PNG 的顏色數 (選單只有幾種顏色，保留文字反鋸齒需要的灰階即可)
+PALETTE_COLORS = 64
+# 改用 JPEG 時依序嘗試的品質
+JPEG_QUALITIES = (90, 80, 70, 60, 50)
+# 圖片中記錄版面雜湊值的欄位
+HASH_KEY = 'layout-hash'
+
+FONT_SIZE = 60
+STYLE = {
+    'background': '#FFFFFF',
+    'line': '#000000',
+    'line_width': 2,
+    'label_background': '#D3D3D3',
+    'label_padding': 20,
+    'text': '#000000',
+}
+
+# 專案內附的字型 (放入 Noto Sans CJK 等字型檔即可，不需安裝到系統)
+BUNDLED_FONT_DIR = os.path.join(MENU_DIR, 'fonts')
+# 檔名含有這些字樣的字型支援中文，越前面越優先
+CJK_FONT_NAMES = [
+    'NotoSansCJK', 'NotoSansTC', 'NotoSansMonoCJK', 'NotoSerifCJK', 'SourceHanSans',
+    'msjh', 'PingFang', 'Hiragino', 'wqy-microhei', 'wqy-zenhei', 'DroidSansFallback',
+    'mingliu', 'simsun', 'msgothic', 'meiryo',
+]
+FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf', '.otc')
+
+
+def _system_font_dirs():
+    """各平台的字型目錄"""
+    home = os.path.expanduser('~')
+    if sys.platform == 'win32':
+        windir = os.environ.get('SYSTEMROOT') or os.environ.get('WINDIR') or r'C:\Windows'
+        return [os.path.join(windir, 'Fonts'), os.path.join(os.environ.get('LOCALAPPDATA', home), 'Microsoft', 'Windows', 'Fonts')]
+    if sys.platform == 'darwin':
+        return ['/System/Library/Fonts', '/Library/Fonts', os.path.join(home, 'Library', 'Fonts')]
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(home, '.local', 'share')
+    return ['/usr/share/fonts', '/usr/local/share/fonts', os.path.join(data_home, 'fonts'), os.path.join(home, '.fonts')]
+
+
+def _font_rank(path):
+    """依 CJK_FONT_NAMES 排序，不認得的字型排在最後"""
+    name = os.path.basename(path).lower()
+    for rank, pattern in enumerate(CJK_FONT_NAMES):
+        if pattern.lower() in name:
+            return rank
+    return len(CJK_FONT_NAMES)
+
+
+def _fontconfig_fonts():
+    """fontconfig 列出涵蓋繁體中文的字型 (沒有 fc-list 時回傳空列表)"""
+    if not shutil.which('fc-list'):
+        return []
+    try:
+        output = subprocess.run(
+            ['fc-list', ':lang=zh-tw', 'file'], capture_output=True, text=True, timeout=10, check=True
+        ).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("fc-list 執行失敗: %s", e)
+        return []
+    return [line.strip().rstrip(':') for line in output.splitlines() if line.strip()]
+
+
+@functools.lru_cache(maxsize=1)
+def find_cjk_font():
+    """尋找支援中文的字型檔，找不到時回傳 None"""
+    override = os.getenv('MENU_FONT')
+    if override:
+        if os.path.exists(override):
+            return override
+        logger.warning("MENU_FONT 指定的字型不存在", extra={'path': override})
+
+    bundled = sorted(
+        (path for path in glob.glob(os.path.join(BUNDLED_FONT_DIR, '*')) if path.lower().endswith(FONT_EXTENSIONS)),
+        key=_font_rank
+    )
+    if bundled:
+        return bundled[0]
+
+    # fontconfig 已依字元涵蓋範圍篩選過，檔名不認得的也可以用
+    fonts = sorted(_fontconfig_fonts(), key=_font_rank)
+    if fonts:
+        return fonts[0]
+
+    candidates = []
+    for font_dir in _system_font_dirs():
+        for root, _, files in os.walk(font_dir):
+            candidates.extend(
+                os.path.join(root, name) for name in files
+                if name.lower().endswith(FONT_EXTENSIONS) and _font_rank(name) < len(CJK_FONT_NAMES)
+            )
+    return min(candidates, key=_font_rank) if candidates else None
+
+
+def layout_hash(menu, font_path):
+    """版面雜湊值：按鈕文字與範圍、圖片尺寸、樣式、字型 (檔名與大小) 與繪製版本"""
+    layout = {
+        'version': RENDER_VERSION,
+        'size': [MENU_WIDTH, MENU_HEIGHT],
+        'buttons': [[button['label'], bounds] for button, bounds in button_bounds(menu)],
+        'style': STYLE,
+        'font': [os.path.basename(font_path), os.path.getsize(font_path), FONT_SIZE] if font_path else None,
+    }
+    return hashlib.sha256(json.dumps(layout, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def cached_hash(path):
+    """讀出既有圖片內嵌的版面雜湊值 (只讀檔頭，不解碼像素)"""
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            if image.format == 'PNG':
+                return image.text.get(HASH_KEY)
+            comment = image.info.get('comment')
+            return comment.decode('ascii', 'ignore') if isinstance(comment, bytes) else comment
+    except (OSError, ValueError):
+        return None
+
+
+def render_menu_image(menu, font_path):
+    """繪製選單圖片：格線與置中的按鈕文字"""
+    from PIL import Image, ImageDraw, ImageFont
+    image = Image.new('RGB', (MENU_WIDTH, MENU_HEIGHT), STYLE['background'])
     draw = ImageDraw.Draw(image)
-    
-    # 定義按鈕區域
-    button_width = width // 3
-    button_height = height // 2
-    
-    # 繪製網格線
-    for i in range(1, 3):
-        # 垂直線
-        draw.line([(i * button_width, 0), (i * button_width, height)], fill='black', width=2)
-    # 水平線
-    draw.line([(0, button_height), (width, button_height)], fill='black', width=2)
-    
-    # 定義按鈕文字
-    buttons = [
-        ['記事', '行程', '提醒'],
-        ['查看記事', '查看行程', '查看提醒']
-    ]
-    
-    # 嘗試多個可能的字體
-    possible_fonts = [
-        "msjh.ttc",  # 微軟正黑體
-        "mingliu.ttc",  # 細明體
-        "simsun.ttc",  # 新細明體
-        "msgothic.ttc",  # MS Gothic
-        "arial.ttf",
-        "MEIRYO.TTC"  # 日文字體（通常也支援中文）
-    ]
-    
-    font = None
-    font_size = 60
-    
-    # 嘗試載入字體
-    for font_name in possible_fonts:
-        try:
-            # 嘗試從 Windows 字體目錄載入
-            font_path = os.path.join(os.environ['SYSTEMROOT'], 'Fonts', font_name)
-            if os.path.exists(font_path):
-                font = ImageFont.truetype(font_path, font_size)
-                print(f"使用字體: {font_name}")
-                break
-        except Exception as e:
-            print(f"無法載入字體 {font_name}: {str(e)}")
-    
-    if font is None:
-        print("無法載入任何字體，使用預設字體")
-        font = ImageFont.load_default()
-        font_size = 30  # 預設字體較小，調整大小
-    
-    # 繪製按鈕文字
-    for row in range(2):
-        for col in range(3):
-            text = buttons[row][col]
-            # 計算文字位置使其居中
-            text_bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            text_height = text_bbox[3] - text_bbox[1]
-            
-            x = col * button_width + (button_width - text_width) // 2
-            y = row * button_height + (button_height - text_height) // 2
-            
-            # 繪製文字背景（可選）
-            padding = 20
-            draw.rectangle([
-                x - padding,
-                y - padding,
-                x + text_width + padding,
-                y + text_height + padding
-            ], fill='lightgray')
-            
-            # 繪製文字
-            draw.text((x, y), text, fill='black', font=font)
-            print(f"已繪製文字: {text} 在位置 ({x}, {y})")
-    
-    # 保存圖片
-    image.save('rich_menu_image.png')
-    print("圖片已保存為 rich_menu_image.png")
+    font = ImageFont.truetype(font_path, FONT_SIZE)
+    padding = STYLE['label_padding']
+
+    for button, (x, y, width, height) in button_bounds(menu):
+        # 只畫右邊與下邊的格線，相鄰的按鈕共用
+        if x + width < MENU_WIDTH:
+            draw.line([(x + width, y), (x + width, y + height)], fill=STYLE['line'], width=STYLE['line_width'])
+        if y + height < MENU_HEIGHT:
+            draw.line([(x, y + height), (x + width, y + height)], fill=STYLE['line'], width=STYLE['line_width'])
+
+        left, top, right, bottom = draw.textbbox((0, 0), button['label'], font=font)
+        text_x = x + (width - (right - left)) // 2 - left
+        text_y = y + (height - (bottom - top)) // 2 - top
+        draw.rectangle([
+            text_x + left - padding, text_y + top - padding,
+            text_x + right + padding, text_y + bottom + padding,
+        ], fill=STYLE['label_background'])
+        draw.text((text_x, text_y), button['label'], fill=STYLE['text'], font=font)
+    return image
+
+
+def encode_image(image, digest, max_bytes=MAX_IMAGE_BYTES):
+    """壓縮到 max_bytes 以內並內嵌版面雜湊值
+    Returns:
+        bytes: PNG (調色盤) 或 JPEG 的內容
+    """
+    from PIL import PngImagePlugin
+    info = PngImagePlugin.PngInfo()
+    info.add_text(HASH_KEY, digest)
+    buffer = io.BytesIO()
+    image.quantize(colors=PALETTE_COLORS).save(buffer, format='PNG', optimize=True, pnginfo=info)
+    if buffer.tell() <= max_bytes:
+        return buffer.getvalue()
+
+    for quality in JPEG_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True, comment=digest.encode('ascii'))
+        if buffer.tell() <= max_bytes:
+            return buffer.getvalue()
+    raise ValueError(f"選單圖片無法壓縮到 {max_bytes} bytes 以內")
+
+
+def render_menu_images(menus=MENUS, menu_dir=MENU_DIR, force=False):
+    """產生所有選單的圖片，版面沒有變更的直接沿用
+    Returns:
+        dict: {圖片路徑: 'cached' 或 'rendered'}
+    """
+    font_path = find_cjk_font()
+    if font_path is None:
+        raise RuntimeError("找不到支援中文的字型：請安裝 Noto Sans CJK、把字型檔放到 fonts/ 目錄，或設定 MENU_FONT")
+
+    results = {}
+    for menu in menus:
+        path = os.path.join(menu_dir, menu['image'])
+        digest = layout_hash(menu, font_path)
+        if not force and cached_hash(path) == digest:
+            results[path] = 'cached'
+            continue
+        data = encode_image(render_menu_image(menu, font_path), digest)
+        # 先寫到暫存檔再換名，中斷時不會留下不完整的圖片
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+        results[path] = 'rendered'
+        logger.info("已產生選單圖片", extra={'path': path, 'bytes': len(data), 'font': os.path.basename(font_path)})
+    return results
+
+
+def create_rich_menu_image():
+    """產生所有選單的圖片 (沿用舊的函式名稱)"""
+    return render_menu_images()
+
 
 if __name__ == "__main__":
-    create_rich_menu_image()
+    parser = argparse.ArgumentParser(description="產生圖文選單圖片")
+    parser.add_argument('--force', action='store_true', help="忽略快取，一律重新繪製")
+    args = parser.parse_args()
+    for path, result in render_menu_images(force=args.force).items():
+        print(f"{'沿用' if result == 'cached' else '已產生'}: {path}")
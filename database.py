@@ -1,38 +1,64 @@
 import sqlite3
-from datetime import datetime
-import pytz
 import json
-import traceback
-import threading
+import logging
+from contextlib import contextmanager
 from datetime import timedelta
+from logger import get_logger, SAMPLED
+from timeutil import to_epoch, from_epoch, now_epoch, day_range
+import timeutil
+from recurrence import upcoming_occurrences, describe_rrule
+from sharding import (
+    connect, get_connection, connection_for, close_connections, shard_paths, map_shards
+)
+from storage import (
+    Storage, SCHEDULES, REMINDERS, TIME_COLUMNS, PRIORITY_NORMAL, remind_offsets, OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_SENT, OUTBOX_DEAD,
+    EXPORT_COLUMNS, EXPORT_ORDER, IMPORT_COLUMNS, EXPORT_BATCH,
+)
 
-DATABASE = 'line_bot.db'
-thread_local = threading.local()
+logger = get_logger(__name__)
 
-def dict_factory(cursor, row):
-    """將資料庫查詢結果轉換為字典格式"""
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+# 查詢行程時每個重複行程最多展開幾次
+RECURRING_EXPAND_LIMIT = 10
 
-def get_db():
-    """獲取資料庫連接"""
-    if not hasattr(thread_local, "db"):
-        thread_local.db = sqlite3.connect(DATABASE)
-        thread_local.db.row_factory = dict_factory
-    return thread_local.db
+# 用量統計不屬於任何用戶，固定存放在第一個分片
+STATS_SHARD = 0
+
+# 筆記搜尋時放進 MATCH 的 user_id 末幾碼 (LINE 的 user_id 是 U 加 32 個十六進位字元，末 8 碼已足以區分用戶)
+FTS_USER_KEY_LENGTH = 8
+
+# 資料庫結構版本 (PRAGMA user_version)
+#   1: 時間欄位由台北時間字串改為 UTC epoch 秒
+SCHEMA_VERSION = 1
+
+# 以 UTC epoch 秒儲存的時間欄位
+EPOCH_COLUMNS = {
+    'notes': ['created_at'],
+    'schedules': ['scheduled_time', 'created_at'],
+    'reminders': ['remind_time', 'created_at'],
+    'schedules_archive': ['scheduled_time', 'created_at', 'archived_at'],
+    'reminders_archive': ['remind_time', 'created_at', 'archived_at'],
+}
+
+def get_db(shard=0):
+    """獲取資料庫連接 (指定分片，預設為第一個)"""
+    return get_connection(shard)
 
 def close_db():
     """關閉資料庫連接"""
-    if hasattr(thread_local, "db"):
-        thread_local.db.close()
-        del thread_local.db
+    close_connections()
 
 def init_db():
-    """初始化資料庫表"""
-    with sqlite3.connect(DATABASE) as db:
-        db.row_factory = dict_factory
+    """初始化所有分片的資料庫表"""
+    for path in shard_paths():
+        init_shard(path)
+
+def init_shard(path):
+    """初始化單一資料庫檔案的資料表"""
+    with connect(path) as db:
+        # 新建立的資料庫使用增量 VACUUM，封存舊資料後可以逐步釋放空間 (對既有資料庫無作用)
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL 模式讓讀取不會擋住寫入
+        db.execute('PRAGMA journal_mode = WAL')
         
         # 創建筆記表
         db.execute('''
@@ -40,7 +66,7 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
             content TEXT NOT NULL,
-            created_at DATETIME NOT NULL
+            created_at INTEGER NOT NULL
         )
         ''')
         
@@ -51,9 +77,9 @@ def init_db():
             user_id TEXT NOT NULL,
             title TEXT NOT NULL,
             description TEXT,
-            scheduled_time DATETIME NOT NULL,
+            scheduled_time INTEGER NOT NULL,
             remind_before INTEGER DEFAULT 5,
-            created_at DATETIME NOT NULL,
+            created_at INTEGER NOT NULL,
             ics_file TEXT,
             reminded INTEGER DEFAULT 0
         )
@@ -65,8 +91,8 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
             content TEXT NOT NULL,
-            remind_time DATETIME NOT NULL,
-            created_at DATETIME NOT NULL,
+            remind_time INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
             is_done INTEGER DEFAULT 0,
             reminded INTEGER DEFAULT 0
         )
@@ -81,16 +107,320 @@ def init_db():
         )
         ''')
         
+        # 推播佇列：到期的提醒先寫入這裡 (與標記已提醒同一個交易)，再由 outbox 發送並重試
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            source_table TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            occurrence INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            last_error TEXT,
+            created_at INTEGER NOT NULL,
+            sent_at INTEGER,
+            UNIQUE (source_table, source_id, occurrence)
+        )
+        ''')
+        
+        # 待提醒項目：行程與提醒的每一個提醒時間各一列 (行程可以有多個提前時間)，
+        # 提醒掃描只查這張表；重複項目提醒後移到下一次發生時間，單次的提醒後刪除
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS due_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            source_table TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            offset_minutes INTEGER NOT NULL DEFAULT 0,
+            occurrence INTEGER NOT NULL,
+            fire_at INTEGER NOT NULL,
+            rrule TEXT,
+            UNIQUE (source_table, source_id, offset_minutes)
+        )
+        ''')
+        
+        # 提醒掃描的進度 (每個分片各自記錄)，停機後從這裡補發錯過的提醒
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS scanner_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''')
+        
+        # 每日摘要的訂閱者，last_sent 為最後一次收到摘要那天的開始時間
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS digest_subscriptions (
+            user_id TEXT PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            last_sent INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        
+        # 用戶的勿擾時段 (當天第幾分鐘)，一般的提醒會延到時段結束後發送
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_windows (
+            user_id TEXT PRIMARY KEY,
+            quiet_start INTEGER NOT NULL,
+            quiet_end INTEGER NOT NULL
+        )
+        ''')
+        
+        # 用量統計的每小時彙總與不重複成員 (活躍用戶) 的去重表，只使用 STATS_SHARD
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, metric)
+        ) WITHOUT ROWID
+        ''')
+        db.execute('''
+        CREATE TABLE IF NOT EXISTS stats_members (
+            bucket INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            member TEXT NOT NULL,
+            PRIMARY KEY (bucket, metric, member)
+        ) WITHOUT ROWID
+        ''')
+
+        # 重複規則 (RRULE)，一筆資料代表整個系列，時間欄位保存下一次發生時間
+        add_column_if_missing(db, 'schedules', 'rrule', 'TEXT')
+        add_column_if_missing(db, 'reminders', 'rrule', 'TEXT')
+        # 優先順序 (storage.PRIORITY_*)
+        add_column_if_missing(db, 'schedules', 'priority', 'INTEGER DEFAULT 0')
+        add_column_if_missing(db, 'reminders', 'priority', 'INTEGER DEFAULT 0')
+        # 圖片或檔案筆記的附件 (內容的 SHA-256，原檔存放在 attachments.AttachmentStore)
+        add_column_if_missing(db, 'notes', 'attachment', 'TEXT')
+        add_column_if_missing(db, 'notes', 'attachment_type', 'TEXT')
+        add_column_if_missing(db, 'notes', 'attachment_name', 'TEXT')
+        
+        # 先遷移再建立索引與觸發器，重建資料表時會一併移除舊的
+        if db.execute('PRAGMA user_version').fetchone()['user_version'] < SCHEMA_VERSION:
+            migrate_epoch_timestamps(db)
+            db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        
+        db.execute('CREATE INDEX IF NOT EXISTS idx_notes_user_created ON notes (user_id, created_at)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_schedules_user_time ON schedules (user_id, scheduled_time)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_reminders_user_time ON reminders (user_id, remind_time)')
+        # 提醒掃描只用這一個索引；舊的各表掃描索引不再需要
+        db.execute('CREATE INDEX IF NOT EXISTS idx_due_items_fire ON due_items (fire_at)')
+        db.execute('DROP INDEX IF EXISTS idx_schedules_due')
+        db.execute('DROP INDEX IF EXISTS idx_reminders_due')
+        backfill_due_items(db)
+        db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, next_attempt_at)')
+        # 稍後提醒與完成按鈕以 (用戶, 發生時間) 找回收到的那則提醒
+        db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_user ON outbox (user_id, occurrence)')
+        init_notes_fts(db)
+        
         db.commit()
 
-class Database:
-    def __init__(self):
-        self.db = sqlite3.connect(DATABASE)
-        self.db.row_factory = dict_factory
+def backfill_due_items(db, user_id=None, tables=(SCHEDULES, REMINDERS)):
+    """為尚未提醒、還沒有待提醒項目的行程與提醒建立 due_items (舊資料庫升級、重新分片或匯入後，可重複執行)
+    Args:
+        user_id (str): 只處理這位用戶的資料 (匯入時使用)，預設整個分片
+        tables (tuple): 要處理的來源資料表
+    """
+    offsets = {SCHEDULES: 'COALESCE(remind_before, 0)', REMINDERS: '0'}
+    for table in tables:
+        column, offset = TIME_COLUMNS[table], offsets[table]
+        cursor = db.execute(f'''
+            INSERT INTO due_items (user_id, source_table, source_id, offset_minutes, occurrence, fire_at, rrule)
+            SELECT user_id, ?, id, {offset}, {column}, {column} - {offset} * 60, rrule
+            FROM {table} t
+            WHERE reminded = 0
+            {'AND user_id = ?' if user_id else ''}
+            AND NOT EXISTS (SELECT 1 FROM due_items d WHERE d.source_table = ? AND d.source_id = t.id)
+        ''', (table, user_id, table) if user_id else (table, table))
+        if cursor.rowcount and not user_id:
+            logger.info("已建立待提醒項目", extra={'table': table, 'count': cursor.rowcount})
+
+def insert_due_items(db, user_id, source_table, source_id, occurrence, offsets, rrule):
+    """為新增的行程或提醒建立每個提前時間的待提醒項目 (呼叫端負責 commit)"""
+    db.executemany('''
+        INSERT INTO due_items (user_id, source_table, source_id, offset_minutes, occurrence, fire_at, rrule)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(user_id, source_table, source_id, offset, occurrence, occurrence - offset * 60, rrule) for offset in offsets])
+
+def migrate_epoch_timestamps(db):
+    """把舊版以台北時間字串儲存的時間欄位轉為 UTC epoch 秒 (只處理仍是字串的資料，可重複執行)"""
+    for table, columns in EPOCH_COLUMNS.items():
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if not exists:
+            continue
+        rebuild_text_time_columns(db, table, columns)
+        for column in columns:
+            rows = db.execute(
+                f"SELECT rowid AS row_id, {column} AS value FROM {table} WHERE typeof({column}) = 'text'"
+            ).fetchall()
+            updates = []
+            for row in rows:
+                try:
+                    updates.append((to_epoch(row['value']), row['row_id']))
+                except ValueError:
+                    logger.warning("無法轉換時間欄位", extra={'table': table, 'column': column, 'rowid': row['row_id']})
+            db.executemany(f"UPDATE {table} SET {column} = ? WHERE rowid = ?", updates)
+            if updates:
+                logger.info("時間欄位已轉為 epoch", extra={'table': table, 'column': column, 'count': len(updates)})
+
+def rebuild_text_time_columns(db, table, columns):
+    """舊的 update_db.py 等腳本把時間欄位宣告為 TEXT，整數寫入時會被轉回字串；
+    此時以 INTEGER 欄位重建資料表 (保留 rowid)，索引與觸發器由 init_shard 之後重新建立"""
+    info = db.execute(f'PRAGMA table_info({table})').fetchall()
+    if not any(col['name'] in columns and 'TEXT' in (col['type'] or '').upper() for col in info):
+        return
+    definitions = []
+    for col in info:
+        definition = f"{col['name']} {'INTEGER' if col['name'] in columns else col['type']}"
+        if col['pk']:
+            definition += ' PRIMARY KEY AUTOINCREMENT' if col['type'].upper() == 'INTEGER' else ' PRIMARY KEY'
+        elif col['notnull']:
+            definition += ' NOT NULL'
+        if col['dflt_value'] is not None:
+            definition += f" DEFAULT {col['dflt_value']}"
+        definitions.append(definition)
+    names = ', '.join(col['name'] for col in info)
+    db.execute(f"CREATE TABLE {table}_rebuild ({', '.join(definitions)})")
+    db.execute(f"INSERT INTO {table}_rebuild ({names}) SELECT {names} FROM {table}")
+    db.execute(f"DROP TABLE {table}")
+    db.execute(f"ALTER TABLE {table}_rebuild RENAME TO {table}")
+    logger.info("時間欄位改為 INTEGER 重建資料表", extra={'table': table})
+
+def add_column_if_missing(db, table, column, definition):
+    """為既有資料表補上新欄位"""
+    columns = [row['name'] for row in db.execute(f'PRAGMA table_info({table})').fetchall()]
+    if column not in columns:
+        db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def fts_phrase(text):
+    """把文字包成 FTS5 的片語 (雙引號內的引號要重複)"""
+    return '"' + text.replace('"', '""') + '"'
+
+def init_notes_fts(db):
+    """建立筆記全文檢索索引 (FTS5 trigram)，並以觸發器與 notes 表保持同步
+
+    user_id 也建立索引，搜尋時放在 MATCH 裡由索引篩選出該用戶的筆記，
+    不必先找出所有用戶符合關鍵字的筆記再逐筆比對 user_id
+    """
+    existing = db.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'"
+    ).fetchone()
+    if existing and 'UNINDEXED' in existing['sql']:
+        # 舊版索引的 user_id 沒有建立索引，刪除後重建 (觸發器的欄位相同，不需重建)
+        db.execute('DROP TABLE notes_fts')
+        existing = None
+        logger.info("重建筆記全文檢索索引")
+    try:
+        db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            content,
+            user_id,
+            content='notes',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite 未編譯 FTS5 或版本過舊 (trigram 需 3.34+)，搜尋會退回 LIKE 查詢
+        logger.warning("無法建立筆記全文檢索索引: %s", e)
+        return
+
+    db.execute('''
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+    END
+    ''')
+    db.execute('''
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, content, user_id) VALUES ('delete', old.id, old.content, old.user_id);
+    END
+    ''')
+    db.execute('''
+    CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE ON notes BEGIN
+        INSERT INTO notes_fts (notes_fts, rowid, content, user_id) VALUES ('delete', old.id, old.content, old.user_id);
+        INSERT INTO notes_fts (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+    END
+    ''')
+
+    if not existing:
+        # 第一次建立 (或重建) 索引時，把既有筆記匯入
+        db.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+def expand_schedules(rows, start, end=None):
+    """把查詢到的行程整理為顯示格式，重複行程展開時間範圍內的發生時間
+    Args:
+        rows (list): 含 title、description、scheduled_time、remind_before、rrule 的資料列
+        start (datetime): 起始時間
+        end (datetime): 結束時間 (不含)，預設為 start 後 7 天
+    Returns:
+        list: 依時間排序的行程列表
+    """
+    schedules = []
+    log_each = logger.isEnabledFor(logging.DEBUG)
+    for row in rows:
+        # 高頻日誌只記錄欄位名稱並取樣，不輸出用戶內容
+        if log_each:
+            logger.debug("讀取到行程", extra={'fields': list(row.keys()), **SAMPLED})
+        
+        dt = from_epoch(row['scheduled_time'])
+        
+        if row['rrule']:
+            # 只展開有限筆數，避免長期重複的行程塞滿提示詞
+            occurrences = upcoming_occurrences(
+                row['rrule'], dt,
+                limit=RECURRING_EXPAND_LIMIT,
+                start=start,
+                end=end or start + timedelta(days=7)
+            )
+            repeat = describe_rrule(row['rrule'])
+        else:
+            occurrences = [dt]
+            repeat = None
+        
+        for occurrence in occurrences:
+            schedules.append((occurrence, {
+                'title': row['title'],
+                'description': row['description'],
+                # 將時間轉換為更友好的格式
+                'time': occurrence.strftime('%Y年%m月%d日 %H:%M'),
+                'remind_before': row['remind_before'],
+                'repeat': repeat
+            }))
+    
+    return [schedule for _, schedule in sorted(schedules, key=lambda entry: entry[0])]
+
+class Database(Storage):
+    """SQLite 後端，依 user_id 把每個操作路由到所在分片的連接"""
+    
+    name = 'sqlite'
+    
+    def init_schema(self):
+        """初始化所有分片的資料庫表"""
+        init_db()
+
+    @contextmanager
+    def unit_of_work(self, user_id):
+        """工作單元：區塊內在用戶分片上的 commit() 延到結束時一次執行"""
+        db = connection_for(user_id)
+        db.unit_depth += 1
+        try:
+            yield self
+        except BaseException:
+            db.unit_depth -= 1
+            if not db.unit_depth:
+                db.rollback()
+            raise
+        db.unit_depth -= 1
+        db.commit()
     
     def get_user_state(self, user_id):
         """獲取用戶狀態"""
-        cursor = self.db.execute('SELECT * FROM user_states WHERE user_id = ?', (user_id,))
+        db = connection_for(user_id)
+        cursor = db.execute('SELECT * FROM user_states WHERE user_id = ?', (user_id,))
         state = cursor.fetchone()
         if state and state['data']:
             state['data'] = json.loads(state['data'])
@@ -98,71 +428,116 @@ class Database:
 
     def set_user_state(self, user_id, state_data):
         """設置用戶狀態"""
+        db = connection_for(user_id)
         if isinstance(state_data.get('data'), dict):
             state_data['data'] = json.dumps(state_data['data'])
         
-        self.db.execute('''
+        db.execute('''
             INSERT OR REPLACE INTO user_states (user_id, state, data)
             VALUES (?, ?, ?)
         ''', (user_id, state_data.get('state'), state_data.get('data')))
-        self.db.commit()
+        db.commit()
 
     def clear_user_state(self, user_id):
         """清除用戶狀態"""
-        self.db.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
-        self.db.commit()
+        db = connection_for(user_id)
+        db.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+        db.commit()
 
-    def add_schedule(self, user_id, title, description, scheduled_time, remind_before=5):
+    def get_delivery_window(self, user_id):
+        """獲取用戶的勿擾時段"""
+        db = connection_for(user_id)
+        return db.execute(
+            'SELECT quiet_start, quiet_end FROM delivery_windows WHERE user_id = ?', (user_id,)
+        ).fetchone()
+
+    def set_delivery_window(self, user_id, quiet_start, quiet_end):
+        """設定或清除用戶的勿擾時段"""
+        db = connection_for(user_id)
+        if quiet_start is None or quiet_end is None:
+            db.execute('DELETE FROM delivery_windows WHERE user_id = ?', (user_id,))
+        else:
+            db.execute(
+                'INSERT OR REPLACE INTO delivery_windows (user_id, quiet_start, quiet_end) VALUES (?, ?, ?)',
+                (user_id, quiet_start, quiet_end)
+            )
+        db.commit()
+
+    def add_schedule(self, user_id, title, description, scheduled_time, remind_before=5, rrule=None,
+                     priority=PRIORITY_NORMAL):
         """添加行程
         Args:
             user_id (str): 用戶ID
             title (str): 行程標題
             description (str): 行程描述
-            scheduled_time (str): 行程時間，格式為 YYYY-MM-DD HH:MM:SS
-            remind_before (int): 提前多少分鐘提醒，預設5分鐘
+            scheduled_time (datetime|str|int): 行程時間 (重複行程為第一次發生時間)，
+                台北時間的 datetime、YYYY-MM-DD HH:MM[:SS] 字串或 epoch 秒
+            remind_before (int|list): 提前多少分鐘提醒，預設5分鐘；多個分鐘數時每個各提醒一次
+            rrule (str): 重複規則，例如 FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR，預設不重複
+            priority (int): PRIORITY_URGENT 表示在勿擾時段也準時提醒
         Returns:
-            bool: 是否成功添加
+            bool: 是否成功添加 (在工作單元中出錯時拋出例外，由工作單元回滾)
         """
+        db = connection_for(user_id)
+        offsets = remind_offsets(remind_before)
+        scheduled_time = to_epoch(scheduled_time)
         try:
-            cursor = self.db.cursor()
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # 將 scheduled_time 轉換為正確的格式
-            if 'T' in scheduled_time:
-                # 處理 ISO 格式的時間 (YYYY-MM-DDTHH:MM)
-                scheduled_time = scheduled_time.replace('T', ' ') + ':00'
-            
+            cursor = db.cursor()
+            # remind_before 欄位保存最接近行程的提前時間 (顯示用)，每個提前時間另有一筆 due_items
             cursor.execute(
-                "INSERT INTO schedules (user_id, title, description, scheduled_time, remind_before, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, title, description, scheduled_time, remind_before, now)
+                "INSERT INTO schedules (user_id, title, description, scheduled_time, remind_before, created_at, rrule, priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, title, description, scheduled_time, offsets[-1], now_epoch(), rrule, priority)
             )
-            self.db.commit()
+            insert_due_items(db, user_id, SCHEDULES, cursor.lastrowid, scheduled_time, offsets, rrule)
+            db.commit()
             return True
         except Exception as e:
-            print(f"添加行程時出錯: {e}")
+            if db.unit_depth:
+                raise
+            db.rollback()
+            logger.error("添加行程時出錯: %s", e)
             return False
 
-    def add_reminder(self, user_id, content, remind_time):
-        """添加提醒"""
-        self.db.execute('''
-            INSERT INTO reminders (user_id, content, remind_time, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, content, remind_time, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        self.db.commit()
+    def add_reminder(self, user_id, content, remind_time, rrule=None, priority=PRIORITY_NORMAL):
+        """添加提醒 (rrule 為重複規則，預設不重複；priority 見 add_schedule)，回傳是否成功"""
+        db = connection_for(user_id)
+        remind_time = to_epoch(remind_time)
+        try:
+            cursor = db.execute('''
+                INSERT INTO reminders (user_id, content, remind_time, created_at, rrule, priority)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, content, remind_time, now_epoch(), rrule, priority))
+            insert_due_items(db, user_id, REMINDERS, cursor.lastrowid, remind_time, [0], rrule)
+            db.commit()
+            return True
+        except Exception as e:
+            if db.unit_depth:
+                raise
+            db.rollback()
+            logger.error("添加提醒時出錯: %s", e)
+            return False
 
-    def add_note(self, user_id, content):
-        """添加筆記"""
+    def add_note(self, user_id, content, attachment=None, attachment_type=None, attachment_name=None):
+        """添加筆記 (圖片或檔案筆記另外記錄附件的雜湊值、類型與檔名)；
+        語意索引在交易提交後才更新，工作單元回滾時不會留下不存在的筆記
+        """
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            cursor = db.cursor()
             cursor.execute(
-                "INSERT INTO notes (user_id, content, created_at) VALUES (?, ?, ?)",
-                (user_id, content, now)
+                "INSERT INTO notes (user_id, content, created_at, attachment, attachment_type, attachment_name) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, content, now_epoch(), attachment, attachment_type, attachment_name)
             )
-            self.db.commit()
+            note_id = cursor.lastrowid
+            from note_index import note_index  # 需要 numpy，延後到用到時才載入
+            db.on_commit(lambda: note_index.add_note(user_id, note_id, content))
+            db.commit()
             return True
         except Exception as e:
-            print(f"添加筆記時出錯: {e}")
+            if db.unit_depth:
+                raise
+            db.rollback()
+            logger.error("添加筆記時出錯: %s", e)
             return False
 
     def get_schedules(self, user_id):
@@ -172,170 +547,576 @@ class Database:
         Returns:
             list: 行程列表
         """
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
+            cursor = db.cursor()
             cursor.execute(
                 "SELECT * FROM schedules WHERE user_id = ? ORDER BY scheduled_time ASC",
                 (user_id,)
             )
             return cursor.fetchall()
         except Exception as e:
-            print(f"獲取行程時出錯: {e}")
+            logger.error("獲取行程時出錯: %s", e)
             return []
 
     def get_reminders(self, user_id):
         """獲取用戶的所有提醒"""
-        cursor = self.db.execute('SELECT * FROM reminders WHERE user_id = ? ORDER BY remind_time', (user_id,))
+        db = connection_for(user_id)
+        cursor = db.execute('SELECT * FROM reminders WHERE user_id = ? ORDER BY remind_time', (user_id,))
         return cursor.fetchall()
 
     def get_notes(self, user_id):
         """獲取用戶的所有筆記"""
-        cursor = self.db.cursor()
+        db = connection_for(user_id)
+        cursor = db.cursor()
         cursor.execute(
-            "SELECT id, user_id, content, created_at FROM notes WHERE user_id = ? ORDER BY created_at DESC",
+            "SELECT id, user_id, content, created_at, attachment, attachment_type, attachment_name FROM notes WHERE user_id = ? ORDER BY created_at DESC, id DESC",
             (user_id,)
         )
         return cursor.fetchall()
 
-    def get_upcoming_reminders(self, user_id):
-        """獲取用戶即將到來的提醒"""
-        cursor = self.db.execute('''
+    def search_notes(self, user_id, keyword, limit=10, offset=0):
+        """全文搜尋用戶的筆記
+        Args:
+            user_id (str): 用戶ID
+            keyword (str): 搜尋關鍵字，以空白分隔多個關鍵字 (全部需符合)
+            limit (int): 每頁筆數
+            offset (int): 略過的筆數
+        Returns:
+            list: 依相關度排序的筆記列表
+        """
+        db = connection_for(user_id)
+        terms = keyword.split()
+        if not terms:
+            return []
+
+        # trigram 索引只能比對 3 個字以上的關鍵字，較短的 (例如兩個中文字) 改用 LIKE
+        if all(len(term) >= 3 for term in terms):
+            # user_id 的末幾碼放進 MATCH 由索引篩選 (trigram 無法比對 3 個字以下的片語，過短時只靠下面的條件)；
+            # 片語的 trigram 越少比對越快，trigram 比對的又是子字串，仍以 user_id = ? 確認完全相同
+            query = f"content : ({' AND '.join(fts_phrase(term) for term in terms)})"
+            user_key = user_id[-FTS_USER_KEY_LENGTH:]
+            if len(user_key) >= 3:
+                query = f"user_id : {fts_phrase(user_key)} AND {query}"
+            # 不用 bm25 排序：它的 IDF 要讀完關鍵字在所有用戶筆記中的索引，常見的字在十萬則筆記時要數十毫秒；
+            # 改以關鍵字佔筆記內容的比例排序 (出現越多次、筆記越短越前面)，只計算這位用戶符合的筆記；
+            # +user_id 讓 SQLite 由 MATCH 的結果以主鍵取出筆記，不會掃描用戶的全部筆記
+            coverage = ' + '.join("length(content) - length(replace(lower(content), ?, ''))" for _ in terms)
+            try:
+                cursor = db.execute(f'''
+                    SELECT id, user_id, content, created_at, attachment, attachment_type, attachment_name FROM notes
+                    WHERE id IN (SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?) AND +user_id = ?
+                    ORDER BY ({coverage}) * 1.0 / (length(content) + 20) DESC, id DESC
+                    LIMIT ? OFFSET ?
+                ''', (query, user_id, *(term.lower() for term in terms), limit, offset))
+                return cursor.fetchall()
+            except sqlite3.OperationalError as e:
+                logger.warning("全文檢索失敗，改用 LIKE 查詢: %s", e)
+
+        conditions = ' AND '.join("content LIKE ? ESCAPE '\\'" for _ in terms)
+        patterns = [
+            '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            for term in terms
+        ]
+        cursor = db.execute(f'''
+            SELECT id, user_id, content, created_at, attachment, attachment_type, attachment_name FROM notes
+            WHERE user_id = ? AND {conditions}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ? OFFSET ?
+        ''', (user_id, *patterns, limit, offset))
+        return cursor.fetchall()
+
+    def get_relevant_notes(self, user_id, query, k=3):
+        """取得與問題最相關的前 k 則筆記，作為 AI 回答的參考資料
+        Args:
+            user_id (str): 用戶ID
+            query (str): 用戶的問題
+            k (int): 最多回傳幾則
+        Returns:
+            list: [(note_id, content, score)]，依相關度排序
+        """
+        db = connection_for(user_id)
+        fingerprint = db.execute(
+            "SELECT COUNT(*) AS count, MAX(id) AS max_id FROM notes WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        from note_index import note_index
+        return note_index.search(
+            user_id,
+            query,
+            k,
+            (fingerprint['count'], fingerprint['max_id']),
+            lambda: self.get_notes(user_id)
+        )
+
+    def get_upcoming_reminders(self, user_id, start=None, end=None):
+        """獲取用戶即將到來的提醒
+        Args:
+            user_id (str): 用戶ID
+            start (datetime): 起始時間，預設為現在
+            end (datetime): 結束時間 (不含)，預設不限制
+        Returns:
+            list: 提醒列表
+        """
+        db = connection_for(user_id)
+        params = [user_id, to_epoch(start) if start else now_epoch()]
+        end_condition = ''
+        if end:
+            end_condition = 'AND remind_time < ?'
+            params.append(to_epoch(end))
+        # 重複提醒的時間欄位是下一次發生時間，一律列出
+        cursor = db.execute(f'''
             SELECT * FROM reminders 
             WHERE user_id = ? 
-            AND datetime(remind_time) >= datetime(?)
+            AND (rrule IS NOT NULL OR remind_time >= ?)
+            {end_condition}
             ORDER BY remind_time
-        ''', (user_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        ''', params)
         return cursor.fetchall()
 
     def get_today_schedules(self, user_id):
         """獲取用戶今天的行程"""
-        today = datetime.now().date()
-        today_start = today.strftime('%Y-%m-%d 00:00:00')
-        today_end = today.strftime('%Y-%m-%d 23:59:59')
+        db = connection_for(user_id)
+        today_start, today_end = day_range()
         
-        cursor = self.db.execute('''
+        cursor = db.execute('''
             SELECT * FROM schedules 
             WHERE user_id = ? 
-            AND datetime(scheduled_time) >= datetime(?)
-            AND datetime(scheduled_time) <= datetime(?)
+            AND scheduled_time >= ?
+            AND scheduled_time < ?
             ORDER BY scheduled_time
         ''', (user_id, today_start, today_end))
         return cursor.fetchall()
 
-    def get_schedule_by_id(self, schedule_id):
+    def get_schedule_by_id(self, user_id, schedule_id):
         """根據ID獲取行程
         Args:
+            user_id (str): 用戶ID
             schedule_id (str): 行程ID
         Returns:
             dict: 行程信息，如果不存在則返回 None
         """
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
+            cursor = db.cursor()
             cursor.execute(
-                "SELECT * FROM schedules WHERE id = ?",
-                (schedule_id,)
+                "SELECT * FROM schedules WHERE id = ? AND user_id = ?",
+                (schedule_id, user_id)
             )
             return cursor.fetchone()
         except Exception as e:
-            print(f"根據ID獲取行程時出錯: {e}")
+            logger.error("根據ID獲取行程時出錯: %s", e)
             return None
 
-    def delete_note(self, note_id):
+    def delete_note(self, user_id, note_id):
         """刪除筆記"""
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
-            cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-            self.db.commit()
-            return cursor.rowcount > 0
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM notes WHERE id = ? AND user_id = ?", (note_id, user_id))
+            db.commit()
+            if cursor.rowcount > 0:
+                from note_index import note_index
+                note_index.remove_note(user_id, int(note_id))
+                return True
+            return False
         except Exception as e:
-            print(f"刪除筆記時出錯: {e}")
+            logger.error("刪除筆記時出錯: %s", e)
             return False
 
-    def delete_reminder(self, reminder_id):
+    def delete_reminder(self, user_id, reminder_id):
         """刪除提醒
         Args:
+            user_id (str): 用戶ID
             reminder_id (str): 提醒ID
         Returns:
             bool: 是否成功刪除
         """
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
+            cursor = db.cursor()
             cursor.execute(
-                "DELETE FROM reminders WHERE id = ?",
-                (reminder_id,)
+                "DELETE FROM reminders WHERE id = ? AND user_id = ?",
+                (reminder_id, user_id)
+            )
+            db.execute(
+                "DELETE FROM due_items WHERE source_table = ? AND source_id = ? AND user_id = ?",
+                (REMINDERS, reminder_id, user_id)
+            )
+            # 還沒發送 (或已發送、之後可能被改為稍後提醒) 的訊息一併刪除，dead letter 留著供查詢
+            db.execute(
+                "DELETE FROM outbox WHERE source_table = ? AND source_id = ? AND user_id = ? AND status != ?",
+                (REMINDERS, reminder_id, user_id, OUTBOX_DEAD)
             )
-            self.db.commit()
+            db.commit()
             return cursor.rowcount > 0
         except Exception as e:
-            print(f"刪除提醒時出錯: {e}")
+            logger.error("刪除提醒時出錯: %s", e)
             return False
 
-    def delete_schedule(self, schedule_id):
+    def delete_schedule(self, user_id, schedule_id):
         """刪除行程
         Args:
+            user_id (str): 用戶ID
             schedule_id (str): 行程ID
         Returns:
             bool: 是否成功刪除
         """
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
+            cursor = db.cursor()
             cursor.execute(
-                "DELETE FROM schedules WHERE id = ?",
-                (schedule_id,)
+                "DELETE FROM schedules WHERE id = ? AND user_id = ?",
+                (schedule_id, user_id)
+            )
+            db.execute(
+                "DELETE FROM due_items WHERE source_table = ? AND source_id = ? AND user_id = ?",
+                (SCHEDULES, schedule_id, user_id)
             )
-            self.db.commit()
+            # 還沒發送 (或已發送、之後可能被改為稍後提醒) 的訊息一併刪除，dead letter 留著供查詢
+            db.execute(
+                "DELETE FROM outbox WHERE source_table = ? AND source_id = ? AND user_id = ? AND status != ?",
+                (SCHEDULES, schedule_id, user_id, OUTBOX_DEAD)
+            )
+            db.commit()
             return cursor.rowcount > 0
         except Exception as e:
-            print(f"刪除行程時出錯: {e}")
+            logger.error("刪除行程時出錯: %s", e)
             return False
 
-    def get_user_schedules(self, user_id):
-        """獲取用戶的所有行程"""
+    def get_user_schedules(self, user_id, start=None, end=None):
+        """獲取用戶即將到來的行程
+        Args:
+            user_id (str): 用戶ID
+            start (datetime): 起始時間，預設為現在
+            end (datetime): 結束時間 (不含)，預設不限制
+        Returns:
+            list: 格式化後的行程列表
+        """
+        db = connection_for(user_id)
         try:
-            cursor = self.db.cursor()
+            cursor = db.cursor()
             # 將結果轉換為字典格式
             cursor.row_factory = sqlite3.Row
             
-            cursor.execute("""
-                SELECT s.title, s.description, s.scheduled_time, s.remind_before
+            start = start or timeutil.now()
+            params = [user_id, to_epoch(start)]
+            end_condition = ''
+            if end:
+                end_condition = 'AND s.scheduled_time < ?'
+                params.append(to_epoch(end))
+            
+            # 重複行程的時間欄位是下一次發生時間，一律取出後再展開時間範圍內的發生時間
+            cursor.execute(f"""
+                SELECT s.title, s.description, s.scheduled_time, s.remind_before, s.rrule
                 FROM schedules s
                 WHERE s.user_id = ?
-                AND datetime(s.scheduled_time) >= datetime('now', 'localtime')
+                AND (s.rrule IS NOT NULL OR s.scheduled_time >= ?)
+                {end_condition}
                 ORDER BY s.scheduled_time ASC
-            """, (user_id,))
+            """, params)
             
-            schedules = []
-            for row in cursor.fetchall():
-                # 使用列名而不是索引來訪問數據
-                print(f"讀取到行程: {dict(row)}")
-                
-                # 格式化時間
-                scheduled_time = row['scheduled_time']
-                try:
-                    # 將時間轉換為更友好的格式
-                    dt = datetime.strptime(scheduled_time, '%Y-%m-%d %H:%M:%S')
-                    formatted_time = dt.strftime('%Y年%m月%d日 %H:%M')
-                except Exception as e:
-                    print(f"時間格式化錯誤: {e}")
-                    formatted_time = scheduled_time
-                
-                schedules.append({
-                    'title': row['title'],
-                    'description': row['description'],
-                    'time': formatted_time,
-                    'remind_before': row['remind_before']
-                })
-            
-            # 添加調試信息
-            print(f"用戶 {user_id} 的行程列表: {schedules}")
+            schedules = expand_schedules(cursor.fetchall(), start, end)
+            logger.debug("查詢用戶行程完成", extra={'user_id': user_id, 'count': len(schedules)})
             return schedules
             
         except Exception as e:
-            print(f"獲取用戶行程時出錯: {e}")
-            import traceback
-            print(traceback.format_exc())
+            logger.exception("獲取用戶行程時出錯: %s", e)
             return []
 
+    def map_partitions(self, func):
+        """各分片平行執行"""
+        return map_shards(func)
+
+    def get_due_items(self, shard, since, now):
+        """分片內提醒時間落在 (since, now] 的待提醒項目 (連同來源內容與勿擾時段)"""
+        return get_db(shard).execute("""
+            SELECT d.id, d.user_id, d.source_table, d.source_id, d.offset_minutes, d.fire_at, d.occurrence, d.rrule,
+                COALESCE(s.title, r.content) AS title, s.description,
+                COALESCE(s.priority, r.priority) AS priority, w.quiet_start, w.quiet_end
+            FROM due_items d
+            LEFT JOIN schedules s ON d.source_table = ? AND s.id = d.source_id
+            LEFT JOIN reminders r ON d.source_table = ? AND r.id = d.source_id
+            LEFT JOIN delivery_windows w ON w.user_id = d.user_id
+            WHERE d.fire_at > ? AND d.fire_at <= ?
+        """, (SCHEDULES, REMINDERS, to_epoch(since), to_epoch(now))).fetchall()
+
+    def get_missed_due_items(self, shard, before):
+        """分片內提醒時間不晚於 before 的待提醒項目"""
+        return get_db(shard).execute("""
+            SELECT id, user_id, offset_minutes, occurrence, rrule
+            FROM due_items
+            WHERE fire_at <= ?
+        """, (to_epoch(before),)).fetchall()
+
+    def advance_due_item(self, user_id, item_id, next_time=None, rrule=None):
+        """移除待提醒項目或移到下一次發生時間，並同步來源的時間欄位與已提醒標記"""
+        db = connection_for(user_id)
+        item = db.execute(
+            "SELECT source_table, source_id FROM due_items WHERE id = ? AND user_id = ?", (item_id, user_id)
+        ).fetchone()
+        if item is None:
+            return
+        if next_time is None:
+            db.execute("DELETE FROM due_items WHERE id = ?", (item_id,))
+        else:
+            db.execute(
+                "UPDATE due_items SET occurrence = ?, fire_at = ? - offset_minutes * 60, rrule = ? WHERE id = ?",
+                (to_epoch(next_time), to_epoch(next_time), rrule, item_id)
+            )
+        table = item['source_table']
+        upcoming = db.execute("""
+            SELECT occurrence, rrule FROM due_items
+            WHERE source_table = ? AND source_id = ?
+            ORDER BY occurrence LIMIT 1
+        """, (table, item['source_id'])).fetchone()
+        if upcoming:
+            db.execute(
+                f"UPDATE {table} SET {TIME_COLUMNS[table]} = ?, rrule = ?, reminded = 0 WHERE id = ?",
+                (upcoming['occurrence'], upcoming['rrule'], item['source_id'])
+            )
+        else:
+            db.execute(f"UPDATE {table} SET reminded = 1 WHERE id = ?", (item['source_id'],))
+        db.commit()
+
+    def get_scan_checkpoint(self, shard):
+        """分片上一次完整掃描到的時間"""
+        row = get_db(shard).execute(
+            "SELECT value FROM scanner_state WHERE name = 'checkpoint'"
+        ).fetchone()
+        return row['value'] if row else None
+
+    def set_scan_checkpoint(self, shard, at):
+        """記錄分片已完整掃描到 at"""
+        db = get_db(shard)
+        db.execute(
+            "INSERT OR REPLACE INTO scanner_state (name, value) VALUES ('checkpoint', ?)", (to_epoch(at),)
+        )
+        db.commit()
+
+    def enqueue_outbox(self, user_id, source_table, source_id, occurrence, message, send_at=None):
+        """加入待發送的訊息；同一項目的同一次提醒只會加入一次"""
+        db = connection_for(user_id)
+        now = now_epoch()
+        cursor = db.execute("""
+            INSERT OR IGNORE INTO outbox
+            (user_id, source_table, source_id, occurrence, message, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, source_table, source_id, to_epoch(occurrence), message, to_epoch(send_at) or now, now))
+        db.commit()
+        return cursor.rowcount > 0
+
+    def claim_outbox(self, shard, now, limit, lease_until):
+        """領取分片內已到發送時間的訊息 (單一寫入者，同一個 UPDATE 內選取並標記，不會被重複領取)"""
+        db = get_db(shard)
+        rows = db.execute("""
+            UPDATE outbox SET status = ?, next_attempt_at = ?
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE status IN (?, ?) AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            )
+            RETURNING *
+        """, (OUTBOX_SENDING, to_epoch(lease_until), OUTBOX_PENDING, OUTBOX_SENDING, to_epoch(now), limit)).fetchall()
+        db.commit()
+        return rows
+
+    def mark_outbox_sent(self, user_id, outbox_id):
+        """標記訊息已發送"""
+        db = connection_for(user_id)
+        db.execute(
+            "UPDATE outbox SET status = ?, sent_at = ?, attempts = attempts + 1 WHERE id = ? AND user_id = ? AND status = ?",
+            (OUTBOX_SENT, now_epoch(), outbox_id, user_id, OUTBOX_SENDING)
+        )
+        db.commit()
+
+    def mark_outbox_failed(self, user_id, outbox_id, error, retry_at=None):
+        """記錄發送失敗，retry_at 為 None 時轉為 dead letter"""
+        db = connection_for(user_id)
+        if retry_at is None:
+            db.execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ? WHERE id = ? AND user_id = ? AND status = ?",
+                (OUTBOX_DEAD, error, outbox_id, user_id, OUTBOX_SENDING)
+            )
+        else:
+            db.execute("""
+                UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                WHERE id = ? AND user_id = ? AND status = ?
+            """, (OUTBOX_PENDING, to_epoch(retry_at), error, outbox_id, user_id, OUTBOX_SENDING))
+        db.commit()
+
+    def purge_outbox(self, shard, before):
+        """刪除在 before 之前已發送的訊息"""
+        db = get_db(shard)
+        cursor = db.execute(
+            "DELETE FROM outbox WHERE status = ? AND sent_at < ?", (OUTBOX_SENT, to_epoch(before))
+        )
+        db.commit()
+        return cursor.rowcount
+
+    def find_outbox(self, user_id, source_table, occurrence):
+        """用戶在這次提醒收到的訊息"""
+        return connection_for(user_id).execute(
+            "SELECT id, source_id, message, status FROM outbox WHERE user_id = ? AND source_table = ? AND occurrence = ?",
+            (user_id, source_table, to_epoch(occurrence))
+        ).fetchall()
+
+    def snooze_outbox(self, user_id, outbox_ids, send_at):
+        """把收到的提醒改為在 send_at 再發送一次 (沿用同一筆 outbox，不新增資料)"""
+        if not outbox_ids:
+            return False
+        db = connection_for(user_id)
+        cursor = db.execute(f"""
+            UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ?, last_error = NULL
+            WHERE user_id = ? AND id IN ({', '.join('?' * len(outbox_ids))}) AND status IN (?, ?)
+        """, (OUTBOX_PENDING, to_epoch(send_at), user_id, *outbox_ids, OUTBOX_PENDING, OUTBOX_SENT))
+        db.commit()
+        return cursor.rowcount > 0
+
+    def acknowledge_outbox(self, user_id, outbox_ids):
+        """取消尚未發送的稍後提醒，單次的提醒標記為完成"""
+        if not outbox_ids:
+            return False
+        db = connection_for(user_id)
+        placeholders = ', '.join('?' * len(outbox_ids))
+        rows = db.execute(
+            f"SELECT source_table, source_id FROM outbox WHERE user_id = ? AND id IN ({placeholders})",
+            (user_id, *outbox_ids)
+        ).fetchall()
+        if not rows:
+            return False
+        db.execute(
+            f"UPDATE outbox SET status = ? WHERE user_id = ? AND id IN ({placeholders}) AND status = ?",
+            (OUTBOX_SENT, user_id, *outbox_ids, OUTBOX_PENDING)
+        )
+        reminder_ids = [row['source_id'] for row in rows if row['source_table'] == REMINDERS]
+        if reminder_ids:
+            db.execute(
+                f"UPDATE reminders SET is_done = 1 WHERE user_id = ? AND rrule IS NULL AND id IN ({', '.join('?' * len(reminder_ids))})",
+                (user_id, *reminder_ids)
+            )
+        db.commit()
+        return True
+
+    def set_digest_subscription(self, user_id, enabled):
+        """訂閱或取消每日摘要"""
+        db = connection_for(user_id)
+        if enabled:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO digest_subscriptions (user_id, created_at) VALUES (?, ?)",
+                (user_id, now_epoch())
+            )
+        else:
+            cursor = db.execute("DELETE FROM digest_subscriptions WHERE user_id = ?", (user_id,))
+        db.commit()
+        return cursor.rowcount > 0
+
+    def get_digest_batch(self, shard, start, end, after=None, limit=500):
+        """分片內當天還沒收到摘要的訂閱者及其行程與提醒 (一個查詢)"""
+        start, end = to_epoch(start), to_epoch(end)
+        # 兩邊的條件都能使用 (user_id, 時間) 索引；重複項目的時間是下一次發生時間，晚於 end 就不會落在當天
+        return get_db(shard).execute("""
+            WITH due AS (
+                SELECT user_id FROM digest_subscriptions
+                WHERE last_sent < ? AND user_id > ?
+                ORDER BY user_id
+                LIMIT ?
+            )
+            SELECT d.user_id, CASE WHEN s.id IS NULL THEN NULL ELSE ? END AS kind,
+                s.title, s.description, s.scheduled_time AS at, s.rrule
+            FROM due d
+            LEFT JOIN schedules s ON s.user_id = d.user_id
+                AND s.scheduled_time < ?
+                AND (s.rrule IS NOT NULL OR s.scheduled_time >= ?)
+            UNION ALL
+            SELECT d.user_id, ?, r.content, NULL, r.remind_time, r.rrule
+            FROM due d
+            JOIN reminders r ON r.user_id = d.user_id
+                AND r.remind_time < ?
+                AND (r.rrule IS NOT NULL OR r.remind_time >= ?)
+            ORDER BY 1
+        """, (start, after or '', limit, SCHEDULES, end, start, REMINDERS, end, start)).fetchall()
+
+    def mark_digest_sent(self, user_id, day_start):
+        """記錄用戶已收到那一天的摘要"""
+        db = connection_for(user_id)
+        db.execute(
+            "UPDATE digest_subscriptions SET last_sent = ? WHERE user_id = ?", (to_epoch(day_start), user_id)
+        )
+        db.commit()
+
+    def iter_items(self, user_id, kind, batch_size=EXPORT_BATCH):
+        """逐批讀出用戶的筆記、行程或提醒 (SQLite 的游標本來就是逐步執行，fetchmany 每次只取 batch_size 筆)"""
+        db = connection_for(user_id)
+        cursor = db.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS[kind])} FROM {kind} WHERE user_id = ? ORDER BY {EXPORT_ORDER[kind]}, id",
+            (user_id,)
+        )
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def import_items(self, user_id, kind, rows):
+        """以 executemany 寫入一批資料，行程與提醒接著建立待提醒項目"""
+        db = connection_for(user_id)
+        columns = IMPORT_COLUMNS[kind]
+        try:
+            db.executemany(
+                f"INSERT INTO {kind} (user_id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+                [(user_id, *(row.get(column) for column in columns)) for row in rows]
+            )
+            if kind in TIME_COLUMNS:
+                backfill_due_items(db, user_id, (kind,))
+            db.commit()
+        except Exception:
+            if not db.unit_depth:
+                db.rollback()
+            raise
+        return len(rows)
+
+    def add_stats(self, counters, members=()):
+        """以 UPSERT 累加每小時計數；成員以 INSERT OR IGNORE 去重，實際新增的筆數加到對應的計數"""
+        db = get_db(STATS_SHARD)
+        counters = dict(counters)
+        groups = {}
+        for bucket, metric, member in members:
+            groups.setdefault((bucket, metric), []).append((bucket, metric, member))
+        try:
+            for key, rows in groups.items():
+                cursor = db.executemany(
+                    "INSERT OR IGNORE INTO stats_members (bucket, metric, member) VALUES (?, ?, ?)", rows
+                )
+                counters[key] = counters.get(key, 0) + cursor.rowcount
+            db.executemany("""
+                INSERT INTO stats_hourly (bucket, metric, value) VALUES (?, ?, ?)
+                ON CONFLICT (bucket, metric) DO UPDATE SET value = value + excluded.value
+            """, [(bucket, metric, value) for (bucket, metric), value in counters.items() if value])
+            db.commit()
+        except Exception:
+            if not db.unit_depth:
+                db.rollback()
+            raise
+
+    def get_stats(self, start, end):
+        """bucket 落在 [start, end) 的彙總計數 (走主鍵的範圍查詢)"""
+        return get_db(STATS_SHARD).execute(
+            "SELECT bucket, metric, value FROM stats_hourly WHERE bucket >= ? AND bucket < ? ORDER BY bucket, metric",
+            (to_epoch(start), to_epoch(end))
+        ).fetchall()
+
+    def purge_stats_members(self, before):
+        """刪除 bucket 早於 before 的去重成員"""
+        db = get_db(STATS_SHARD)
+        cursor = db.execute("DELETE FROM stats_members WHERE bucket < ?", (to_epoch(before),))
+        db.commit()
+        return cursor.rowcount
+
     def close(self):
-        """關閉資料庫連接"""
-        self.db.close()
+        """關閉目前執行緒的資料庫連接"""
+        close_db()
@@ -0,0 +1,209 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from logger import get_logger
+from outbox import outbox_sender, is_permanent
+from recurrence import upcoming_occurrences, WEEKDAY_NAMES
+from stats import stats_recorder, DIGESTS_SENT
+from storage import get_storage, SCHEDULES
+from timeutil import from_epoch, day_range
+import timeutil
+
+logger = get_logger(__name__)
+
+# 每天發送摘要的時間 (台北時間 HH:MM)，摘要內容為當天的行程與提醒
+DIGEST_TIME = os.getenv('DIGEST_TIME', '07:30')
+# 超過發送時間多久後就不再補發當天的摘要 (秒)
+DIGEST_LATE_LIMIT = 3 * 3600
+# 每個分區每次查詢的訂閱者人數
+DIGEST_BATCH = 500
+# 同時進行的推播數
+DIGEST_CONCURRENCY = int(os.getenv('DIGEST_CONCURRENCY', '8'))
+# 檢查是否到了發送時間的間隔 (秒)；發送失敗的用戶也在下一次檢查時重試
+DIGEST_INTERVAL = 60
+# 摘要最多列出的項目數，避免超過 Flex 訊息的大小限制
+DIGEST_MAX_ITEMS = 20
+
+# 用戶輸入這些文字時訂閱或取消每日摘要
+SUBSCRIBE_COMMANDS = ('訂閱每日摘要', '訂閱摘要')
+UNSUBSCRIBE_COMMANDS = ('取消每日摘要', '取消訂閱摘要')
+
+_RETRY_KEY_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'line-bot/digest')
+
+
+def digest_day(now):
+    """now 落在發送時段內時回傳要發送摘要的日期，否則回傳 None"""
+    hour, minute = map(int, DIGEST_TIME.split(':'))
+    send_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if send_at <= now < send_at + timedelta(seconds=DIGEST_LATE_LIMIT):
+        return now.date()
+    return None
+
+
+def collect_items(rows, start, end):
+    """把 get_digest_batch 的結果依用戶整理，重複項目展開為當天的發生時間
+    Returns:
+        dict: {user_id: [(時間, kind, 標題, 描述)]}，依時間排序；沒有項目的用戶為空列表
+    """
+    users = {}
+    for row in rows:
+        items = users.setdefault(row['user_id'], [])
+        if row['kind'] is None:
+            continue
+        at = from_epoch(row['at'])
+        if row['rrule']:
+            try:
+                occurrences = upcoming_occurrences(row['rrule'], at, limit=DIGEST_MAX_ITEMS, start=start, end=end)
+            except ValueError as e:
+                logger.warning("無法展開重複規則: %s", e, extra={'user_id': row['user_id']})
+                continue
+        else:
+            occurrences = [at]
+        items.extend((occurrence, row['kind'], row['title'], row['description']) for occurrence in occurrences)
+    for items in users.values():
+        items.sort(key=lambda item: item[0])
+    return users
+
+
+def build_digest_message(day, items):
+    """把當天的項目組成一則 Flex 摘要"""
+    from linebot.v3.messaging import FlexBox, FlexBubble, FlexMessage, FlexSeparator, FlexText
+    schedules = sum(1 for _, kind, _, _ in items if kind == SCHEDULES)
+    reminders = len(items) - schedules
+
+    rows = []
+    for at, kind, title, description in items[:DIGEST_MAX_ITEMS]:
+        contents = [
+            FlexText(text=at.strftime('%H:%M'), size="sm", color="#888888", flex=0),
+            FlexText(text=f"{'📅' if kind == SCHEDULES else '⏰'} {title or '未設定標題'}", size="sm", wrap=True, flex=1),
+        ]
+        rows.append(FlexBox(layout="horizontal", spacing="md", contents=contents))
+        if description:
+            rows.append(FlexText(text=description, size="xs", color="#aaaaaa", wrap=True, margin="none"))
+    if len(items) > DIGEST_MAX_ITEMS:
+        rows.append(FlexText(text=f"…還有 {len(items) - DIGEST_MAX_ITEMS} 項", size="xs", color="#aaaaaa"))
+
+    summary = f"今天有 {schedules} 個行程、{reminders} 個提醒"
+    return FlexMessage(
+        alt_text=summary,
+        contents=FlexBubble(
+            size="kilo",
+            header=FlexBox(
+                layout="vertical",
+                contents=[
+                    FlexText(text="☀️ 今日摘要", weight="bold", size="xl"),
+                    FlexText(text=f"{day.month}月{day.day}日 (週{WEEKDAY_NAMES[day.weekday()]})　{summary}",
+                             size="xs", color="#aaaaaa", wrap=True),
+                ]
+            ),
+            body=FlexBox(
+                layout="vertical",
+                spacing="sm",
+                contents=[FlexSeparator(), *rows]
+            )
+        )
+    )
+
+
+class DigestSender:
+    """每天在 DIGEST_TIME 把當天的行程與提醒整理成一則摘要推播給訂閱者
+
+    各分區以一個查詢取出一批訂閱者與他們當天的項目，再以有限的並行數推播，
+    取代用戶每天早上詢問 AI「今天有什麼行程」。推播成功 (或沒有項目) 後記錄已發送，
+    程序重啟或暫時失敗時，發送時段內的下一次檢查會補發尚未收到的用戶。
+    """
+
+    def __init__(self, interval=DIGEST_INTERVAL, concurrency=DIGEST_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.thread = None
+        self.stop_event = threading.Event()
+        self._executor = None
+
+    def start(self):
+        """啟動摘要排程"""
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """停止摘要排程"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                day = digest_day(timeutil.now())
+                if day:
+                    self.send_digests(day)
+            except Exception as e:
+                logger.exception("發送每日摘要時出錯: %s", e)
+
+    def send_digests(self, day):
+        """發送 day 的摘要給所有還沒收到的訂閱者
+        Returns:
+            dict: {'sent': 已推播, 'empty': 當天沒有項目 (不推播), 'failed': 稍後重試, 'dropped': 放棄}
+        """
+        storage = get_storage()
+        start, end = day_range(day)
+        start_dt, end_dt = from_epoch(start), from_epoch(end)
+        stats = {'sent': 0, 'empty': 0, 'failed': 0, 'dropped': 0}
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='digest')
+
+        def send_partition(partition):
+            counts = dict.fromkeys(stats, 0)
+            after = None
+            while True:
+                users = collect_items(storage.get_digest_batch(partition, start, end, after, DIGEST_BATCH), start_dt, end_dt)
+                if not users:
+                    return counts
+                for result in self._executor.map(lambda user: self._send(storage, day, start, *user), users.items()):
+                    counts[result] += 1
+                if len(users) < DIGEST_BATCH:
+                    return counts
+                after = max(users)
+
+        for counts in storage.map_partitions(send_partition):
+            for key, count in counts.items():
+                stats[key] += count
+        stats_recorder.record(DIGESTS_SENT, stats['sent'])
+        if any(stats.values()):
+            logger.info("每日摘要發送完成", extra={'day': day.isoformat(), **stats})
+        return stats
+
+    def _send(self, storage, day, day_start, user_id, items):
+        """推播一位用戶的摘要並記錄已發送，回傳統計用的分類"""
+        if not items:
+            storage.mark_digest_sent(user_id, day_start)
+            return 'empty'
+        from linebot.v3.messaging import PushMessageRequest
+        key = str(uuid.uuid5(_RETRY_KEY_NAMESPACE, f"{user_id}:{day.isoformat()}"))
+        try:
+            outbox_sender.messaging_api.push_message(
+                PushMessageRequest(to=user_id, messages=[build_digest_message(day, items)]), x_line_retry_key=key
+            )
+            result = 'sent'
+        except Exception as e:
+            if getattr(e, 'status', None) == 409:
+                # 同一個重試 key 已經送出過
+                result = 'sent'
+            elif is_permanent(e):
+                # 用戶封鎖了機器人等無法重試的錯誤，當天不再發送
+                logger.error("每日摘要發送失敗: %s", e, extra={'user_id': user_id})
+                result = 'dropped'
+            else:
+                logger.warning("每日摘要發送失敗，稍後重試: %s", e, extra={'user_id': user_id})
+                return 'failed'
+        storage.mark_digest_sent(user_id, day_start)
+        return result
+
+
+digest_sender = DigestSender()
@@ -0,0 +1,509 @@
+"""筆記、行程與提醒的大量匯出/匯入
+
+匯出以產生器逐批輸出 NDJSON、CSV 或 ICS，資料由 Storage.iter_items 的游標逐批讀出，
+記憶體用量不隨筆數增加，可以直接作為 Flask 的串流回應。
+匯入分兩個階段：先把上傳內容 (最多 MAX_IMPORT_BYTES) 複製到暫存檔，逐筆檢查並把整理後的資料寫入另一個暫存檔，
+這段期間不碰資料庫；全部正確後才開啟一個短交易，每 IMPORT_BATCH 筆以 executemany 寫入。
+上傳很慢或中途停住時不會佔住分片的寫入鎖，任何一筆有誤時也不會留下匯入一半的資料。
+
+用法:
+    python export.py export U1234 > backup.ndjson                       # 全部資料 (NDJSON)
+    python export.py export U1234 --kind schedules --format ics > a.ics
+    python export.py import U1234 backup.ndjson
+    python export.py import U1234 notes.csv --kind notes
+"""
+import argparse
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import date, datetime, timedelta, timezone
+
+from logger import get_logger
+from recurrence import parse_rrule, next_occurrence
+from storage import (
+    get_storage, NOTES, SCHEDULES, REMINDERS, TIME_COLUMNS, EXPORT_COLUMNS, PRIORITY_NORMAL, PRIORITY_URGENT,
+    remind_offsets,
+)
+from timeutil import TIMEZONE, to_epoch, from_epoch, now_epoch
+
+logger = get_logger(__name__)
+
+KINDS = (NOTES, SCHEDULES, REMINDERS)
+# 匯出全部資料 (CSV 各類型的欄位不同，只能指定單一類型)
+ALL = 'all'
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'ics': 'text/calendar',
+}
+# 匯出時累積到這個大小才輸出一次，避免每一筆都是一個小區塊
+EXPORT_CHUNK = 64 * 1024
+# 匯入時每批以 executemany 寫入的筆數
+IMPORT_BATCH = 1000
+# 匯入內容的大小上限
+MAX_IMPORT_BYTES = int(os.getenv('MAX_IMPORT_BYTES', str(20 * 1024 * 1024)))
+# 匯出與匯入連結的有效時間 (秒)；兩者的權杖以不同用途簽章，匯出連結不能用來匯入
+EXPORT_LINK_TTL = 3600
+IMPORT_LINK_TTL = 600
+EXPORT = 'export'
+IMPORT = 'import'
+# 以台北時間表示的欄位，匯出為帶時區的 ISO 8601
+TIME_FIELDS = ('created_at', 'scheduled_time', 'remind_time')
+
+# 用戶輸入這些文字時回覆匯出或匯入連結
+EXPORT_COMMANDS = ('匯出資料', '匯出')
+IMPORT_COMMANDS = ('匯入資料', '匯入')
+
+_ICS_COMPONENTS = {SCHEDULES: 'VEVENT', REMINDERS: 'VTODO', NOTES: 'VJOURNAL'}
+
+
+def _kinds(kind):
+    if kind == ALL:
+        return KINDS
+    if kind not in KINDS:
+        raise ValueError(f"不支援的類型: {kind}")
+    return (kind,)
+
+
+def _format_time(epoch):
+    return datetime.fromtimestamp(epoch, TIMEZONE).isoformat() if epoch is not None else None
+
+
+def _parse_time(value):
+    """匯入的時間：epoch 秒、ISO 8601 (有時區時依其時區，沒有時視為台北時間) 或 timeutil 支援的字串"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"無法解析時間: {value}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return to_epoch(value)
+    return to_epoch(value)
+
+
+def _flag(value):
+    return 1 if str(value).strip().lower() in ('1', 'true', 'yes', 'y') else 0
+
+
+def _chunked(pieces):
+    """把逐筆產生的字串合併成約 EXPORT_CHUNK 大小的區塊"""
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= EXPORT_CHUNK:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _record(row):
+    return {key: _format_time(value) if key in TIME_FIELDS else value for key, value in row.items()}
+
+
+# 匯出
+
+def _ndjson_lines(storage, user_id, kinds):
+    for kind in kinds:
+        for row in storage.iter_items(user_id, kind):
+            yield json.dumps({'kind': kind, **_record(row)}, ensure_ascii=False) + '\n'
+
+
+def _csv_lines(storage, user_id, kind):
+    columns = EXPORT_COLUMNS[kind]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(columns)
+    yield take()
+    for row in storage.iter_items(user_id, kind):
+        record = _record(row)
+        writer.writerow([record[column] for column in columns])
+        yield take()
+
+
+def _ics_escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _ics_fold(line):
+    """RFC 5545：每行最多 75 個位元組，超過的以 CRLF 加空白接續 (不切斷 UTF-8 字元)"""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts, current, size = [], '', 0
+    for char in line:
+        width = len(char.encode('utf-8'))
+        if size + width > (75 if not parts else 74):
+            parts.append(current)
+            current, size = '', 0
+        current += char
+        size += width
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _ics_local(epoch):
+    return from_epoch(epoch).strftime('%Y%m%dT%H%M%S')
+
+
+def _ics_utc(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _ics_component(kind, row, stamp):
+    """一筆資料轉為 ICS 元件：行程為 VEVENT (提前提醒為 VALARM)、提醒為 VTODO、筆記為 VJOURNAL"""
+    component = _ICS_COMPONENTS[kind]
+    lines = [f"BEGIN:{component}", f"UID:{kind}-{row['id']}@linebotcalendar", f"DTSTAMP:{stamp}",
+             f"CREATED:{_ics_utc(row['created_at'])}"]
+    if kind == NOTES:
+        lines += [f"DTSTART;TZID=Asia/Taipei:{_ics_local(row['created_at'])}", f"DESCRIPTION:{_ics_escape(row['content'])}"]
+    elif kind == SCHEDULES:
+        start = row['scheduled_time']
+        lines += [
+            f"DTSTART;TZID=Asia/Taipei:{_ics_local(start)}",
+            f"DTEND;TZID=Asia/Taipei:{_ics_local(start + 3600)}",
+            f"SUMMARY:{_ics_escape(row['title'])}",
+        ]
+        if row['description']:
+            lines.append(f"DESCRIPTION:{_ics_escape(row['description'])}")
+    else:
+        lines += [f"DUE;TZID=Asia/Taipei:{_ics_local(row['remind_time'])}", f"SUMMARY:{_ics_escape(row['content'])}"]
+        if row['is_done']:
+            lines.append("STATUS:COMPLETED")
+    if kind != NOTES:
+        if row['rrule']:
+            lines.append(f"RRULE:{row['rrule']}")
+        if row['priority'] == PRIORITY_URGENT:
+            lines.append("PRIORITY:1")
+    if kind == SCHEDULES and row['remind_before'] is not None:
+        lines += ["BEGIN:VALARM", "ACTION:DISPLAY", f"DESCRIPTION:{_ics_escape(row['title'])}",
+                  f"TRIGGER:-PT{row['remind_before']}M", "END:VALARM"]
+    lines.append(f"END:{component}")
+    return ''.join(_ics_fold(line) for line in lines)
+
+
+def _ics_lines(storage, user_id, kinds):
+    stamp = _ics_utc(now_epoch())
+    yield ''.join(_ics_fold(line) for line in [
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Line Bot//Export//TW", "CALSCALE:GREGORIAN",
+        "BEGIN:VTIMEZONE", "TZID:Asia/Taipei", "BEGIN:STANDARD", "DTSTART:19700101T000000",
+        "TZOFFSETFROM:+0800", "TZOFFSETTO:+0800", "TZNAME:CST", "END:STANDARD", "END:VTIMEZONE",
+    ])
+    for kind in kinds:
+        for row in storage.iter_items(user_id, kind):
+            yield _ics_component(kind, row, stamp)
+    yield "END:VCALENDAR\r\n"
+
+
+def export_stream(storage, user_id, kind=ALL, fmt='ndjson'):
+    """以產生器輸出用戶的資料
+    Args:
+        kind (str): NOTES、SCHEDULES、REMINDERS 或 ALL (CSV 不支援 ALL)
+        fmt (str): FORMATS 中的格式
+    Returns:
+        generator: 約 EXPORT_CHUNK 大小的字串區塊
+    Raises:
+        ValueError: 類型或格式不支援 (在開始輸出前檢查)
+    """
+    kinds = _kinds(kind)
+    if fmt == 'ndjson':
+        lines = _ndjson_lines(storage, user_id, kinds)
+    elif fmt == 'csv':
+        if kind == ALL:
+            raise ValueError("CSV 需要指定單一類型 (notes、schedules 或 reminders)")
+        lines = _csv_lines(storage, user_id, kind)
+    elif fmt == 'ics':
+        lines = _ics_lines(storage, user_id, kinds)
+    else:
+        raise ValueError(f"不支援的格式: {fmt}")
+    return _chunked(lines)
+
+
+# 匯入
+
+class ImportTooLarge(ValueError):
+    """匯入內容超過 MAX_IMPORT_BYTES"""
+
+
+def spool_upload(stream, max_bytes=MAX_IMPORT_BYTES):
+    """把上傳內容 (bytes 串流) 複製到暫存檔，之後的檢查與寫入都從本機檔案讀取
+    Returns:
+        暫存檔 (已移到開頭，binary 模式)，呼叫端負責關閉
+    Raises:
+        ImportTooLarge: 超過 max_bytes
+    """
+    spool = tempfile.TemporaryFile()
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(EXPORT_CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise ImportTooLarge(f"匯入內容超過 {max_bytes // (1024 * 1024)} MB")
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def _ics_records(stream, kinds):
+    """解析 ICS (需整份讀入，大小由 spool_upload 限制)：VEVENT 為行程、VTODO 為提醒、VJOURNAL 為筆記"""
+    from icalendar import Calendar  # 只有匯入 ICS 時才需要
+    calendar = Calendar.from_ical(stream.read())
+    components = {component: kind for kind, component in _ICS_COMPONENTS.items() if kind in kinds}
+
+    def value(component, key):
+        prop = component.get(key)
+        return prop.dt if hasattr(prop, 'dt') else (str(prop) if prop is not None else None)
+
+    for component in calendar.walk():
+        kind = components.get(component.name)
+        if kind is None:
+            continue
+        created_at = value(component, 'CREATED') or value(component, 'DTSTAMP')
+        if kind == NOTES:
+            yield kind, {'content': value(component, 'DESCRIPTION') or value(component, 'SUMMARY'),
+                         'created_at': created_at}
+            continue
+        rrule = component.get('RRULE')
+        record = {
+            'rrule': rrule.to_ical().decode() if rrule else None,
+            'priority': PRIORITY_URGENT if str(component.get('PRIORITY', '')) in ('1', '2', '3', '4') else PRIORITY_NORMAL,
+            'created_at': created_at,
+        }
+        if kind == SCHEDULES:
+            triggers = [value(alarm, 'TRIGGER') for alarm in component.walk('VALARM')]
+            alarms = [trigger for trigger in triggers if isinstance(trigger, timedelta)]
+            record.update(
+                title=value(component, 'SUMMARY'),
+                description=value(component, 'DESCRIPTION'),
+                scheduled_time=value(component, 'DTSTART'),
+                remind_before=[int(-alarm.total_seconds() // 60) for alarm in alarms] or None,
+            )
+        else:
+            record.update(
+                content=value(component, 'SUMMARY') or value(component, 'DESCRIPTION'),
+                remind_time=value(component, 'DUE') or value(component, 'DTSTART'),
+                is_done=str(component.get('STATUS', '')).upper() == 'COMPLETED',
+            )
+        yield kind, record
+
+
+def read_records(stream, fmt, kind=ALL):
+    """逐筆讀出匯入資料，產生 (類型, 欄位 dict)；NDJSON 每一行可以用 kind 欄位指定類型"""
+    kinds = _kinds(kind)
+    if fmt == 'ndjson':
+        for line in stream:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record.pop('kind', kind), record
+    elif fmt == 'csv':
+        if kind == ALL:
+            raise ValueError("CSV 需要指定單一類型 (notes、schedules 或 reminders)")
+        for record in csv.DictReader(stream):
+            yield kind, record
+    elif fmt == 'ics':
+        yield from _ics_records(stream, kinds)
+    else:
+        raise ValueError(f"不支援的格式: {fmt}")
+
+
+def normalize_record(kind, record, now):
+    """把一筆匯入資料整理為 IMPORT_COLUMNS 的欄位
+    已過了提醒時間的單次項目標記為已提醒；重複項目移到提醒時間晚於現在的下一次發生時間
+    (與提醒掃描補發延遲的重複項目相同)，沒有下一次時標記為已提醒。
+    """
+    created_at = _parse_time(record.get('created_at')) or now
+    if kind == NOTES:
+        content = (record.get('content') or '').strip()
+        if not content:
+            raise ValueError("筆記內容不可為空")
+        return {'content': content, 'created_at': created_at}
+
+    column = TIME_COLUMNS[kind]
+    at = _parse_time(record.get(column))
+    if at is None:
+        raise ValueError(f"缺少 {column}")
+    text = (record.get('title') if kind == SCHEDULES else record.get('content')) or ''
+    if not text.strip():
+        raise ValueError("行程標題不可為空" if kind == SCHEDULES else "提醒內容不可為空")
+
+    offset = 0
+    if kind == SCHEDULES:
+        remind_before = record.get('remind_before')
+        if isinstance(remind_before, str):
+            remind_before = int(remind_before) if remind_before.strip() else None
+        # 資料表只保存一個提前時間，多個時取最接近行程的那個
+        offset = remind_offsets(5 if remind_before is None else remind_before)[-1]
+    rrule = record.get('rrule') or None
+    is_done = _flag(record.get('is_done', 0))
+    reminded = is_done
+    if rrule:
+        parse_rrule(rrule)
+        if at - offset * 60 <= now:
+            next_time, rrule_next = next_occurrence(rrule, from_epoch(at), from_epoch(now + offset * 60))
+            if next_time is None:
+                reminded = 1
+            else:
+                at, rrule = to_epoch(next_time), rrule_next
+    elif at - offset * 60 <= now:
+        reminded = 1
+
+    priority = record.get('priority')
+    row = {
+        column: at,
+        'rrule': rrule,
+        'priority': int(priority) if priority not in (None, '') else PRIORITY_NORMAL,
+        'created_at': created_at,
+        'reminded': reminded,
+    }
+    if kind == SCHEDULES:
+        row.update(title=text.strip(), description=record.get('description') or None, remind_before=offset)
+    else:
+        row.update(content=text.strip(), is_done=is_done)
+    return row
+
+
+def stage_records(records, now):
+    """逐筆檢查並整理所有資料 (不碰資料庫)，整理後的 (類型, 欄位) 逐行寫入暫存檔
+    Returns:
+        暫存檔 (已移到開頭，文字模式)，呼叫端負責關閉
+    Raises:
+        ValueError: 某一筆資料有誤 (訊息含第幾筆)
+    """
+    staged = tempfile.TemporaryFile('w+', encoding='utf-8')
+    try:
+        for number, (kind, record) in enumerate(records, 1):
+            if kind not in KINDS:
+                raise ValueError(f"第 {number} 筆: 不支援的類型 {kind}")
+            try:
+                row = normalize_record(kind, record, now)
+            except (ValueError, TypeError, AttributeError) as e:
+                raise ValueError(f"第 {number} 筆: {e}") from e
+            staged.write(json.dumps([kind, row], ensure_ascii=False) + '\n')
+    except BaseException:
+        staged.close()
+        raise
+    staged.seek(0)
+    return staged
+
+
+def import_records(storage, user_id, records, now=None):
+    """先以 stage_records 檢查所有資料，全部正確後才在同一個工作單元內寫入，每 IMPORT_BATCH 筆以 executemany 寫入一次
+    (交易期間只讀取本機的暫存檔，不會等待上傳或解析)
+    Returns:
+        dict: {類型: 匯入筆數}
+    Raises:
+        ValueError: 某一筆資料有誤 (訊息含第幾筆)，不會寫入任何資料
+    """
+    now = now or now_epoch()
+    counts = dict.fromkeys(KINDS, 0)
+    batches = {kind: [] for kind in KINDS}
+    with stage_records(records, now) as staged, storage.unit_of_work(user_id):
+        for line in staged:
+            kind, row = json.loads(line)
+            batches[kind].append(row)
+            if len(batches[kind]) >= IMPORT_BATCH:
+                counts[kind] += storage.import_items(user_id, kind, batches[kind])
+                batches[kind] = []
+        for kind, rows in batches.items():
+            if rows:
+                counts[kind] += storage.import_items(user_id, kind, rows)
+    logger.info("匯入完成", extra={'user_id': user_id, **counts})
+    return counts
+
+
+def import_stream(storage, user_id, stream, fmt, kind=ALL):
+    """從文字串流匯入 (格式見 read_records)"""
+    try:
+        return import_records(storage, user_id, read_records(stream, fmt, kind))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"NDJSON 格式錯誤: {e}") from e
+
+
+# 匯出/匯入連結
+
+def _signature(payload):
+    secret = (os.getenv('LINE_CHANNEL_SECRET') or '').encode('utf-8')
+    digest = hmac.new(secret, payload.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode('ascii')
+
+
+def export_token(user_id, purpose=EXPORT, ttl=None):
+    """用戶專屬、有時效的權杖 (以 LINE channel secret 簽章)；purpose 為 EXPORT 或 IMPORT，一併簽入，
+    只能用在簽發時的用途 (匯出連結會傳到聊天室，不能拿來覆寫資料)
+    """
+    if ttl is None:
+        ttl = IMPORT_LINK_TTL if purpose == IMPORT else EXPORT_LINK_TTL
+    expires = now_epoch() + ttl
+    return f"{user_id}.{expires}.{_signature(f'{purpose}:{user_id}.{expires}')}"
+
+
+def verify_export_token(token, purpose=EXPORT):
+    """驗證 purpose 用途的權杖，有效時回傳 user_id，否則回傳 None"""
+    try:
+        user_id, expires, signature = token.rsplit('.', 2)
+        expired = int(expires) < now_epoch()
+    except ValueError:
+        return None
+    if expired or not hmac.compare_digest(signature, _signature(f"{purpose}:{user_id}.{expires}")):
+        return None
+    return user_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export = subparsers.add_parser('export', help="匯出到標準輸出")
+    export.add_argument('user_id')
+    export.add_argument('--kind', default=ALL, choices=(ALL, *KINDS))
+    export.add_argument('--format', default='ndjson', choices=FORMATS)
+    imports = subparsers.add_parser('import', help="從檔案匯入")
+    imports.add_argument('user_id')
+    imports.add_argument('path')
+    imports.add_argument('--kind', default=ALL, choices=(ALL, *KINDS))
+    imports.add_argument('--format', choices=FORMATS, help="預設依副檔名判斷")
+    args = parser.parse_args()
+
+    storage = get_storage()
+    storage.init_schema()
+    if args.command == 'export':
+        for chunk in export_stream(storage, args.user_id, args.kind, args.format):
+            sys.stdout.write(chunk)
+        return
+    fmt = args.format or os.path.splitext(args.path)[1].lstrip('.').lower()
+    with open(args.path, encoding='utf-8-sig', newline='') as f:
+        counts = import_stream(storage, args.user_id, f, fmt, args.kind)
+    print(', '.join(f"{kind}: {count}" for kind, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,35 @@
-import google.generativeai as genai
 import os
+import threading
 from dotenv import load_dotenv
+from logger import get_logger
+from green import gevent_active
 
 # 載入環境變數
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # 設置 API 金鑰
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
-genai.configure(api_key=GOOGLE_API_KEY)
+
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    """載入並設定 google.generativeai (匯入約需一秒，第一次需要 Gemini 時才載入)"""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            # gRPC 不支援 gevent 的協程，gevent 模式改用 REST (走已 patch 的 socket)
+            genai.configure(api_key=GOOGLE_API_KEY, transport='rest' if gevent_active() else None)
+            _genai = genai
+    return _genai
 
 def get_gemini_response():
     """初始化並返回一個配置好的 Gemini 聊天實例"""
     # 初始化 Gemini Pro 模型
-    model = genai.GenerativeModel('gemini-pro')
+    model = get_genai().GenerativeModel('gemini-pro')
     
     # 設定管家角色
     system_prompt = """你現在是一個專業的AI助理，名字叫做 happy。
@@ -40,10 +57,10 @@ def get_gemini_response():
     chat = model.start_chat(history=[])
     try:
         response = chat.send_message(system_prompt)
-        print("角色設定成功")
+        logger.info("角色設定成功")
         return chat
     except Exception as e:
-        print(f"設定角色時發生錯誤: {str(e)}")
+        logger.error("設定角色時發生錯誤: %s", e)
         raise
 
 def process_user_message(chat, message):
@@ -52,7 +69,7 @@ def process_user_message(chat, message):
         response = chat.send_message(message)
         return response.text
     except Exception as e:
-        print(f"處理訊息時發生錯誤: {str(e)}")
+        logger.error("處理訊息時發生錯誤: %s", e)
         return "抱歉，我現在無法正確處理您的訊息。請稍後再試。"
 
 if __name__ == "__main__":
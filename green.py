@@ -0,0 +1,22 @@
+import sys
+
+# gunicorn 以 gevent worker 執行時 (見 gunicorn.conf.py)，worker 會在載入應用程式前
+# monkey patch 標準函式庫：threading.local 變成每個 greenlet 一份，所以 sharding 的
+# 連接會依請求分開；背景執行緒也會變成 greenlet。SQLite 與 fsync 在 C 程式碼裡阻塞時
+# 不會讓出控制權，長時間的工作要交給 gevent 的原生執行緒池，才不會卡住整個 worker。
+
+
+def gevent_active():
+    """目前行程是否已由 gevent monkey patch (沒有載入 gevent 時不會去 import 它)"""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def run_blocking(func, *args):
+    """在原生執行緒執行會阻塞的函式，呼叫端的 greenlet 等待期間其他請求照常處理；
+    不是 gevent 模式時直接呼叫
+    """
+    if not gevent_active():
+        return func(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(func, args)
@@ -0,0 +1,20 @@
+import os
+
+# webhook 幾乎都在等待 LINE API、Gemini 與資料庫，預設使用 gevent worker，
+# 單一 worker 就能以協程同時處理數百個請求；設定 GUNICORN_WORKER_CLASS=sync 可改回同步 worker
+wsgi_app = 'line_bot:create_app()'
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+
+# 每個 worker 都會啟動自己的提醒與壓縮執行緒，多個 worker 會重複發送提醒，因此預設只用一個
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+# 每個 gevent worker 同時處理的連線數上限
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '500'))
+
+# Gemini 的回應可能要十幾秒
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# 不可 preload：gevent 必須在載入應用程式 (threading、socket、SDK) 之前 monkey patch
+preload_app = False
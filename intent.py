@@ -0,0 +1,189 @@
+import re
+from datetime import datetime, time, timedelta
+
+import timeutil
+
+# 意圖名稱
+SCHEDULE_QUERY = 'schedule_query'
+REMINDER_QUERY = 'reminder_query'
+NOTES_QUERY = 'notes_query'
+
+# 直接比對的關鍵字，依分類列出
+_KEYWORDS = {
+    # 時間範圍
+    'today': ('今天', '今日', '今晚', '今早'),
+    'tomorrow': ('明天', '明日', '明早', '明晚'),
+    'day_after': ('後天',),
+    'this_week': ('這週', '这周', '本週', '本周', '這星期', '這禮拜', '這個禮拜'),
+    'next_week': ('下週', '下周', '下星期', '下禮拜', '下個禮拜'),
+    'this_month': ('這個月', '这个月', '本月'),
+    'next_month': ('下個月', '下个月'),
+    # 行程相關關鍵字
+    'schedule': ('行程', '日程', '待辦', '約會', '會議', '開會'),
+    # 搭配時間範圍才算行程查詢的用語，例如「明天有事嗎」
+    'busy': ('有什麼', '有什么', '有沒有', '有事', '要做', '忙嗎', '忙不忙', '有空', '安排', '計畫', '計劃', '活動'),
+}
+_QUERY_HEADS = ('我的', '哪些', '什麼', '什么', '有沒有', '查看', '查詢', '列出')
+# 需要前後文判斷的查詢用語：(開頭的文字, 之後的正規表示式)
+# 查詢提醒：「我的提醒」、「有哪些提醒」、「提醒事項」，但不包含「提醒我…」這類指令 (比對結果必定含「提醒」)
+_REMINDER = [
+    *((head, '(?:的)?提醒') for head in (*_QUERY_HEADS, '幾個')),
+    ('提醒', '(?:事項|清單|列表)'),
+    ('提醒', '(?!我)[^，。,.!！]*[嗎吗？?]$'),
+]
+# 查詢筆記：「我的筆記」、「筆記裡」、「記過什麼」(比對結果不含「提醒」)
+_NOTES = [
+    *((head, '(?:的)?(?:筆記|記事)') for head in _QUERY_HEADS),
+    *((head, '(?:裡|中|內)') for head in ('筆記', '記事')),
+    *((head, '(?:什麼|什么|哪些)') for head in ('記過', '記了', '記下')),
+]
+
+_GROUP_OF = {keyword: name for name, keywords in _KEYWORDS.items() for keyword in keywords}
+_WINDOW_NAMES = ('today', 'tomorrow', 'day_after', 'this_week', 'next_week', 'this_month', 'next_month')
+
+
+def _compile(entries):
+    """把 (開頭的文字, 之後的正規表示式) 依第一個字分組後編譯成一個正規表示式
+
+    每個分支都以固定的字開頭時，re 會先以這些字做預先篩選，在 C 裡直接跳過不可能是關鍵字開頭的位置，
+    一般聊天訊息幾乎不必嘗試任何分支；同一個字開頭的分支維持原本的先後順序
+    """
+    groups = {}
+    for head, rest in entries:
+        groups.setdefault(head[0], []).append(re.escape(head[1:]) + rest)
+    return re.compile('|'.join(
+        re.escape(char) + (branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})")
+        for char, branches in groups.items()
+    ))
+
+
+# 查詢用語與時間範圍分成兩個正規表示式：沒有查詢意圖的訊息 (大多數的聊天) 只需掃描一次，
+# 有查詢意圖時才需要找出時間範圍。提醒與筆記的用語放在前面，「有沒有提醒」才不會先被當成「有沒有」
+_INTENT_PATTERN = _compile([
+    *_REMINDER, *_NOTES, *((keyword, '') for name in ('schedule', 'busy') for keyword in _KEYWORDS[name]),
+])
+_WINDOW_PATTERN = _compile([(keyword, '') for name in _WINDOW_NAMES for keyword in _KEYWORDS[name]])
+
+# 視窗計算用的常數：_DAYS[n] 為 n 天 (每次以關鍵字參數建立 timedelta 或呼叫 replace 都比查表與加減慢得多)
+_DAYS = tuple(timedelta(days=n) for n in range(15))
+_MIDNIGHT = time()
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _next_month_start(day):
+    return datetime(day.year + day.month // 12, day.month % 12 + 1, 1, 0, 0, 0, 0, day.tzinfo)
+
+
+def time_window(name, now):
+    """把時間範圍名稱轉成 (開始, 結束) 的 datetime，結束時間不包含在內"""
+    today = datetime.combine(now, _MIDNIGHT, now.tzinfo)
+    if name == 'today':
+        return now, today + _DAYS[1]
+    if name == 'tomorrow':
+        return today + _DAYS[1], today + _DAYS[2]
+    if name == 'day_after':
+        return today + _DAYS[2], today + _DAYS[3]
+    week_start = today - _DAYS[today.weekday()]
+    if name == 'this_week':
+        return now, week_start + _DAYS[7]
+    if name == 'next_week':
+        return week_start + _DAYS[7], week_start + _DAYS[14]
+    if name == 'this_month':
+        return now, _next_month_start(today)
+    if name == 'next_month':
+        start = _next_month_start(today)
+        return start, _next_month_start(start)
+    return None
+
+
+def detect_intents(text, now=None):
+    """偵測訊息的查詢意圖
+    Args:
+        text (str): 用戶訊息
+        now (datetime): 目前時間，預設為台北時間
+    Returns:
+        dict: {'intents': set, 'window': (start, end) 或 None}
+    """
+    found = _INTENT_PATTERN.findall(text)
+    if not found:
+        return {'intents': set(), 'window': None}
+    # 關鍵字查表得到分類，其餘是提醒或筆記的正規表示式比對結果
+    matched = {_GROUP_OF.get(match) or ('reminder' if '提醒' in match else 'notes') for match in found}
+    window_names = {_GROUP_OF[match] for match in _WINDOW_PATTERN.findall(text)}
+
+    intents = set()
+    if 'reminder' in matched:
+        intents.add(REMINDER_QUERY)
+    if 'notes' in matched:
+        intents.add(NOTES_QUERY)
+    if 'schedule' in matched or (window_names and 'busy' in matched):
+        intents.add(SCHEDULE_QUERY)
+
+    window = None
+    if window_names and intents:
+        now = now or timeutil.now()
+        windows = [time_window(name, now) for name in _WINDOW_NAMES if name in window_names]
+        # 同時提到多個時間 (例如「今天和明天」) 時取聯集
+        window = windows[0] if len(windows) == 1 else (min(start for start, _ in windows), max(end for _, end in windows))
+
+    return {'intents': intents, 'window': window}
+
+
+# 準確度測試語料：(訊息, 預期意圖, 預期時間範圍名稱)
+CORPUS = [
+    ("今天有什麼行程", {SCHEDULE_QUERY}, 'today'),
+    ("明天有事嗎", {SCHEDULE_QUERY}, 'tomorrow'),
+    ("後天忙不忙", {SCHEDULE_QUERY}, 'day_after'),
+    ("下週的會議有哪些", {SCHEDULE_QUERY}, 'next_week'),
+    ("這個月有什麼安排", {SCHEDULE_QUERY}, 'this_month'),
+    ("下個月有活動嗎", {SCHEDULE_QUERY}, 'next_month'),
+    ("我的行程", {SCHEDULE_QUERY}, None),
+    ("我有哪些提醒", {REMINDER_QUERY}, None),
+    ("明天有什麼提醒嗎", {REMINDER_QUERY, SCHEDULE_QUERY}, 'tomorrow'),
+    ("查看提醒事項", {REMINDER_QUERY}, None),
+    ("我的筆記裡有wifi密碼嗎", {NOTES_QUERY}, None),
+    ("我記過什麼", {NOTES_QUERY}, None),
+    ("提醒我明天買牛奶", set(), None),
+    ("謝謝你的提醒", set(), None),
+    ("今天天氣如何", set(), None),
+    ("明天會下雨嗎", set(), None),
+    ("幫我寫一首詩", set(), None),
+    ("你好，請自我介紹", set(), None),
+    ("今天好累", set(), None),
+]
+
+
+if __name__ == "__main__":
+    import timeit
+
+    now = datetime(2024, 5, 15, 10, 0)
+
+    # 準確度
+    correct = 0
+    for text, expected_intents, expected_window in CORPUS:
+        result = detect_intents(text, now)
+        expected = time_window(expected_window, now) if expected_window else None
+        ok = result['intents'] == expected_intents and result['window'] == expected
+        correct += ok
+        if not ok:
+            print(f"不符: {text} -> {result}")
+    print(f"準確度: {correct}/{len(CORPUS)}")
+
+    # 效能：與原本逐一比對關鍵字的做法比較 (取多次執行中最快的一次，減少機器負載的影響)
+    def best(func, number=20):
+        return min(timeit.repeat(func, number=number, repeat=7))
+
+    keywords = ['行程', '日程', '安排', '計畫', '活動', '提醒', '待辦', '今天', '明天', '下週', '下个月']
+    texts = [text for text, _, _ in CORPUS] * 50
+    linear = best(lambda: [any(k in t for k in keywords) for t in texts])
+    compiled = best(lambda: [detect_intents(t, now) for t in texts])
+    per_call = compiled / (20 * len(texts)) * 1e6
+    print(f"逐一比對關鍵字: {linear:.4f}s, 意圖偵測: {compiled:.4f}s ({per_call:.2f} µs/訊息)")
+    # 沒有查詢意圖的訊息只掃描一次 (語料中大多是查詢，實際的聊天訊息多半屬於這一類)
+    chat = [text for text, expected_intents, _ in CORPUS if not expected_intents] * 150
+    linear = best(lambda: [any(k in t for k in keywords) for t in chat])
+    compiled = best(lambda: [detect_intents(t, now) for t in chat])
+    print(f"沒有查詢意圖的訊息: 逐一比對關鍵字 {linear:.4f}s, 意圖偵測 {compiled:.4f}s")
@@ -1,69 +1,84 @@
-from flask import Flask, request, abort, send_file
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.webhooks import (
-    MessageEvent, TextMessageContent,
-    PostbackEvent
-)
-from linebot.v3.messaging import (
-    Configuration, 
-    ApiClient, 
-    MessagingApi,
-    TextMessage,
-    TemplateMessage,
-    ButtonsTemplate,
-    DatetimePickerAction,
-    PostbackAction,
-    ReplyMessageRequest,
-    FlexMessage,
-    FlexContainer,
-    FlexBubble,
-    FlexBox,
-    FlexText,
-    FlexButton,
-    FlexCarousel,
-    QuickReply,
-    QuickReplyItem
-)
-from database import Database, init_db, get_db, close_db
+from flask import Flask, request, abort, send_file, Response, jsonify, stream_with_context, has_request_context
+from storage import get_storage, PRIORITY_NORMAL, PRIORITY_URGENT
 from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
-from urllib.parse import parse_qsl, quote
+from urllib.parse import parse_qsl, quote, urlencode
+import hmac
+import io
 import json
+import mimetypes
+import logging
 import threading
 import pytz
-from gemini_test import get_gemini_response
-from reminder_handler import reminder_handler
+from gemini_test import get_gemini_response, get_genai
+# 提醒、摘要、匯出、統計等模組 (及其載入的資料庫後端) 在用到的處理函式或 create_app 內才 import，
+# 讓 import 本模組保持輕量 (見 startup_check.py)
+from logger import get_logger, SAMPLED
+from recurrence import upcoming_occurrences, describe_rrule
+from timeutil import from_epoch, format_epoch
+import timeutil
 
 # 載入環境變數
 load_dotenv()
 
 app = Flask(__name__)
+logger = get_logger(__name__)
 
-# 設定Line Bot API
-channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-configuration = Configuration(access_token=channel_access_token)
-handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
+# LINE API 位址 (壓力測試時可指向模擬伺服器)
+LINE_API_HOST = os.getenv('LINE_API_HOST', 'https://api.line.me')
 
-# 初始化 API client
-api_client = ApiClient(configuration)
-messaging_api = MessagingApi(api_client)
+# LINE SDK 載入模型約需一秒，改在第一次使用 (或 create_app 的背景預熱) 時才載入
+_line_lock = threading.Lock()
+_messaging_api = None
+_webhook_handler = None
 
 # 用戶狀態管理
 user_states = {}
-thread_local = threading.local()
 
 # 用戶聊天歷史
 user_chat_history = {}
 
-# 初始化 Gemini 聊天
-chat = get_gemini_response()
+# 筆記搜尋每頁顯示的筆數 (Flex 輪播最多 12 個氣泡)
+NOTE_SEARCH_PAGE_SIZE = 10
+# 筆記搜尋關鍵字的字數上限：「下一頁」的 postback 會帶上 URL 編碼後的關鍵字，
+# LINE 限制 postback 資料 300 字元 (一個字編碼後最多 12 字元)
+NOTE_SEARCH_MAX_KEYWORD = 20
+
+def get_messaging_api():
+    """取得 LINE Messaging API client，第一次呼叫時才載入 SDK"""
+    global _messaging_api
+    if _messaging_api is None:
+        with _line_lock:
+            if _messaging_api is None:
+                from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
+                configuration = Configuration(
+                    host=LINE_API_HOST, access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+                )
+                _messaging_api = MessagingApi(ApiClient(configuration))
+    return _messaging_api
+
+def get_webhook_handler():
+    """取得已註冊事件處理函式的 WebhookHandler，第一次呼叫時才載入 SDK"""
+    global _webhook_handler
+    if _webhook_handler is None:
+        with _line_lock:
+            if _webhook_handler is None:
+                from linebot.v3 import WebhookHandler
+                from linebot.v3.webhooks import (
+                    MessageEvent, TextMessageContent, ImageMessageContent, FileMessageContent, PostbackEvent
+                )
+                handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
+                handler.add(PostbackEvent)(handle_postback)
+                handler.add(MessageEvent, message=TextMessageContent)(handle_message)
+                handler.add(MessageEvent, message=ImageMessageContent)(handle_attachment_message)
+                handler.add(MessageEvent, message=FileMessageContent)(handle_attachment_message)
+                _webhook_handler = handler
+    return _webhook_handler
 
 def get_db():
-    if not hasattr(thread_local, "db"):
-        thread_local.db = Database()
-    return thread_local.db
+    """取得依設定選擇的資料庫後端"""
+    return get_storage()
 
 def set_user_state(user_id, state):
     """設置用戶狀態"""
@@ -96,15 +111,17 @@ def format_datetime(dt_str):
         
         raise ValueError(f"無法解析日期時間: {dt_str}")
     except Exception as e:
-        print(f"格式化日期時間出錯: {str(e)}")  # 添加日誌
+        logger.error("格式化日期時間出錯: %s", e)
         raise
 
 def handle_schedule_input(user_id, text):
     """處理行程輸入"""
-    print(f"處理行程輸入: user_id={user_id}, text={text}")  # 添加日誌
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("處理行程輸入", extra={'user_id': user_id, 'text_len': len(text)})
     try:
         user_state = get_user_state(user_id)
-        print(f"用戶當前狀態: {user_state}")  # 添加日誌
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("用戶當前狀態", extra={'user_id': user_id, 'state': user_state.get("state")})
         db = get_db()
         
         if user_state.get("state") == "waiting_for_schedule":
@@ -126,32 +143,35 @@ def handle_schedule_input(user_id, text):
             
             # 添加行程
             try:
-                db.add_schedule(
+                if not db.add_schedule(
                     user_id,
                     schedule_title,
                     text,  # 描述
                     selected_time,
                     selected_time  # 暫時使用相同的時間作為結束時間
-                )
+                ):
+                    return "添加行程失敗，請重試。"
                 
                 # 重置狀態
                 set_user_state(user_id, {"state": None})
                 return "行程已添加！"
                 
             except Exception as e:
-                print(f"添加行程時發生錯誤: {str(e)}")  # 添加日誌
+                logger.error("添加行程時發生錯誤: %s", e)
                 return f"添加行程失敗：{str(e)}"
     
     except Exception as e:
-        print(f"處理行程輸入時出錯: {str(e)}")  # 添加日誌
+        logger.error("處理行程輸入時出錯: %s", e)
         return "處理行程時發生錯誤，請重試。"
 
 def handle_reminder_input(user_id, text):
     """處理提醒輸入"""
-    print(f"處理提醒輸入: user_id={user_id}, text={text}")  # 添加日誌
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("處理提醒輸入", extra={'user_id': user_id, 'text_len': len(text)})
     try:
         user_state = get_user_state(user_id)
-        print(f"用戶當前狀態: {user_state}")  # 添加日誌
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("用戶當前狀態", extra={'user_id': user_id, 'state': user_state.get("state")})
         db = get_db()
         
         if user_state.get("state") == "waiting_for_reminder":
@@ -161,22 +181,23 @@ def handle_reminder_input(user_id, text):
                     return "發生錯誤，請重新開始添加提醒。"
                 
                 # 添加提醒
-                db.add_reminder(
+                if not db.add_reminder(
                     user_id,
                     text,  # 提醒內容
                     selected_time
-                )
+                ):
+                    return "添加提醒失敗，請重試。"
                 
                 # 重置狀態
                 set_user_state(user_id, {"state": None})
                 return "提醒已添加！"
                 
             except Exception as e:
-                print(f"添加提醒時發生錯誤: {str(e)}")  # 添加日誌
+                logger.error("添加提醒時發生錯誤: %s", e)
                 return f"添加提醒失敗：{str(e)}"
     
     except Exception as e:
-        print(f"處理提醒輸入時出錯: {str(e)}")  # 添加日誌
+        logger.error("處理提醒輸入時出錯: %s", e)
         return "處理提醒時發生錯誤，請重試。"
 
 def generate_ics_content(schedule):
@@ -186,13 +207,12 @@ def generate_ics_content(schedule):
     Returns:
         str: ICS 文件內容
     """
-    start_time = datetime.strptime(schedule['scheduled_time'], '%Y-%m-%d %H:%M:%S')
+    start_time = from_epoch(schedule['scheduled_time'])
     end_time = start_time + timedelta(hours=1)
     
-    # 轉換為 UTC 時間
-    tz = pytz.timezone('Asia/Taipei')
-    start_utc = tz.localize(start_time).astimezone(pytz.UTC)
-    end_utc = tz.localize(end_time).astimezone(pytz.UTC)
+    # 資料庫保存的就是 UTC epoch 秒
+    start_utc = datetime.fromtimestamp(schedule['scheduled_time'], pytz.UTC)
+    end_utc = start_utc + timedelta(hours=1)
     
     now = datetime.now(pytz.UTC)
     
@@ -202,9 +222,33 @@ def generate_ics_content(schedule):
         "PRODID:-//Line Bot//Calendar Event//TW",
         "CALSCALE:GREGORIAN",
         "METHOD:PUBLISH",
-        "BEGIN:VEVENT",
-        f"DTSTART:{start_utc.strftime('%Y%m%dT%H%M%SZ')}",
-        f"DTEND:{end_utc.strftime('%Y%m%dT%H%M%SZ')}",
+    ]
+    
+    if schedule.get('rrule'):
+        # 重複行程使用當地時間，避免換算成 UTC 後星期幾跟著改變
+        ics_content += [
+            "BEGIN:VTIMEZONE",
+            "TZID:Asia/Taipei",
+            "BEGIN:STANDARD",
+            "DTSTART:19700101T000000",
+            "TZOFFSETFROM:+0800",
+            "TZOFFSETTO:+0800",
+            "TZNAME:CST",
+            "END:STANDARD",
+            "END:VTIMEZONE",
+            "BEGIN:VEVENT",
+            f"DTSTART;TZID=Asia/Taipei:{start_time.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND;TZID=Asia/Taipei:{end_time.strftime('%Y%m%dT%H%M%S')}",
+            f"RRULE:{schedule['rrule']}",
+        ]
+    else:
+        ics_content += [
+            "BEGIN:VEVENT",
+            f"DTSTART:{start_utc.strftime('%Y%m%dT%H%M%SZ')}",
+            f"DTEND:{end_utc.strftime('%Y%m%dT%H%M%SZ')}",
+        ]
+    
+    ics_content += [
         f"DTSTAMP:{now.strftime('%Y%m%dT%H%M%SZ')}",
         f"UID:{schedule['id']}@linebotcalendar",
         f"SUMMARY:{schedule['title']}",
@@ -234,7 +278,7 @@ def save_ics_file(schedule):
         
         return file_path
     except Exception as e:
-        print(f"保存 ICS 文件時出錯: {e}")
+        logger.error("保存 ICS 文件時出錯: %s", e)
         return None
 
 @app.route('/calendar_events/<event_id>.ics')
@@ -252,7 +296,7 @@ def serve_calendar_event(event_id):
         else:
             return "Calendar event not found", 404
     except Exception as e:
-        print(f"提供 ICS 文件時出錯: {e}")
+        logger.error("提供 ICS 文件時出錯: %s", e)
         return "Error serving calendar event", 500
 
 def send_calendar_link(event_id):
@@ -293,7 +337,7 @@ def send_calendar_link(event_id):
         return temp_file_path
         
     except Exception as e:
-        print(f"生成日曆文件時出錯: {str(e)}")
+        logger.error("生成日曆文件時出錯: %s", e)
         return None
 
 @app.route('/calendar_events/<event_id>.ics')
@@ -307,6 +351,114 @@ def serve_calendar_file(event_id):
     else:
         return "找不到指定的行程"
 
+@app.route('/export/<kind>.<fmt>')
+def export_data(kind, fmt):
+    """串流輸出用戶的資料 (權杖由「匯出資料」指令取得)，資料逐批讀出，不會整份載入記憶體"""
+    from export import export_stream, verify_export_token, FORMATS
+    user_id = verify_export_token(request.args.get('token', ''))
+    if user_id is None:
+        abort(403)
+    try:
+        chunks = export_stream(get_storage(), user_id, kind, fmt)
+    except ValueError:
+        abort(404)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{kind}.{fmt}"'}
+    )
+
+@app.route('/import/<kind>.<fmt>', methods=['POST'])
+def import_data(kind, fmt):
+    """從請求內容匯入資料 (權杖由「匯入資料」指令取得，匯出連結的權杖不能用來匯入)
+    先把內容完整收到暫存檔並檢查過，才在一個短交易內寫入，上傳緩慢時不會佔住資料庫的寫入鎖
+    """
+    from export import import_stream, spool_upload, verify_export_token, ImportTooLarge, IMPORT
+    user_id = verify_export_token(request.args.get('token', ''), IMPORT)
+    if user_id is None:
+        abort(403)
+    try:
+        with spool_upload(request.stream) as upload:
+            stream = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+            counts = import_stream(get_storage(), user_id, stream, fmt, kind)
+    except ImportTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(counts)
+
+@app.route('/admin/stats')
+def admin_stats():
+    """用量統計 (只讀取每小時彙總表，不查詢熱資料表)；需要 Authorization: Bearer <ADMIN_TOKEN>，未設定時不開放
+
+    參數：start、end 為台北時間的日期 (YYYY-MM-DD，含 end 當天，預設最近 7 天)，granularity 為 hour 或 day
+    """
+    from stats import summarize, GRANULARITIES, STATS_MAX_DAYS
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {admin_token}"):
+        abort(403)
+    granularity = request.args.get('granularity', 'hour')
+    today = timeutil.now().date()
+    try:
+        end_day = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if 'end' in request.args else today
+        start_day = (datetime.strptime(request.args['start'], '%Y-%m-%d').date() if 'start' in request.args
+                     else end_day - timedelta(days=6))
+    except ValueError:
+        return jsonify({'error': "日期格式應為 YYYY-MM-DD"}), 400
+    if granularity not in GRANULARITIES:
+        return jsonify({'error': f"granularity 應為 {' 或 '.join(GRANULARITIES)}"}), 400
+    if not 0 <= (end_day - start_day).days < STATS_MAX_DAYS:
+        return jsonify({'error': f"查詢範圍應為 1 到 {STATS_MAX_DAYS} 天"}), 400
+
+    start, end = timeutil.day_range(start_day)[0], timeutil.day_range(end_day)[1]
+    summary = summarize(get_storage().get_stats(start, end), granularity)
+    return jsonify({
+        'start': start_day.isoformat(), 'end': end_day.isoformat(), 'granularity': granularity, **summary,
+    })
+
+@app.route('/attachments/<digest>/thumbnail.jpg')
+def serve_attachment_thumbnail(digest):
+    """筆記附件的縮圖 (第一次要求時才產生並快取)；內容不會改變，可以讓 LINE 與瀏覽器長期快取"""
+    from attachments import attachment_store, is_digest
+    path = attachment_store.thumbnail(digest) if is_digest(digest) else None
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype='image/jpeg', max_age=365 * 24 * 3600)
+
+@app.route('/attachments/<digest>/<path:name>')
+def serve_attachment(digest, name):
+    """筆記附件的原檔 (類型依檔名判斷)"""
+    from attachments import attachment_store
+    if not attachment_store.exists(digest):
+        abort(404)
+    return send_file(attachment_store.object_path(digest), download_name=name, max_age=365 * 24 * 3600)
+
+def attachment_urls(note):
+    """筆記附件的 (縮圖, 原檔) 網址；不在 webhook 請求中 (沒有網址可用) 或沒有附件時回傳 None"""
+    if not note.get('attachment') or not has_request_context():
+        return None
+    base = f"{request.url_root.rstrip('/')}/attachments/{note['attachment']}"
+    return f"{base}/thumbnail.jpg", f"{base}/{quote(note['attachment_name'] or 'attachment')}"
+
+def export_links(user_id):
+    """用戶的匯出連結 (有效期限 EXPORT_LINK_TTL 秒)"""
+    from export import export_token
+    base = request.url_root.rstrip('/')
+    query = urlencode({'token': export_token(user_id)})
+    return {
+        '全部資料 (NDJSON)': f"{base}/export/all.ndjson?{query}",
+        '行事曆 (ICS)': f"{base}/export/all.ics?{query}",
+        '筆記 (CSV)': f"{base}/export/notes.csv?{query}",
+    }
+
+def import_link(user_id):
+    """用戶的匯入網址 (有效期限 IMPORT_LINK_TTL 秒)，{kind}.{fmt} 由用戶替換"""
+    from export import export_token, IMPORT
+    query = urlencode({'token': export_token(user_id, IMPORT)})
+    return f"{request.url_root.rstrip('/')}/import/{{kind}}.{{fmt}}?{query}"
+
 @app.route("/")
 def home():
     return 'Line Bot is running!'
@@ -315,8 +467,9 @@ def home():
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
+    from linebot.v3.exceptions import InvalidSignatureError
     try:
-        handler.handle(body, signature)
+        get_webhook_handler().handle(body, signature)
     except InvalidSignatureError:
         abort(400)
     return 'OK'
@@ -328,6 +481,7 @@ def create_note_bubble(note):
     Returns:
         FlexBubble: 筆記氣泡
     """
+    from linebot.v3.messaging import FlexBox, FlexBubble, FlexButton, FlexImage, FlexText, PostbackAction, URIAction
     # 從字典中獲取數據
     note_id = note['id']
     content = note['content']
@@ -337,14 +491,23 @@ def create_note_bubble(note):
     note_id_str = str(note_id)
     
     # 格式化創建時間
-    try:
-        dt = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
-        created_at_str = dt.strftime("%Y-%m-%d %H:%M")
-    except:
-        created_at_str = created_at
+    created_at_str = format_epoch(created_at)
+    
+    # 圖片筆記以縮圖為封面 (點擊開啟原圖)，檔案筆記加上下載按鈕
+    hero = None
+    buttons = []
+    urls = attachment_urls(note)
+    if urls:
+        thumbnail_url, original_url = urls
+        if (note.get('attachment_type') or '').startswith('image/'):
+            hero = FlexImage(url=thumbnail_url, size="full", aspect_ratio="20:13", aspect_mode="cover",
+                             action=URIAction(uri=original_url))
+        else:
+            buttons.append(FlexButton(style="link", height="sm", action=URIAction(label="下載", uri=original_url)))
     
     return FlexBubble(
         size="kilo",
+        hero=hero,
         body=FlexBox(
             layout="vertical",
             contents=[
@@ -355,6 +518,7 @@ def create_note_bubble(note):
                     layout="horizontal",
                     margin="md",
                     contents=[
+                        *buttons,
                         FlexButton(
                             style="link",
                             height="sm",
@@ -369,22 +533,53 @@ def create_note_bubble(note):
         )
     )
 
+def format_remind_before(remind_before):
+    """格式化提前提醒時間，例如「提前 1 小時提醒」；多個提前時間時為「提前 1 天、10 分鐘提醒」"""
+    if isinstance(remind_before, int):
+        remind_before = [remind_before]
+    texts = []
+    for minutes in remind_before:
+        if minutes >= 1440:  # 1天 = 1440分鐘
+            texts.append(f"{minutes // 1440} 天")
+        elif minutes >= 60:  # 1小時 = 60分鐘
+            texts.append(f"{minutes // 60} 小時")
+        else:
+            texts.append(f"{minutes} 分鐘")
+    return f"提前 {'、'.join(texts)}提醒"
+
+def create_recurrence_texts(rrule, next_time):
+    """重複項目的說明文字：重複規則與接下來幾次的時間 (即時計算，不另外存資料)"""
+    from linebot.v3.messaging import FlexText
+    if not rrule or not next_time:
+        return []
+    try:
+        occurrences = upcoming_occurrences(rrule, from_epoch(next_time), limit=3)
+    except ValueError as e:
+        logger.warning("無法展開重複規則: %s", e)
+        return []
+    upcoming = "、".join(occurrence.strftime('%m/%d %H:%M') for occurrence in occurrences)
+    return [
+        FlexText(text=f"重複：{describe_rrule(rrule)}", size="sm"),
+        FlexText(text=f"接下來：{upcoming}", size="xs", color="#aaaaaa", wrap=True),
+    ]
+
 def create_schedule_bubble(schedule):
     """創建行程氣泡"""
-    scheduled_time = schedule['scheduled_time'] if schedule['scheduled_time'] else "未設定"
+    from linebot.v3.messaging import FlexBox, FlexBubble, FlexButton, FlexText, PostbackAction
+    scheduled_time = format_epoch(schedule['scheduled_time'])
     title = schedule['title'] if schedule['title'] else "未設定標題"
     description = schedule['description'] if schedule['description'] else "無詳細內容"
     remind_before = schedule['remind_before'] if schedule['remind_before'] else 5
     
     # 格式化提醒時間顯示
-    remind_text = "提前 "
-    if remind_before >= 1440:  # 1天 = 1440分鐘
-        remind_text += f"{remind_before // 1440} 天"
-    elif remind_before >= 60:  # 1小時 = 60分鐘
-        remind_text += f"{remind_before // 60} 小時"
-    else:
-        remind_text += f"{remind_before} 分鐘"
-    remind_text += "提醒"
+    remind_text = format_remind_before(remind_before)
+    
+    body_contents = [
+        FlexText(text=description, wrap=True),
+        FlexText(text=f"時間：{scheduled_time}", size="sm"),
+        FlexText(text=f"提醒：{remind_text}", size="sm"),
+    ]
+    body_contents += create_recurrence_texts(schedule.get('rrule'), schedule['scheduled_time'])
     
     return FlexBubble(
         size="kilo",
@@ -397,11 +592,7 @@ def create_schedule_bubble(schedule):
         ),
         body=FlexBox(
             layout="vertical",
-            contents=[
-                FlexText(text=description, wrap=True),
-                FlexText(text=f"時間：{scheduled_time}", size="sm"),
-                FlexText(text=f"提醒：{remind_text}", size="sm"),
-            ]
+            contents=body_contents
         ),
         footer=FlexBox(
             layout="horizontal",
@@ -423,9 +614,10 @@ def create_schedule_bubble(schedule):
 
 def create_reminder_bubble(reminder):
     """創建提醒氣泡"""
+    from linebot.v3.messaging import FlexBox, FlexBubble, FlexButton, FlexText, PostbackAction
     # 確保所有文字欄位都有值
     content = reminder['content'] if reminder['content'] else "無內容"
-    reminder_time = reminder['reminder_time'] if reminder['reminder_time'] else "未設定"
+    reminder_time = format_epoch(reminder['remind_time'])
 
     return FlexBubble(
         size="kilo",
@@ -440,6 +632,7 @@ def create_reminder_bubble(reminder):
             contents=[
                 FlexText(text=content, wrap=True),
                 FlexText(text=f"提醒時間: {reminder_time}", size="sm"),
+                *create_recurrence_texts(reminder.get('rrule'), reminder['remind_time']),
             ]
         ),
         footer=FlexBox(
@@ -455,6 +648,66 @@ def create_reminder_bubble(reminder):
         )
     )
 
+def reply_note_search(reply_token, user_id, keyword, page=1):
+    """回覆筆記搜尋結果
+    Args:
+        reply_token (str): 回覆用的 token
+        user_id (str): 用戶ID
+        keyword (str): 搜尋關鍵字
+        page (int): 頁碼，從 1 開始
+    """
+    from linebot.v3.messaging import (
+        FlexCarousel, FlexMessage, PostbackAction, QuickReply,
+        QuickReplyItem, ReplyMessageRequest, TextMessage
+    )
+    messaging_api = get_messaging_api()
+    if not keyword:
+        messages = [TextMessage(text="請輸入要搜尋的關鍵字，例如：搜尋 會議")]
+    elif len(keyword) > NOTE_SEARCH_MAX_KEYWORD:
+        messages = [TextMessage(text=f"搜尋關鍵字請在 {NOTE_SEARCH_MAX_KEYWORD} 個字以內")]
+    else:
+        db = get_db()
+        # 多取一筆用來判斷是否還有下一頁
+        notes = db.search_notes(
+            user_id,
+            keyword,
+            limit=NOTE_SEARCH_PAGE_SIZE + 1,
+            offset=(page - 1) * NOTE_SEARCH_PAGE_SIZE
+        )
+        has_more = len(notes) > NOTE_SEARCH_PAGE_SIZE
+        notes = notes[:NOTE_SEARCH_PAGE_SIZE]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("筆記搜尋", extra={'user_id': user_id, 'page': page, 'count': len(notes)})
+
+        if not notes:
+            text = f"找不到包含「{keyword}」的筆記" if page == 1 else "沒有更多搜尋結果了"
+            messages = [TextMessage(text=text)]
+        else:
+            quick_reply = None
+            if has_more:
+                quick_reply = QuickReply(items=[
+                    QuickReplyItem(
+                        action=PostbackAction(
+                            label="下一頁",
+                            data=urlencode({'action': 'search_notes', 'q': keyword, 'page': page + 1})
+                        )
+                    )
+                ])
+            messages = [
+                FlexMessage(
+                    alt_text=f"「{keyword}」的搜尋結果",
+                    contents=FlexCarousel(contents=[create_note_bubble(note) for note in notes]),
+                    quick_reply=quick_reply
+                )
+            ]
+
+    messaging_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=messages
+        )
+    )
+
 def parse_postback_data(data):
     """解析 postback 數據
     Args:
@@ -467,20 +720,47 @@ def parse_postback_data(data):
             return {}
         return dict(parse_qsl(data))
     except Exception as e:
-        print(f"解析 postback 數據出錯: {e}")
+        logger.error("解析 postback 數據出錯: %s", e)
         return {}
 
-@handler.add(PostbackEvent)
+def handle_reminder_action(user_id, data):
+    """處理提醒訊息的「稍後提醒」與「完成」按鈕，回傳回覆文字"""
+    from outbox import find_reminder_outbox, outbox_sender
+    db = get_db()
+    try:
+        minutes = max(1, min(int(data.get('min') or 10), 24 * 60))
+    except ValueError:
+        return "無效的提醒"
+    outbox_ids = find_reminder_outbox(db, user_id, data)
+    if data['action'] == 'done':
+        if not db.acknowledge_outbox(user_id, outbox_ids):
+            return "找不到這則提醒，可能已經過期了。"
+        return "已完成 ✅"
+
+    send_at = (timeutil.now() + timedelta(minutes=minutes)).replace(microsecond=0)
+    if not db.snooze_outbox(user_id, outbox_ids, send_at):
+        return "找不到這則提醒，可能已經過期了。"
+    outbox_sender.schedule(send_at)
+    logger.info("稍後提醒", extra={'user_id': user_id, 'outbox_ids': outbox_ids, 'minutes': minutes})
+    return f"好的，{send_at.strftime('%H:%M')} 再提醒您 ⏰"
+
 def handle_postback(event):
     """處理 Postback 事件"""
+    from linebot.v3.messaging import (
+        ButtonsTemplate, DatetimePickerAction, FlexCarousel, FlexMessage,
+        ReplyMessageRequest, TemplateMessage, TextMessage
+    )
+    from stats import stats_recorder, POSTBACKS
+    messaging_api = get_messaging_api()
     user_id = event.source.user_id
     data = parse_postback_data(event.postback.data)
-    params = event.postback.params
     
-    print(f"處理 Postback: action={data.get('action')}, data={data}, params={params}")
+    logger.info("處理 Postback", extra={'user_id': user_id, 'action': data.get('action')})
+    stats_recorder.record(POSTBACKS)
+    stats_recorder.record_active(user_id)
     
     if data.get('action') == 'note':
-        db = Database()
+        db = get_db()
         db.set_user_state(user_id, {'state': 'waiting_for_note'})
         messaging_api.reply_message(
             ReplyMessageRequest(
@@ -516,11 +796,11 @@ def handle_postback(event):
     elif data.get('action') == "add_schedule":
         if hasattr(event.postback, 'params') and event.postback.params:
             selected_time = event.postback.params.get('datetime')
-            print(f"用戶選擇的時間: {selected_time}")
+            logger.debug("用戶選擇的時間: %s", selected_time)
             
             if selected_time:
                 # 將選擇的時間保存到用戶狀態
-                db = Database()
+                db = get_db()
                 db.set_user_state(user_id, {
                     'state': 'waiting_for_schedule',
                     'data': {'selected_time': selected_time}
@@ -570,10 +850,10 @@ def handle_postback(event):
             # 檢查是否有時間參數
             if hasattr(event.postback, 'params') and event.postback.params:
                 selected_time = event.postback.params.get('datetime')
-                print(f"用戶選擇的提醒時間: {selected_time}")
+                logger.debug("用戶選擇的提醒時間: %s", selected_time)
                 
                 if selected_time:
-                    db = Database()
+                    db = get_db()
                     # 設置用戶狀態為等待輸入提醒內容，並保存選擇的時間
                     db.set_user_state(user_id, {
                         'state': 'waiting_for_reminder',
@@ -594,7 +874,7 @@ def handle_postback(event):
                         )
                     )
         except Exception as e:
-            print(f"設置提醒時間時出錯: {e}")
+            logger.error("設置提醒時間時出錯: %s", e)
             messaging_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -648,9 +928,9 @@ def handle_postback(event):
             if not note_id:
                 raise ValueError("筆記 ID 不能為空")
             
-            print(f"正在刪除筆記，ID: {note_id}")  # 添加日誌
-            db = Database()
-            if db.delete_note(note_id):
+            logger.info("正在刪除筆記", extra={'user_id': user_id, 'note_id': note_id})
+            db = get_db()
+            if db.delete_note(user_id, note_id):
                 message = TextMessage(text="筆記已成功刪除")
                 
                 # 重新獲取筆記列表
@@ -666,7 +946,7 @@ def handle_postback(event):
             else:
                 message = TextMessage(text="找不到要刪除的筆記")
         except Exception as e:
-            print(f"刪除筆記時出錯: {e}")
+            logger.error("刪除筆記時出錯: %s", e)
             message = TextMessage(text="刪除筆記失敗，請稍後再試")
         
         messaging_api.reply_message(
@@ -687,15 +967,15 @@ def handle_postback(event):
             )
             return
 
-        db = Database()
-        if db.delete_schedule(schedule_id):
+        db = get_db()
+        if db.delete_schedule(user_id, schedule_id):
             # 同時刪除相關的 ICS 文件
             try:
                 ics_file = os.path.join(os.path.dirname(__file__), 'temp', f"{schedule_id}.ics")
                 if os.path.exists(ics_file):
                     os.remove(ics_file)
             except Exception as e:
-                print(f"刪除 ICS 文件時出錯: {e}")
+                logger.error("刪除 ICS 文件時出錯: %s", e)
 
             messaging_api.reply_message(
                 ReplyMessageRequest(
@@ -722,8 +1002,8 @@ def handle_postback(event):
             )
             return
 
-        db = Database()
-        if db.delete_reminder(reminder_id):
+        db = get_db()
+        if db.delete_reminder(user_id, reminder_id):
             messaging_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -738,6 +1018,16 @@ def handle_postback(event):
                 )
             )
         
+    elif data.get('action') in ("snooze", "done"):
+        # 提醒訊息下方的按鈕：直接更新原本那一筆 outbox，不需重新走一次新增提醒的流程
+        reply_text = handle_reminder_action(user_id, data)
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
+        )
+        
     elif data.get('action') == "add_to_calendar":
         schedule_id = data.get('id')
         if not schedule_id:
@@ -749,8 +1039,8 @@ def handle_postback(event):
             )
             return
 
-        db = Database()
-        schedule = db.get_schedule_by_id(schedule_id)
+        db = get_db()
+        schedule = db.get_schedule_by_id(user_id, schedule_id)
         if not schedule:
             messaging_api.reply_message(
                 ReplyMessageRequest(
@@ -769,8 +1059,9 @@ def handle_postback(event):
             # 生成 Google Calendar 連結
             title = quote(schedule['title'])
             description = quote(schedule.get('description', ''))
-            start_time = schedule['scheduled_time'].replace(' ', 'T')
-            end_time = (datetime.strptime(schedule['scheduled_time'], '%Y-%m-%d %H:%M:%S') + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S')
+            start = from_epoch(schedule['scheduled_time'])
+            start_time = start.strftime('%Y-%m-%dT%H:%M:%S')
+            end_time = (start + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S')
             
             calendar_url = (
                 f"https://calendar.google.com/calendar/render?"
@@ -778,6 +1069,8 @@ def handle_postback(event):
                 f"&dates={start_time}/{end_time}"
                 f"&ctz=Asia/Taipei"
             )
+            if schedule.get('rrule'):
+                calendar_url += f"&recur={quote('RRULE:' + schedule['rrule'])}"
             
             # 生成 ICS 文件下載連結
             ics_url = f"{request.url_root.rstrip('/')}/calendar_events/{schedule_id}.ics"
@@ -795,7 +1088,7 @@ def handle_postback(event):
                 )
             )
         except Exception as e:
-            print(f"生成日曆連結時出錯: {e}")
+            logger.error("生成日曆連結時出錯: %s", e)
             messaging_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -805,7 +1098,7 @@ def handle_postback(event):
     
     elif data.get('action') == "set_remind_time":
         # 初始化數據庫連接
-        db = Database()
+        db = get_db()
         
         # 從用戶狀態中獲取行程信息
         user_state = db.get_user_state(user_id)
@@ -821,29 +1114,22 @@ def handle_postback(event):
         if not all([title, selected_time]):
             return
         
-        # 添加行程到數據庫
-        print(f"添加行程: 標題={title}, 內容={description}, 時間={selected_time}, 提前{remind_minutes}分鐘提醒")
-        db.add_schedule(user_id, title, description, selected_time, remind_minutes)
-        
-        # 清除用戶狀態
-        db.clear_user_state(user_id)
-        
-        # 發送確認消息
-        remind_text = "提前 "
-        if remind_minutes >= 1440:  # 1天 = 1440分鐘
-            remind_text += f"{remind_minutes // 1440} 天"
-        elif remind_minutes >= 60:  # 1小時 = 60分鐘
-            remind_text += f"{remind_minutes // 60} 小時"
-        else:
-            remind_text += f"{remind_minutes} 分鐘"
-        remind_text += "提醒"
+        # 添加行程並清除用戶狀態 (同一個交易)
+        logger.info("添加行程", extra={'user_id': user_id, 'scheduled_time': selected_time, 'remind_before': remind_minutes})
+        try:
+            with db.unit_of_work(user_id):
+                db.add_schedule(user_id, title, description, selected_time, remind_minutes)
+                db.clear_user_state(user_id)
+            # 發送確認消息
+            reply_text = f"已為您添加行程：\n標題：{title}\n時間：{selected_time}\n{format_remind_before(remind_minutes)}"
+        except Exception as e:
+            logger.error("添加行程時出錯: %s", e, extra={'user_id': user_id})
+            reply_text = "添加行程失敗，請重試。"
         
         messaging_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[
-                    TextMessage(text=f"已為您添加行程：\n標題：{title}\n時間：{selected_time}\n{remind_text}")
-                ]
+                messages=[TextMessage(text=reply_text)]
             )
         )
     
@@ -945,12 +1231,10 @@ def handle_postback(event):
         
     elif data.get('action') == 'view_notes':
         try:
-            print("正在獲取筆記列表...")  # 添加日誌
-            db = Database()
+            db = get_db()
             notes = db.get_notes(user_id)
             
             if not notes:
-                print("沒有找到任何筆記")  # 添加日誌
                 messaging_api.reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
@@ -959,15 +1243,18 @@ def handle_postback(event):
                 )
                 return
 
-            print(f"找到 {len(notes)} 條筆記")  # 添加日誌
+            log_each = logger.isEnabledFor(logging.DEBUG)
+            if log_each:
+                logger.debug("找到筆記", extra={'user_id': user_id, 'count': len(notes)})
             bubbles = []
             for i, note in enumerate(notes):
                 try:
-                    print(f"處理第 {i+1} 條筆記: {note}")  # 添加詳細的筆記信息
+                    if log_each:
+                        logger.debug("處理筆記", extra={'index': i, 'note_id': note['id'], **SAMPLED})
                     bubble = create_note_bubble(note)
                     bubbles.append(bubble)
                 except Exception as e:
-                    print(f"創建筆記氣泡時出錯: {e}, note={note}")  # 添加日誌
+                    logger.warning("創建筆記氣泡時出錯: %s", e, extra={'note_id': note.get('id')})
                     continue
 
             if not bubbles:
@@ -979,7 +1266,6 @@ def handle_postback(event):
                 )
                 return
 
-            print(f"成功創建 {len(bubbles)} 個筆記氣泡")  # 添加日誌
             messaging_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -992,7 +1278,7 @@ def handle_postback(event):
                 )
             )
         except Exception as e:
-            print(f"處理筆記列表時出錯: {e}")  # 添加日誌
+            logger.error("處理筆記列表時出錯: %s", e)
             messaging_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -1000,6 +1286,13 @@ def handle_postback(event):
                 )
             )
     
+    elif data.get('action') == 'search_notes':
+        try:
+            page = max(int(data.get('page', '1')), 1)
+        except ValueError:
+            page = 1
+        reply_note_search(event.reply_token, user_id, data.get('q', '').strip(), page)
+    
     elif data.get('action') == 'view_schedules':
         db = get_db()
         schedules = db.get_schedules(user_id)
@@ -1071,6 +1364,7 @@ def handle_postback(event):
 
 def create_remind_time_options():
     """創建提醒時間選項"""
+    from linebot.v3.messaging import PostbackAction, QuickReply, QuickReplyItem
     options = [
         QuickReplyItem(
             action=PostbackAction(
@@ -1117,11 +1411,6 @@ def create_remind_time_options():
     ]
     return QuickReply(items=options)
 
-def check_schedule_keywords(text):
-    """檢查文字是否包含行程相關關鍵字"""
-    keywords = ['行程', '日程', '安排', '計畫', '活動', '提醒', '待辦', '今天', '明天', '下週', '下个月']
-    return any(keyword in text for keyword in keywords)
-
 def format_schedule_info(schedules):
     """格式化行程信息"""
     if not schedules:
@@ -1132,31 +1421,223 @@ def format_schedule_info(schedules):
         result += f"\n🔸 {schedule['title']}\n"
         result += f"📝 內容：{schedule['description']}\n"
         result += f"⏰ 時間：{schedule['time']}\n"
+        if schedule.get('repeat'):
+            result += f"🔁 {schedule['repeat']}\n"
         if schedule['remind_before']:
             result += f"⚡ 提前 {schedule['remind_before']} 分鐘提醒\n"
         result += "─────────────\n"
     return result
 
-@handler.add(MessageEvent, message=TextMessageContent)
+def format_reminder_info(reminders):
+    """格式化提醒信息"""
+    if not reminders:
+        return "目前沒有待辦的提醒事項喔！ 😊"
+    
+    result = "⏰ 以下是您的提醒事項：\n"
+    for reminder in reminders:
+        result += f"\n🔸 {reminder['content']}\n"
+        result += f"⏰ 時間：{format_epoch(reminder['remind_time'])}\n"
+        if reminder.get('rrule'):
+            result += f"🔁 {describe_rrule(reminder['rrule'])}\n"
+        result += "─────────────\n"
+    return result
+
+def build_note_context(db, user_id, text, k=3):
+    """檢索與問題最相關的筆記，組成提示詞中的參考資料"""
+    try:
+        notes = db.get_relevant_notes(user_id, text, k)
+    except Exception as e:
+        logger.error("檢索相關筆記時出錯: %s", e)
+        return ""
+    if not notes:
+        return ""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("檢索到相關筆記", extra={'user_id': user_id, 'note_ids': [note_id for note_id, _, _ in notes]})
+    lines = "\n".join(f"- {content}" for _, content, _ in notes)
+    return f"以下是用戶先前記錄、可能與問題相關的筆記，僅在有幫助時參考：\n{lines}"
+
+def reply_parsed_command(reply_token, user_id, command):
+    """依時間解析結果直接新增提醒或行程，解析不出時間時改用時間選擇器
+    Args:
+        reply_token (str): 回覆用的 token
+        user_id (str): 用戶ID
+        command (dict): time_parser.parse_command 的結果
+    """
+    from linebot.v3.messaging import (
+        ButtonsTemplate, DatetimePickerAction, ReplyMessageRequest, TemplateMessage,
+        TextMessage
+    )
+    from time_parser import REMINDER
+    messaging_api = get_messaging_api()
+    if command['time'] is None:
+        message = TemplateMessage(
+            alt_text="選擇提醒時間",
+            template=ButtonsTemplate(
+                title="選擇時間",
+                text="無法判斷提醒時間，請選擇時間",
+                actions=[
+                    DatetimePickerAction(
+                        label="選擇時間",
+                        data="action=add_reminder",
+                        mode="datetime"
+                    )
+                ]
+            )
+        )
+    else:
+        db = get_db()
+        scheduled_time = command['time']
+        display_time = scheduled_time.strftime('%Y-%m-%d %H:%M')
+        priority = PRIORITY_URGENT if command['urgent'] else PRIORITY_NORMAL
+        if command['kind'] == REMINDER:
+            content = command['title'] or "提醒"
+            saved = db.add_reminder(user_id, content, scheduled_time, command['rrule'], priority)
+            text = f"已為您添加提醒：\n內容：{content}\n時間：{display_time}"
+        else:
+            remind_minutes = command['remind_before'] or [5]
+            saved = db.add_schedule(user_id, command['title'], '', scheduled_time, remind_minutes, command['rrule'], priority)
+            text = f"已為您添加行程：\n標題：{command['title']}\n時間：{display_time}\n{format_remind_before(remind_minutes)}"
+        if command['rrule']:
+            text += f"\n重複：{describe_rrule(command['rrule'])}"
+        if command['urgent']:
+            text += "\n優先：緊急 (勿擾時段也會準時提醒)"
+        if not saved:
+            text = "添加提醒失敗，請重試。" if command['kind'] == REMINDER else "添加行程失敗，請重試。"
+        logger.info("以文字直接新增", extra={'user_id': user_id, 'kind': command['kind'], 'time': display_time})
+        message = TextMessage(text=text)
+
+    messaging_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=[message]
+        )
+    )
+
+def format_minute_of_day(minute):
+    """當天第幾分鐘轉為 HH:MM"""
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def handle_quiet_hours(user_id, text):
+    """設定、清除或查詢勿擾時段，回傳回覆文字"""
+    from time_parser import parse_quiet_hours
+    db = get_db()
+    if text.startswith('取消'):
+        db.set_delivery_window(user_id, None, None)
+        return "已取消勿擾時段，提醒會準時發送。"
+    window = parse_quiet_hours(text)
+    if window:
+        db.set_delivery_window(user_id, *window)
+        start, end = (format_minute_of_day(minute) for minute in window)
+        return (f"已設定勿擾時段 {start}-{end}，這段時間的提醒會在 {end} 之後發送。\n"
+                "標示「緊急」的提醒仍會準時通知，輸入「取消勿擾」即可取消。")
+    current = db.get_delivery_window(user_id)
+    usage = "設定方式：勿擾時段 22:00-08:00"
+    if current:
+        start, end = format_minute_of_day(current['quiet_start']), format_minute_of_day(current['quiet_end'])
+        return f"目前的勿擾時段：{start}-{end}\n{usage}"
+    return f"目前沒有設定勿擾時段。\n{usage}"
+
+def handle_attachment_message(event):
+    """處理圖片與檔案消息：等待輸入筆記時下載內容並保存為附件筆記"""
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+    from attachments import attachment_store, content_downloader, AttachmentTooLarge, MAX_ATTACHMENT_BYTES
+    from stats import stats_recorder, ATTACHMENTS
+    messaging_api = get_messaging_api()
+    user_id = event.source.user_id
+    message = event.message
+    stats_recorder.record(ATTACHMENTS)
+    stats_recorder.record_active(user_id)
+    db = get_db()
+    state = db.get_user_state(user_id)
+
+    if not state or state['state'] != 'waiting_for_note':
+        reply_text = "如要把圖片或檔案存成筆記，請先點選「新增筆記」再傳送。"
+    else:
+        file_name = getattr(message, 'file_name', None)
+        try:
+            if getattr(message, 'file_size', None) and message.file_size > MAX_ATTACHMENT_BYTES:
+                raise AttachmentTooLarge(f"附件超過 {MAX_ATTACHMENT_BYTES // (1024 * 1024)} MB")
+            digest, content_type, size = content_downloader.download(message.id, attachment_store)
+            if file_name is None:
+                file_name = f"{message.id}{mimetypes.guess_extension(content_type) or '.jpg'}"
+            content = f"📎 {file_name}" if message.type == 'file' else "📷 圖片筆記"
+            try:
+                with db.unit_of_work(user_id):
+                    db.add_note(user_id, content, digest, content_type, file_name)
+                    db.clear_user_state(user_id)
+                reply_text = "檔案筆記已保存！" if message.type == 'file' else "圖片筆記已保存！"
+            except Exception as e:
+                logger.error("保存附件筆記時出錯: %s", e, extra={'user_id': user_id, 'message_id': message.id})
+                reply_text = "保存筆記失敗，請重試。"
+        except AttachmentTooLarge as e:
+            reply_text = f"{e}，無法保存。"
+        except Exception as e:
+            logger.error("保存附件筆記時出錯: %s", e, extra={'user_id': user_id, 'message_id': message.id})
+            reply_text = "下載圖片或檔案時發生錯誤，請重新傳送。"
+
+    messaging_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_text)]
+        )
+    )
+
 def handle_message(event):
     """處理文字消息"""
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+    from digest import DIGEST_TIME, SUBSCRIBE_COMMANDS, UNSUBSCRIBE_COMMANDS
+    from export import EXPORT_COMMANDS, IMPORT_COMMANDS, EXPORT_LINK_TTL, IMPORT_LINK_TTL
+    from intent import detect_intents, SCHEDULE_QUERY, REMINDER_QUERY, NOTES_QUERY
+    from rich_menu import menu_switcher, MENU_COMMANDS, MAIN_MENU
+    from stats import stats_recorder, MESSAGES, AI_CALLS, AI_ERRORS
+    from time_parser import parse_command
+    messaging_api = get_messaging_api()
     user_id = event.source.user_id
     text = event.message.text
-    print(f"處理文字消息: user_id={user_id}, text={text}")
+    logger.info("處理文字消息", extra={'user_id': user_id, 'text_len': len(text)})
+    stats_recorder.record(MESSAGES)
+    stats_recorder.record_active(user_id)
 
     # 獲取用戶當前狀態
-    db = Database()
+    db = get_db()
     state = db.get_user_state(user_id)
-    print(f"用戶當前狀態: {state}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("用戶當前狀態", extra={'user_id': user_id, 'state': state['state'] if state else None})
 
     if state and state['state'] == 'waiting_for_note':
-        # 添加筆記
-        db.add_note(user_id, text)
-        db.clear_user_state(user_id)
+        # 添加筆記並清除用戶狀態 (同一個交易)
+        try:
+            with db.unit_of_work(user_id):
+                db.add_note(user_id, text)
+                db.clear_user_state(user_id)
+            reply_text = "筆記已保存！"
+        except Exception as e:
+            logger.error("添加筆記時出錯: %s", e, extra={'user_id': user_id})
+            reply_text = "保存筆記失敗，請重試。"
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
+        )
+    elif state and state['state'] == 'waiting_for_reminder':
+        # 時間選擇器選好時間後，輸入提醒內容
+        selected_time = (state.get('data') or {}).get('selected_time')
+        try:
+            with db.unit_of_work(user_id):
+                if selected_time:
+                    db.add_reminder(user_id, text, selected_time)
+                    reply_text = "提醒已添加！"
+                else:
+                    reply_text = "發生錯誤，請重新開始添加提醒。"
+                db.clear_user_state(user_id)
+        except Exception as e:
+            logger.error("添加提醒時出錯: %s", e, extra={'user_id': user_id})
+            reply_text = "添加提醒失敗，請重試。"
         messaging_api.reply_message(
             ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[TextMessage(text="筆記已保存！")]
+                messages=[TextMessage(text=reply_text)]
             )
         )
     elif state and state['state'] == 'waiting_for_schedule':
@@ -1165,7 +1646,7 @@ def handle_message(event):
             if not data.get('title'):
                 # 第一步：保存標題
                 data['title'] = text
-                db = Database()
+                db = get_db()
                 db.set_user_state(user_id, {
                     'state': 'waiting_for_schedule',
                     'data': data
@@ -1179,7 +1660,7 @@ def handle_message(event):
             elif not data.get('description'):
                 # 第二步：保存內容並詢問提醒時間
                 data['description'] = text
-                db = Database()
+                db = get_db()
                 db.set_user_state(user_id, {
                     'state': 'waiting_for_schedule',
                     'data': data
@@ -1197,7 +1678,7 @@ def handle_message(event):
                 )
             else:
                 # 不應該到達這裡
-                db = Database()
+                db = get_db()
                 db.clear_user_state(user_id)
                 messaging_api.reply_message(
                     ReplyMessageRequest(
@@ -1206,32 +1687,100 @@ def handle_message(event):
                     )
                 )
         except Exception as e:
-            print(f"添加行程時出錯: {e}")
+            logger.error("添加行程時出錯: %s", e)
             messaging_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[TextMessage(text="添加行程失敗，請重試")]
                 )
             )
-            db = Database()
+            db = get_db()
             db.clear_user_state(user_id)
+    elif text in SUBSCRIBE_COMMANDS or text in UNSUBSCRIBE_COMMANDS:
+        # 每日摘要：每天早上推播當天的行程與提醒，不必再問 AI「今天有什麼行程」
+        subscribe = text in SUBSCRIBE_COMMANDS
+        db.set_digest_subscription(user_id, subscribe)
+        if subscribe:
+            reply_text = f"已訂閱每日摘要，每天 {DIGEST_TIME} 會傳送當天的行程與提醒給您。\n輸入「取消每日摘要」即可取消。"
+        else:
+            reply_text = "已取消每日摘要。"
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
+        )
+    elif text in EXPORT_COMMANDS:
+        # 回覆用戶專屬、有時效的匯出連結 (只能用來匯出)
+        links = '\n\n'.join(f"{label}:\n{url}" for label, url in export_links(user_id).items())
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"📦 匯出連結 ({EXPORT_LINK_TTL // 60} 分鐘內有效)：\n\n{links}")]
+            )
+        )
+    elif text in IMPORT_COMMANDS:
+        # 匯入網址另外簽發，權杖只能用來匯入且時效較短
+        reply_text = (
+            f"📥 匯入網址 ({IMPORT_LINK_TTL // 60} 分鐘內有效，請勿分享)：\n{import_link(user_id)}\n\n"
+            "以 POST 上傳檔案，kind 為 all、notes、schedules 或 reminders，fmt 為 ndjson、csv 或 ics。"
+        )
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
+        )
+    elif text in MENU_COMMANDS:
+        # 切換這位用戶的圖文選單 (與其他用戶的切換一起以 bulk API 送出)
+        alias = MENU_COMMANDS[text]
+        menu_switcher.switch(user_id, alias)
+        reply_text = "已切換回主選單。" if alias == MAIN_MENU else f"已切換到{text}選單，點選「返回主選單」即可切換回來。"
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
+        )
+    elif text.startswith('勿擾') or text in ('取消勿擾', '取消勿擾時段'):
+        # 勿擾時段：一般的提醒延到時段結束後才發送，緊急的提醒不受影響
+        reply_text = handle_quiet_hours(user_id, text)
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_text)]
+            )
+        )
+    elif text.startswith('搜尋'):
+        # 筆記全文搜尋，例如「搜尋 會議」
+        reply_note_search(event.reply_token, user_id, text[len('搜尋'):].strip())
+    elif (command := parse_command(text)) is not None:
+        # 「明天下午三點開會」、「30分鐘後提醒我喝水」這類訊息直接新增，不需經過時間選擇器
+        reply_parsed_command(event.reply_token, user_id, command)
     else:
         # AI 對話處理
         try:
-            # 檢查是否包含行程相關關鍵字
-            if check_schedule_keywords(text):
-                print("檢測到行程相關關鍵字，正在查詢行程...")
-                # 查詢用戶的行程
-                schedules = db.get_user_schedules(user_id)
-                print(f"查詢到的行程: {schedules}")
-                schedule_info = format_schedule_info(schedules)
-                print(f"格式化後的行程信息: {schedule_info}")
-                
+            # 偵測查詢意圖，只查詢需要的資料，並以提到的時間範圍縮小查詢
+            detected = detect_intents(text)
+            intents = detected['intents']
+            start, end = detected['window'] or (None, None)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("偵測到意圖", extra={'user_id': user_id, 'intents': sorted(intents)})
+            
+            context = []
+            if SCHEDULE_QUERY in intents:
+                schedules = db.get_user_schedules(user_id, start, end)
+                context.append(f"目前的行程資料如下：\n{format_schedule_info(schedules)}")
+            if REMINDER_QUERY in intents:
+                reminders = db.get_upcoming_reminders(user_id, start, end)
+                context.append(f"目前的提醒事項如下：\n{format_reminder_info(reminders)}")
+            
+            if context:
                 # 將行程信息加入到用戶的提示中
+                context_info = "\n\n".join(context)
                 prompt = f"""用戶詢問行程相關信息。
 
-目前的行程資料如下：
-{schedule_info}
+{context_info}
 
 請根據以上資料，以專業助理的身份回答用戶的問題：{text}
 如果沒有行程，可以建議用戶添加新的行程。
@@ -1239,24 +1788,33 @@ def handle_message(event):
             else:
                 prompt = text
 
+            # 檢索與問題相關的筆記，只把相關的內容放入提示詞
+            note_context = build_note_context(db, user_id, text, k=5 if NOTES_QUERY in intents else 3)
+            if note_context:
+                prompt = f"{prompt}\n\n{note_context}"
+
             # 獲取或創建用戶的聊天實例
             if user_id not in user_chat_history:
                 user_chat_history[user_id] = get_gemini_response()
             
             # 使用用戶的聊天實例
+            stats_recorder.record(AI_CALLS)
             response = user_chat_history[user_id].send_message(prompt)
             reply_text = response.text
         except Exception as e:
-            print(f"AI 回應錯誤: {str(e)}")
+            logger.error("AI 回應錯誤: %s", e)
+            stats_recorder.record(AI_ERRORS)
             if hasattr(e, 'finish_reason') and e.finish_reason == 'SAFETY':
                 reply_text = "抱歉，我無法回應這個問題。請嘗試用不同的方式提問。"
             else:
                 # 如果出錯，重新初始化聊天實例
                 try:
                     user_chat_history[user_id] = get_gemini_response()
+                    stats_recorder.record(AI_CALLS)
                     response = user_chat_history[user_id].send_message(prompt)
                     reply_text = response.text
                 except:
+                    stats_recorder.record(AI_ERRORS)
                     reply_text = "抱歉，我現在無法正確處理這個請求。請稍後再試。"
         
         messaging_api.reply_message(
@@ -1266,13 +1824,36 @@ def handle_message(event):
             )
         )
 
-# 初始化資料庫
-init_db()
-reminder_handler.start()  # 啟動提醒處理器
-
 @app.teardown_appcontext
 def teardown_db(exception):
-    close_db()
+    get_storage().close()
+
+def warm_up():
+    """預先載入 LINE 與 Gemini SDK，讓第一個 webhook 不必等待"""
+    get_messaging_api()
+    get_webhook_handler()
+    get_genai()
+
+def create_app():
+    """應用程式工廠：初始化資料庫並啟動背景執行緒
+    import 本模組沒有任何副作用，gunicorn 以 'line_bot:create_app()' 在 worker 內呼叫
+    """
+    from compaction import compactor
+    from digest import digest_sender
+    from export import MAX_IMPORT_BYTES
+    from reminder_handler import reminder_handler
+    from stats import stats_recorder
+
+    # 請求內容的大小上限 (匯入資料是最大的請求，webhook 遠小於此)
+    app.config['MAX_CONTENT_LENGTH'] = MAX_IMPORT_BYTES
+    get_storage().init_schema()
+    stats_recorder.start()  # 啟動用量統計的定期寫入
+    reminder_handler.start()  # 啟動提醒處理器
+    digest_sender.start()  # 啟動每日摘要排程
+    if get_storage().name == 'sqlite':
+        compactor.start()  # 啟動背景封存與壓縮 (PostgreSQL 由 autovacuum 處理)
+    threading.Thread(target=warm_up, daemon=True).start()
+    return app
 
 if __name__ == "__main__":
-    app.run(debug=True, use_reloader=False)  # 關閉 reloader 以避免重複啟動提醒處理器
+    create_app().run(debug=True, use_reloader=False)  # 關閉 reloader 以避免重複啟動提醒處理器
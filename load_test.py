@@ -0,0 +1,167 @@
+"""webhook 壓力測試：比較同步 worker 與 gevent worker
+
+啟動一個模擬的 LINE API (每次回覆延遲 --latency 秒)，再分別以各種 worker 模式
+執行 gunicorn -c gunicorn.conf.py，並發送帶簽章的「搜尋」訊息 webhook
+(查詢資料庫並回覆)，比較吞吐量與延遲。
+
+用法:
+    python load_test.py
+    python load_test.py --modes sync gevent --requests 500 --concurrency 100
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CHANNEL_SECRET = 'load-test-secret'
+
+
+class FakeLineApi(BaseHTTPRequestHandler):
+    """模擬 LINE Messaging API，每次回覆固定延遲"""
+    latency = 0.2
+    replies = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        with self.lock:
+            FakeLineApi.replies += 1
+        body = b'{"sentMessages": [{"id": "1", "quoteToken": "q"}]}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def webhook_body(i):
+    event = {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': f'Uload{i % 50:04d}'},
+        'webhookEventId': f'load{i}',
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': f'reply{i}',
+        'message': {'id': str(i), 'type': 'text', 'quoteToken': 'q', 'text': '搜尋 會議'},
+    }
+    return json.dumps({'destination': 'Uload', 'events': [event]}).encode()
+
+
+def post_webhook(port, i):
+    body = webhook_body(i)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest())
+    req = urllib.request.Request(
+        f'http://127.0.0.1:{port}/callback',
+        data=body,
+        headers={'Content-Type': 'application/json', 'X-Line-Signature': signature.decode()},
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            ok = response.status == 200
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def wait_ready(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn 啟動失敗')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('等待 gunicorn 啟動逾時')
+
+
+def run_mode(mode, api_port, args):
+    port = free_port()
+    workdir = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        PORT=str(port),
+        GUNICORN_WORKER_CLASS=mode,
+        WEB_CONCURRENCY=str(args.workers),
+        LINE_API_HOST=f'http://127.0.0.1:{api_port}',
+        LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN='load-test-token',
+    )
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py')],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(port, proc)
+        # 暖機：讓 SDK 載入完成，不計入結果
+        post_webhook(port, -1)
+        FakeLineApi.replies = 0
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(lambda i: post_webhook(port, i), range(args.requests)))
+        elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    print(
+        f"{mode:>7}: {args.requests / elapsed:7.1f} 請求/秒  "
+        f"p50 {latencies[len(latencies) // 2] * 1000:7.0f}ms  "
+        f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.0f}ms  "
+        f"錯誤 {errors}  回覆 {FakeLineApi.replies}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'gevent'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.2, help='模擬 LINE API 的回應延遲 (秒)')
+    args = parser.parse_args()
+
+    FakeLineApi.latency = args.latency
+    api = ThreadingHTTPServer(('127.0.0.1', 0), FakeLineApi)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    print(f"{args.workers} 個 worker，{args.requests} 個請求，並行 {args.concurrency}，LINE API 延遲 {args.latency * 1000:.0f}ms")
+    try:
+        for mode in args.modes:
+            run_mode(mode, api.server_address[1], args)
+    finally:
+        api.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+# 日誌等級與高頻日誌取樣率，可用環境變數調整
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+
+# 高頻日誌使用的 extra 參數，例如 logger.debug("...", extra=SAMPLED)
+SAMPLED = {'sample_rate': LOG_SAMPLE_RATE}
+
+# LogRecord 內建的屬性，其餘屬性視為結構化欄位輸出
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample_rate'}
+
+_handler = None
+_setup_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """將日誌記錄格式化為單行 JSON"""
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """依 record.sample_rate 對高頻日誌取樣，未設定取樣率的日誌全部保留"""
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if rate is None or rate >= 1:
+            return True
+        return random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """只把記錄放入佇列，訊息格式化與 JSON 序列化都在背景執行緒完成
+
+    背景執行緒在這個程序第一次寫日誌時才啟動，import 模組不會建立執行緒；
+    fork 出的子程序 (例如 gunicorn worker) 繼承的是已停止的執行緒，第一次寫日誌時會換一個新佇列重新啟動。
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self.listener = None
+        self.listener_pid = None
+
+    def enqueue(self, record):
+        # emit 已持有 handler 的鎖 (logging 會在 fork 後重設)，這裡不需要另外加鎖
+        if self.listener_pid != os.getpid():
+            self.start_listener()
+        super().enqueue(record)
+
+    def start_listener(self):
+        # 父程序佇列裡尚未寫出的記錄由父程序負責，子程序改用新的佇列，避免重複輸出
+        if self.listener_pid is not None:
+            self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        self.listener_pid = os.getpid()
+
+    def stop_listener(self):
+        self.acquire()
+        try:
+            if self.listener is not None and self.listener_pid == os.getpid():
+                self.listener.stop()
+            self.listener = None
+        finally:
+            self.release()
+
+    def prepare(self, record):
+        # 預設實作會在請求執行緒上格式化訊息，這裡只保留例外堆疊的文字
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging(level=None):
+    """設定根日誌器：請求執行緒只負責入列，由 QueueListener 在背景寫出
+
+    可重複呼叫，只會設定一次；背景執行緒延後到第一筆日誌才啟動。
+    """
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return
+
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter())
+
+        _handler = _QueueHandler(stream_handler)
+        _handler.addFilter(SamplingFilter())
+
+        root = logging.getLogger()
+        root.handlers = [_handler]
+        root.setLevel(level or LOG_LEVEL)
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止背景寫出執行緒，並把佇列中剩餘的日誌寫完"""
+    if _handler is not None:
+        _handler.stop_listener()
+
+
+def get_logger(name):
+    """取得已設定好的日誌器"""
+    setup_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,170 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 雜湊特徵維度 (2^11)，每則筆記佔用 8KB
+FEATURE_DIM = 2048
+# 最多在記憶體中保留多少位用戶的索引
+MAX_CACHED_USERS = 128
+# 相似度低於此值的筆記不放入提示詞
+MIN_SCORE = 0.1
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def _features(text):
+    """將文字切成特徵：中文等字元用單字與雙字 n-gram，英數用整個單字"""
+    text = _SPACE_RE.sub(' ', text.lower()).strip()
+    features = _WORD_RE.findall(text)
+    chars = [c for c in _WORD_RE.sub(' ', text) if c != ' ']
+    features.extend(chars)
+    features.extend(a + b for a, b in zip(chars, chars[1:]))
+    return features
+
+
+def vectorize(text):
+    """以雜湊技巧把文字轉成次數向量 (1 + log tf)"""
+    vector = np.zeros(FEATURE_DIM, dtype=np.float32)
+    for feature in _features(text):
+        vector[zlib.crc32(feature.encode('utf-8')) % FEATURE_DIM] += 1
+    nonzero = vector > 0
+    vector[nonzero] = 1 + np.log(vector[nonzero])
+    return vector
+
+
+class UserNoteIndex:
+    """單一用戶的筆記 TF-IDF 索引，以 NumPy 陣列儲存，支援增量新增與刪除"""
+
+    def __init__(self, fingerprint=None):
+        self.matrix = np.zeros((16, FEATURE_DIM), dtype=np.float32)
+        self.doc_freq = np.zeros(FEATURE_DIM, dtype=np.float32)
+        self.note_ids = []
+        self.contents = []
+        self.fingerprint = fingerprint
+
+    def add(self, note_id, content):
+        """新增一則筆記"""
+        size = len(self.note_ids)
+        if size == len(self.matrix):
+            self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+        vector = vectorize(content)
+        self.matrix[size] = vector
+        self.doc_freq += vector > 0
+        self.note_ids.append(note_id)
+        self.contents.append(content)
+
+    def remove(self, note_id):
+        """刪除一則筆記，把最後一列搬到被刪除的位置"""
+        try:
+            row = self.note_ids.index(note_id)
+        except ValueError:
+            return False
+        last = len(self.note_ids) - 1
+        self.doc_freq -= self.matrix[row] > 0
+        self.matrix[row] = self.matrix[last]
+        self.matrix[last] = 0
+        self.note_ids[row] = self.note_ids[last]
+        self.contents[row] = self.contents[last]
+        self.note_ids.pop()
+        self.contents.pop()
+        return True
+
+    def search(self, query, k):
+        """回傳與查詢最相關的前 k 則筆記 [(note_id, content, score)]"""
+        size = len(self.note_ids)
+        if size == 0:
+            return []
+        idf = np.log((size + 1) / (self.doc_freq + 1)) + 1
+        query_vector = vectorize(query) * idf
+        query_norm = np.linalg.norm(query_vector)
+        if query_norm == 0:
+            return []
+        weighted = self.matrix[:size] * idf
+        norms = np.linalg.norm(weighted, axis=1)
+        norms[norms == 0] = 1
+        scores = weighted @ (query_vector / query_norm) / norms
+
+        k = min(k, size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (self.note_ids[i], self.contents[i], float(scores[i]))
+            for i in top if scores[i] >= MIN_SCORE
+        ]
+
+
+class NoteIndex:
+    """所有用戶的筆記索引快取，依用戶延遲建立並以 LRU 淘汰"""
+
+    def __init__(self, max_users=MAX_CACHED_USERS):
+        self.max_users = max_users
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, user_id, index):
+        self._indexes[user_id] = index
+        self._indexes.move_to_end(user_id)
+        while len(self._indexes) > self.max_users:
+            self._indexes.popitem(last=False)
+
+    def add_note(self, user_id, note_id, content):
+        """筆記新增後同步更新索引 (尚未載入的用戶留待查詢時再建立)"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                return
+            index.add(note_id, content)
+            if index.fingerprint is not None:
+                count, max_id = index.fingerprint
+                index.fingerprint = (count + 1, max(max_id or 0, note_id))
+
+    def remove_note(self, user_id, note_id):
+        """筆記刪除後同步更新索引 (筆記ID只在同一分片內唯一，因此需要 user_id)"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and index.remove(note_id) and index.fingerprint is not None:
+                count, max_id = index.fingerprint
+                index.fingerprint = (count - 1, max_id)
+
+    def search(self, user_id, query, k, fingerprint, load_notes):
+        """搜尋用戶最相關的筆記
+        Args:
+            user_id (str): 用戶ID
+            query (str): 查詢文字
+            k (int): 回傳筆數
+            fingerprint (tuple): 資料庫中該用戶筆記的 (數量, 最大ID)，
+                與索引不一致時 (例如其他 worker 寫入) 重新建立
+            load_notes (callable): 回傳該用戶全部筆記的函式
+        Returns:
+            list: [(note_id, content, score)]
+        """
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None and index.fingerprint == fingerprint:
+                self._store(user_id, index)
+                return index.search(query, k)
+
+        # 讀取與向量化全部筆記較慢，在鎖外建立，不阻擋其他用戶的查詢與更新
+        built = UserNoteIndex(fingerprint)
+        for note in load_notes():
+            built.add(note['id'], note['content'])
+        logger.debug("建立筆記索引", extra={'user_id': user_id, 'count': len(built.note_ids)})
+
+        with self._lock:
+            # 建立期間其他執行緒可能已放入相同版本的索引，優先沿用
+            index = self._indexes.get(user_id)
+            if index is None or index.fingerprint != fingerprint:
+                index = built
+            self._store(user_id, index)
+            return index.search(query, k)
+
+
+note_index = NoteIndex()
@@ -0,0 +1,297 @@
+import hashlib
+import heapq
+import os
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from logger import get_logger
+from stats import stats_recorder, REMINDERS_SENT, REMINDERS_RETRIED, REMINDERS_DEAD
+from storage import get_storage, SCHEDULES, REMINDERS
+import timeutil
+
+logger = get_logger(__name__)
+
+# LINE multicast 一次最多 500 位收件人
+MULTICAST_LIMIT = 500
+# 每個分區每輪最多取出的待發送訊息
+OUTBOX_BATCH = 1000
+# 同時進行的 LINE API 呼叫數
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '4'))
+# 領取訊息的租約 (秒)：程序在發送途中結束時，租約到期後由其他程序接手 (需大於一輪發送所需的時間)
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', '300'))
+# 沒有新訊息時多久檢查一次到了重試時間的訊息 (秒)
+OUTBOX_INTERVAL = 5
+# 失敗幾次後轉為 dead letter
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+# 指數退避：第 n 次失敗後等待 BACKOFF_BASE * 2^(n-1) 秒，最多 BACKOFF_MAX 秒
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+# 已發送的訊息保留天數
+OUTBOX_RETENTION_DAYS = 7
+
+# 提醒訊息附上的「稍後提醒」選項 (分鐘)
+SNOOZE_OPTIONS = (10, 60)
+
+# drain 的統計分類對應的用量指標
+STATS_METRICS = {'sent': REMINDERS_SENT, 'retry': REMINDERS_RETRIED, 'dead': REMINDERS_DEAD}
+
+# 產生 X-Line-Retry-Key 用的命名空間：同一批訊息重試時使用相同的 key，LINE 不會重複發送
+_RETRY_KEY_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'line-bot/outbox')
+
+
+def backoff(attempts):
+    """第 attempts 次失敗後的等待秒數 (加上 ±20% 抖動，避免同時失敗的訊息一起重試)"""
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def is_permanent(error):
+    """LINE 回應 4xx (429 除外) 表示請求本身有問題，重試也不會成功"""
+    status = getattr(error, 'status', None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def retry_key(rows):
+    """由訊息內容來源算出固定的重試 key；稍後提醒再次發送時 sent_at 不同，會得到新的 key"""
+    keys = sorted(f"{row['source_table']}:{row['source_id']}:{row['occurrence']}:{row['sent_at'] or ''}" for row in rows)
+    return str(uuid.uuid5(_RETRY_KEY_NAMESPACE, ','.join(keys)))
+
+
+def message_key(message):
+    """訊息內容的短雜湊，放進 postback 識別用戶按的是哪一則提醒"""
+    return hashlib.blake2b(message.encode('utf-8'), digest_size=6).hexdigest()
+
+
+def reminder_quick_reply(source_table, occurrence, message):
+    """提醒訊息下方的「稍後提醒」與「完成」按鈕
+
+    multicast 的每位收件人收到同一組按鈕，postback 因此不帶各自的 outbox ID，而是帶
+    (來源資料表, 發生時間, 訊息內容雜湊)；處理時依用戶找回自己的那幾筆 outbox (find_reminder_outbox)。
+    同一時間有兩則不同的提醒時各自的雜湊不同，不會互相影響。
+    """
+    from linebot.v3.messaging import PostbackAction, QuickReply, QuickReplyItem
+    if source_table not in (SCHEDULES, REMINDERS):
+        return None
+    source = f"src={source_table}&at={occurrence}&key={message_key(message)}"
+    items = [
+        QuickReplyItem(action=PostbackAction(
+            label=f"{minutes} 分鐘後再提醒" if minutes < 60 else f"{minutes // 60} 小時後再提醒",
+            data=f"action=snooze&{source}&min={minutes}",
+            display_text="稍後再提醒我",
+        ))
+        for minutes in SNOOZE_OPTIONS
+    ]
+    items.append(QuickReplyItem(action=PostbackAction(
+        label="完成 ✅", data=f"action=done&{source}", display_text="完成",
+    )))
+    return QuickReply(items=items)
+
+
+def find_reminder_outbox(storage, user_id, data):
+    """由提醒按鈕的 postback 找回用戶收到的那則提醒對應的 outbox ID
+
+    內容與時間都相同的提醒只會收到一則訊息，這時會一起找回。
+    Returns:
+        list: outbox ID，postback 無效或找不到時為空
+    """
+    try:
+        source_table, occurrence, key = data['src'], int(data['at']), data['key']
+    except (KeyError, ValueError):
+        return []
+    return [
+        row['id'] for row in storage.find_outbox(user_id, source_table, occurrence)
+        if message_key(row['message']) == key
+    ]
+
+
+class OutboxSender:
+    """發送 outbox 中的提醒：相同內容合併成 multicast，失敗時以指數退避重試，
+    超過 MAX_ATTEMPTS 次或遇到不可重試的錯誤時轉為 dead letter (保留在 outbox 供查詢)
+    """
+
+    def __init__(self, interval=OUTBOX_INTERVAL, concurrency=OUTBOX_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.thread = None
+        self.running = False
+        self._wake = threading.Event()
+        # 已知的未來發送時間 (最小堆積)，讓發送執行緒在最早的時間醒來，不必等到下一次輪詢
+        self._frontier = []
+        self._frontier_lock = threading.Lock()
+        self._messaging_api = None
+        self._executor = None
+        self._last_purge = None
+
+    @property
+    def messaging_api(self):
+        """LINE Messaging API client，第一次發送時才載入 SDK"""
+        if self._messaging_api is None:
+            from linebot.v3.messaging import MessagingApi, ApiClient, Configuration
+            configuration = Configuration(
+                host=os.getenv('LINE_API_HOST', 'https://api.line.me'),
+                access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+            )
+            self._messaging_api = MessagingApi(
+                api_client=ApiClient(configuration=configuration)
+            )
+        return self._messaging_api
+
+    def start(self):
+        """啟動發送執行緒"""
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """停止發送執行緒"""
+        self.running = False
+        self._wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def wake(self):
+        """有新訊息加入時立即發送，不必等到下一次檢查"""
+        self._wake.set()
+
+    def schedule(self, at):
+        """登記 at 時有訊息要發送 (例如稍後提醒)，發送執行緒會在那時醒來"""
+        with self._frontier_lock:
+            heapq.heappush(self._frontier, at)
+        self._wake.set()
+
+    def _next_wait(self):
+        """到下一次發送前要等待的秒數：最早的已知發送時間，最多 interval 秒"""
+        now = timeutil.now()
+        with self._frontier_lock:
+            while self._frontier and self._frontier[0] <= now:
+                heapq.heappop(self._frontier)
+            if self._frontier:
+                return min(self.interval, (self._frontier[0] - now).total_seconds())
+        return self.interval
+
+    def _loop(self):
+        while self.running:
+            self._wake.wait(self._next_wait())
+            self._wake.clear()
+            try:
+                self.drain()
+                self._purge()
+            except Exception as e:
+                logger.exception("發送 outbox 時出錯: %s", e)
+
+    def drain(self, now=None):
+        """發送所有已到時間的訊息
+        Returns:
+            dict: {'sent': 成功筆數, 'retry': 待重試筆數, 'dead': 轉為 dead letter 的筆數}
+        """
+        storage = get_storage()
+        now = now or timeutil.now()
+        stats = {'sent': 0, 'retry': 0, 'dead': 0}
+        while True:
+            # 領取後其他 worker 不會再取出同一筆，租約到期前必須標記為已發送、待重試或 dead
+            lease_until = now + timedelta(seconds=OUTBOX_LEASE)
+            partitions = storage.map_partitions(
+                lambda partition: storage.claim_outbox(partition, now, OUTBOX_BATCH, lease_until)
+            )
+            rows = [row for rows in partitions for row in rows]
+            if not rows:
+                return stats
+
+            # 相同內容 (含按鈕) 的訊息合併，同一用戶只發一次
+            groups = {}
+            for row in rows:
+                key = (row['message'], row['source_table'], row['occurrence'])
+                groups.setdefault(key, {}).setdefault(row['user_id'], []).append(row)
+            batches = []
+            for key, recipients in groups.items():
+                user_ids = list(recipients)
+                for i in range(0, len(user_ids), MULTICAST_LIMIT):
+                    batches.append((key, {user_id: recipients[user_id] for user_id in user_ids[i:i + MULTICAST_LIMIT]}))
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='outbox')
+            for result in self._executor.map(lambda batch: self._send_batch(storage, *batch), batches):
+                for key, count in result.items():
+                    stats[key] += count
+                    stats_recorder.record(STATS_METRICS[key], count)
+
+            # 已領取的列不會再被取出；有分區取滿一批時才需要再取下一批
+            if all(len(rows) < OUTBOX_BATCH for rows in partitions):
+                return stats
+
+    def _send_batch(self, storage, key, recipients):
+        """發送一批相同內容的訊息並更新 outbox"""
+        message, source_table, occurrence = key
+        stats = {'sent': 0, 'retry': 0, 'dead': 0}
+        rows = [row for user_rows in recipients.values() for row in user_rows]
+        try:
+            self._send(list(recipients), message, retry_key(rows), reminder_quick_reply(source_table, occurrence, message))
+        except Exception as e:
+            if len(recipients) > 1 and is_permanent(e):
+                # multicast 中有無效的收件人時整批會被拒絕，改為逐一發送找出有問題的用戶
+                for user_id, user_rows in recipients.items():
+                    for outcome, count in self._send_batch(storage, key, {user_id: user_rows}).items():
+                        stats[outcome] += count
+                return stats
+            for row in rows:
+                stats[self._record_failure(storage, row, e)] += 1
+            return stats
+
+        for row in rows:
+            storage.mark_outbox_sent(row['user_id'], row['id'])
+        stats['sent'] += len(rows)
+        return stats
+
+    def _send(self, user_ids, message, key, quick_reply=None):
+        """發送文字訊息給一或多位用戶；重試 key 已被 LINE 接受過 (409) 也視為成功"""
+        from linebot.v3.messaging import TextMessage, PushMessageRequest, MulticastRequest
+        messages = [TextMessage(text=message, quick_reply=quick_reply)]
+        try:
+            if len(user_ids) == 1:
+                self.messaging_api.push_message(
+                    PushMessageRequest(to=user_ids[0], messages=messages), x_line_retry_key=key
+                )
+            else:
+                self.messaging_api.multicast(
+                    MulticastRequest(to=user_ids, messages=messages), x_line_retry_key=key
+                )
+        except Exception as e:
+            if getattr(e, 'status', None) != 409:
+                raise
+
+    def _record_failure(self, storage, row, error):
+        """記錄失敗並決定重試或轉為 dead letter，回傳統計用的分類"""
+        attempts = row['attempts'] + 1
+        reason = f"{type(error).__name__}: {error}"[:500]
+        if is_permanent(error) or attempts >= MAX_ATTEMPTS:
+            storage.mark_outbox_failed(row['user_id'], row['id'], reason)
+            logger.error("提醒發送失敗，不再重試", extra={
+                'user_id': row['user_id'], 'outbox_id': row['id'], 'attempts': attempts, 'error': reason,
+            })
+            return 'dead'
+        retry_at = timeutil.now() + timedelta(seconds=backoff(attempts))
+        storage.mark_outbox_failed(row['user_id'], row['id'], reason, retry_at)
+        logger.warning("提醒發送失敗，稍後重試", extra={
+            'user_id': row['user_id'], 'outbox_id': row['id'], 'attempts': attempts, 'error': reason,
+        })
+        return 'retry'
+
+    def _purge(self):
+        """每小時清除一次保留期限外的已發送訊息"""
+        now = timeutil.now()
+        if self._last_purge and now - self._last_purge < timedelta(hours=1):
+            return
+        self._last_purge = now
+        storage = get_storage()
+        before = now - timedelta(days=OUTBOX_RETENTION_DAYS)
+        purged = sum(storage.map_partitions(lambda partition: storage.purge_outbox(partition, before)))
+        if purged:
+            logger.info("已清除舊的 outbox 訊息", extra={'count': purged})
+
+
+outbox_sender = OutboxSender()
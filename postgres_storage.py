@@ -0,0 +1,843 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from database import expand_schedules
+from logger import get_logger
+from timeutil import to_epoch, now_epoch, day_range
+import timeutil
+from storage import (
+    Storage, SCHEDULES, REMINDERS, TIME_COLUMNS, PRIORITY_NORMAL, remind_offsets, OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_SENT, OUTBOX_DEAD,
+    EXPORT_COLUMNS, EXPORT_ORDER, IMPORT_COLUMNS, EXPORT_BATCH,
+)
+
+logger = get_logger(__name__)
+
+# 每個 worker 連線池的大小
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '10'))
+# 與 SQLite 後端相同的持久性設定；PostgreSQL 伺服器本身就會合併同時間的 WAL fsync，
+# normal 時關閉 synchronous_commit，提交不等待 fsync
+DB_DURABILITY = os.getenv('DB_DURABILITY', 'full')
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS notes (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at BIGINT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS schedules (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        description TEXT,
+        scheduled_time BIGINT NOT NULL,
+        remind_before INTEGER DEFAULT 5,
+        created_at BIGINT NOT NULL,
+        ics_file TEXT,
+        reminded INTEGER DEFAULT 0,
+        rrule TEXT,
+        priority INTEGER DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS reminders (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        content TEXT NOT NULL,
+        remind_time BIGINT NOT NULL,
+        created_at BIGINT NOT NULL,
+        is_done INTEGER DEFAULT 0,
+        reminded INTEGER DEFAULT 0,
+        rrule TEXT,
+        priority INTEGER DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_states (
+        user_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        data TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        source_table TEXT NOT NULL,
+        source_id BIGINT NOT NULL,
+        occurrence BIGINT NOT NULL,
+        message TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at BIGINT NOT NULL,
+        last_error TEXT,
+        created_at BIGINT NOT NULL,
+        sent_at BIGINT,
+        UNIQUE (source_table, source_id, occurrence)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS due_items (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        source_table TEXT NOT NULL,
+        source_id BIGINT NOT NULL,
+        offset_minutes INTEGER NOT NULL DEFAULT 0,
+        occurrence BIGINT NOT NULL,
+        fire_at BIGINT NOT NULL,
+        rrule TEXT,
+        UNIQUE (source_table, source_id, offset_minutes)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS scanner_state (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS delivery_windows (
+        user_id TEXT PRIMARY KEY,
+        quiet_start INTEGER NOT NULL,
+        quiet_end INTEGER NOT NULL
+    )
+    ''',
+    # 既有資料庫補上後來新增的欄位
+    'ALTER TABLE schedules ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0',
+    'ALTER TABLE reminders ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 0',
+    'ALTER TABLE notes ADD COLUMN IF NOT EXISTS attachment TEXT',
+    'ALTER TABLE notes ADD COLUMN IF NOT EXISTS attachment_type TEXT',
+    'ALTER TABLE notes ADD COLUMN IF NOT EXISTS attachment_name TEXT',
+    '''
+    CREATE TABLE IF NOT EXISTS digest_subscriptions (
+        user_id TEXT PRIMARY KEY,
+        created_at BIGINT NOT NULL,
+        last_sent BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+    # 用量統計的每小時彙總與不重複成員 (活躍用戶) 的去重表
+    '''
+    CREATE TABLE IF NOT EXISTS stats_hourly (
+        bucket BIGINT NOT NULL,
+        metric TEXT NOT NULL,
+        value BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, metric)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS stats_members (
+        bucket BIGINT NOT NULL,
+        metric TEXT NOT NULL,
+        member TEXT NOT NULL,
+        PRIMARY KEY (bucket, metric, member)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_notes_user_created ON notes (user_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_schedules_user_time ON schedules (user_id, scheduled_time)',
+    'CREATE INDEX IF NOT EXISTS idx_reminders_user_time ON reminders (user_id, remind_time)',
+    # 提醒掃描只用 due_items 的這一個索引，舊的各表掃描索引不再需要
+    'CREATE INDEX IF NOT EXISTS idx_due_items_fire ON due_items (fire_at)',
+    'DROP INDEX IF EXISTS idx_schedules_due',
+    'DROP INDEX IF EXISTS idx_reminders_due',
+    # 發送執行緒領取待發送與租約過期的發送中訊息，部分索引涵蓋這兩種狀態
+    "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status IN ('pending', 'sending')",
+    'DROP INDEX IF EXISTS idx_outbox_pending',
+    'CREATE INDEX IF NOT EXISTS idx_outbox_user ON outbox (user_id, occurrence)',
+]
+
+def _due_items_backfill(table, per_user=False):
+    """為尚未提醒、還沒有待提醒項目的行程或提醒建立 due_items 的 SQL (per_user 時只處理參數指定的用戶)"""
+    column = TIME_COLUMNS[table]
+    offset = 'COALESCE(remind_before, 0)' if table == SCHEDULES else '0'
+    return f'''
+    INSERT INTO due_items (user_id, source_table, source_id, offset_minutes, occurrence, fire_at, rrule)
+    SELECT user_id, '{table}', id, {offset}, {column}, {column} - {offset} * 60, rrule
+    FROM {table} t
+    WHERE reminded = 0
+    {'AND user_id = %s' if per_user else ''}
+    AND NOT EXISTS (SELECT 1 FROM due_items d WHERE d.source_table = '{table}' AND d.source_id = t.id)
+    '''
+
+
+# 既有資料庫升級時建立 due_items (可重複執行；在時間欄位轉換之後執行)
+DUE_ITEMS_BACKFILL = [_due_items_backfill(table) for table in (SCHEDULES, REMINDERS)]
+
+# 筆記關鍵字搜尋使用 pg_trgm 的 GIN 索引加速 ILIKE
+TRGM_SCHEMA = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS idx_notes_content_trgm ON notes USING gin (content gin_trgm_ops)',
+]
+
+
+# 以 UTC epoch 秒儲存的時間欄位 (早期版本為 TIMESTAMP，init_schema 時轉換)
+EPOCH_COLUMNS = {
+    'notes': ['created_at'],
+    'schedules': ['scheduled_time', 'created_at'],
+    'reminders': ['remind_time', 'created_at'],
+}
+
+
+def _row(row):
+    return dict(row) if row is not None else None
+
+
+def _rows(rows):
+    return [dict(row) for row in rows]
+
+
+class PostgresDatabase(Storage):
+    """PostgreSQL 後端，多個 worker 或主機可以共用同一個資料庫"""
+
+    name = 'postgres'
+
+    def __init__(self, dsn, minconn=PG_POOL_MIN, maxconn=PG_POOL_MAX):
+        options = '-c synchronous_commit=off' if DB_DURABILITY == 'normal' else None
+        self.pool = ThreadedConnectionPool(minconn, maxconn, dsn, options=options)
+        # 目前執行緒進行中的工作單元所使用的連線
+        self._unit = threading.local()
+
+    @contextmanager
+    def unit_of_work(self, user_id):
+        """工作單元：區塊內的操作共用一條連線與交易，結束時一次提交"""
+        if getattr(self._unit, 'conn', None) is not None:
+            yield self
+            return
+        conn = self.pool.getconn()
+        self._unit.conn = conn
+        self._unit.after_commit = []
+        try:
+            yield self
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._unit.conn = None
+            callbacks, self._unit.after_commit = self._unit.after_commit, []
+            self.pool.putconn(conn)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("提交後的工作執行失敗: %s", e)
+
+    def _in_unit(self):
+        return getattr(self._unit, 'conn', None) is not None
+
+    def _on_commit(self, callback):
+        """工作單元中延到提交後才執行，否則 (已由 _cursor 提交) 立即執行"""
+        if self._in_unit():
+            self._unit.after_commit.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def _cursor(self):
+        """從連線池取得連線，區塊結束時提交 (出錯時回滾) 並歸還；工作單元中則沿用其連線且不提交"""
+        unit_conn = getattr(self._unit, 'conn', None)
+        if unit_conn is not None:
+            with unit_conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                yield cursor
+            return
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def init_schema(self):
+        """建立資料表與索引"""
+        with self._cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            self._migrate_epoch_timestamps(cursor)
+            for statement in DUE_ITEMS_BACKFILL:
+                cursor.execute(statement)
+        try:
+            with self._cursor() as cursor:
+                for statement in TRGM_SCHEMA:
+                    cursor.execute(statement)
+        except psycopg2.Error as e:
+            # 沒有建立擴充套件的權限時，關鍵字搜尋退回循序掃描
+            logger.warning("無法建立 pg_trgm 索引: %s", e)
+
+    def _migrate_epoch_timestamps(self, cursor):
+        """把 TIMESTAMP (台北時間) 欄位轉為 UTC epoch 秒"""
+        for table, columns in EPOCH_COLUMNS.items():
+            for column in columns:
+                cursor.execute('''
+                    SELECT data_type FROM information_schema.columns
+                    WHERE table_name = %s AND column_name = %s
+                ''', (table, column))
+                row = cursor.fetchone()
+                if row and row['data_type'].startswith('timestamp'):
+                    cursor.execute(f'''
+                        ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT
+                        USING EXTRACT(EPOCH FROM {column} AT TIME ZONE %s)::BIGINT
+                    ''', (timeutil.TIMEZONE.zone,))
+                    logger.info("時間欄位已轉為 epoch", extra={'table': table, 'column': column})
+
+    def get_user_state(self, user_id):
+        """獲取用戶狀態"""
+        with self._cursor() as cursor:
+            cursor.execute('SELECT * FROM user_states WHERE user_id = %s', (user_id,))
+            state = _row(cursor.fetchone())
+        if state and state['data']:
+            state['data'] = json.loads(state['data'])
+        return state
+
+    def set_user_state(self, user_id, state_data):
+        """設置用戶狀態"""
+        if isinstance(state_data.get('data'), dict):
+            state_data['data'] = json.dumps(state_data['data'])
+        with self._cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO user_states (user_id, state, data) VALUES (%s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data
+            ''', (user_id, state_data.get('state'), state_data.get('data')))
+
+    def clear_user_state(self, user_id):
+        """清除用戶狀態"""
+        with self._cursor() as cursor:
+            cursor.execute('DELETE FROM user_states WHERE user_id = %s', (user_id,))
+
+    def get_delivery_window(self, user_id):
+        """獲取用戶的勿擾時段"""
+        with self._cursor() as cursor:
+            cursor.execute('SELECT quiet_start, quiet_end FROM delivery_windows WHERE user_id = %s', (user_id,))
+            return _row(cursor.fetchone())
+
+    def set_delivery_window(self, user_id, quiet_start, quiet_end):
+        """設定或清除用戶的勿擾時段"""
+        with self._cursor() as cursor:
+            if quiet_start is None or quiet_end is None:
+                cursor.execute('DELETE FROM delivery_windows WHERE user_id = %s', (user_id,))
+            else:
+                cursor.execute('''
+                    INSERT INTO delivery_windows (user_id, quiet_start, quiet_end) VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id) DO UPDATE SET quiet_start = EXCLUDED.quiet_start, quiet_end = EXCLUDED.quiet_end
+                ''', (user_id, quiet_start, quiet_end))
+
+    def add_schedule(self, user_id, title, description, scheduled_time, remind_before=5, rrule=None,
+                     priority=PRIORITY_NORMAL):
+        """添加行程 (每個提前時間各建立一筆待提醒項目)"""
+        offsets = remind_offsets(remind_before)
+        scheduled_time = to_epoch(scheduled_time)
+        try:
+            with self._cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO schedules (user_id, title, description, scheduled_time, remind_before, created_at, rrule, priority)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+                ''', (user_id, title, description, scheduled_time, offsets[-1], now_epoch(), rrule, priority))
+                self._insert_due_items(cursor, user_id, SCHEDULES, cursor.fetchone()['id'], scheduled_time, offsets, rrule)
+            return True
+        except psycopg2.Error as e:
+            # 工作單元中的交易已經失效，交給工作單元回滾
+            if self._in_unit():
+                raise
+            logger.error("添加行程時出錯: %s", e)
+            return False
+
+    def add_reminder(self, user_id, content, remind_time, rrule=None, priority=PRIORITY_NORMAL):
+        """添加提醒，回傳是否成功"""
+        remind_time = to_epoch(remind_time)
+        try:
+            with self._cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO reminders (user_id, content, remind_time, created_at, rrule, priority)
+                    VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+                ''', (user_id, content, remind_time, now_epoch(), rrule, priority))
+                self._insert_due_items(cursor, user_id, REMINDERS, cursor.fetchone()['id'], remind_time, [0], rrule)
+            return True
+        except psycopg2.Error as e:
+            if self._in_unit():
+                raise
+            logger.error("添加提醒時出錯: %s", e)
+            return False
+
+    def _insert_due_items(self, cursor, user_id, source_table, source_id, occurrence, offsets, rrule):
+        cursor.executemany('''
+            INSERT INTO due_items (user_id, source_table, source_id, offset_minutes, occurrence, fire_at, rrule)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', [(user_id, source_table, source_id, offset, occurrence, occurrence - offset * 60, rrule) for offset in offsets])
+
+    def add_note(self, user_id, content, attachment=None, attachment_type=None, attachment_name=None):
+        """添加筆記 (語意索引在交易提交後才更新)"""
+        try:
+            with self._cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO notes (user_id, content, created_at, attachment, attachment_type, attachment_name)
+                    VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
+                ''', (user_id, content, now_epoch(), attachment, attachment_type, attachment_name))
+                note_id = cursor.fetchone()['id']
+            from note_index import note_index  # 需要 numpy，延後到用到時才載入
+            self._on_commit(lambda: note_index.add_note(user_id, note_id, content))
+            return True
+        except psycopg2.Error as e:
+            if self._in_unit():
+                raise
+            logger.error("添加筆記時出錯: %s", e)
+            return False
+
+    def get_schedules(self, user_id):
+        """獲取用戶的所有行程"""
+        with self._cursor() as cursor:
+            cursor.execute('SELECT * FROM schedules WHERE user_id = %s ORDER BY scheduled_time ASC', (user_id,))
+            return _rows(cursor.fetchall())
+
+    def get_reminders(self, user_id):
+        """獲取用戶的所有提醒"""
+        with self._cursor() as cursor:
+            cursor.execute('SELECT * FROM reminders WHERE user_id = %s ORDER BY remind_time', (user_id,))
+            return _rows(cursor.fetchall())
+
+    def get_notes(self, user_id):
+        """獲取用戶的所有筆記"""
+        with self._cursor() as cursor:
+            cursor.execute('''
+                SELECT id, user_id, content, created_at, attachment, attachment_type, attachment_name FROM notes
+                WHERE user_id = %s ORDER BY created_at DESC, id DESC
+            ''', (user_id,))
+            return _rows(cursor.fetchall())
+
+    def search_notes(self, user_id, keyword, limit=10, offset=0):
+        """搜尋包含所有關鍵字的筆記 (不分大小寫)"""
+        terms = keyword.split()
+        if not terms:
+            return []
+        conditions = ' AND '.join("content ILIKE %s" for _ in terms)
+        patterns = [
+            '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            for term in terms
+        ]
+        with self._cursor() as cursor:
+            cursor.execute(f'''
+                SELECT id, user_id, content, created_at, attachment, attachment_type, attachment_name FROM notes
+                WHERE user_id = %s AND {conditions}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s OFFSET %s
+            ''', (user_id, *patterns, limit, offset))
+            return _rows(cursor.fetchall())
+
+    def get_relevant_notes(self, user_id, query, k=3):
+        """取得與問題最相關的前 k 則筆記"""
+        with self._cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) AS count, MAX(id) AS max_id FROM notes WHERE user_id = %s',
+                (user_id,)
+            )
+            fingerprint = cursor.fetchone()
+        from note_index import note_index
+        return note_index.search(
+            user_id,
+            query,
+            k,
+            (fingerprint['count'], fingerprint['max_id']),
+            lambda: self.get_notes(user_id)
+        )
+
+    def get_upcoming_reminders(self, user_id, start=None, end=None):
+        """獲取用戶即將到來的提醒"""
+        params = [user_id, to_epoch(start) if start else now_epoch()]
+        end_condition = ''
+        if end:
+            end_condition = 'AND remind_time < %s'
+            params.append(to_epoch(end))
+        with self._cursor() as cursor:
+            cursor.execute(f'''
+                SELECT * FROM reminders
+                WHERE user_id = %s
+                AND (rrule IS NOT NULL OR remind_time >= %s)
+                {end_condition}
+                ORDER BY remind_time
+            ''', params)
+            return _rows(cursor.fetchall())
+
+    def get_today_schedules(self, user_id):
+        """獲取用戶今天的行程"""
+        today_start, today_end = day_range()
+        with self._cursor() as cursor:
+            cursor.execute('''
+                SELECT * FROM schedules
+                WHERE user_id = %s AND scheduled_time >= %s AND scheduled_time < %s
+                ORDER BY scheduled_time
+            ''', (user_id, today_start, today_end))
+            return _rows(cursor.fetchall())
+
+    def get_schedule_by_id(self, user_id, schedule_id):
+        """根據ID獲取行程"""
+        try:
+            with self._cursor() as cursor:
+                cursor.execute('SELECT * FROM schedules WHERE id = %s AND user_id = %s', (int(schedule_id), user_id))
+                return _row(cursor.fetchone())
+        except (psycopg2.Error, ValueError) as e:
+            logger.error("根據ID獲取行程時出錯: %s", e)
+            return None
+
+    def get_user_schedules(self, user_id, start=None, end=None):
+        """獲取用戶即將到來的行程"""
+        start = start or timeutil.now()
+        params = [user_id, to_epoch(start)]
+        end_condition = ''
+        if end:
+            end_condition = 'AND scheduled_time < %s'
+            params.append(to_epoch(end))
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(f'''
+                    SELECT title, description, scheduled_time, remind_before, rrule
+                    FROM schedules
+                    WHERE user_id = %s
+                    AND (rrule IS NOT NULL OR scheduled_time >= %s)
+                    {end_condition}
+                    ORDER BY scheduled_time ASC
+                ''', params)
+                return expand_schedules(_rows(cursor.fetchall()), start, end)
+        except psycopg2.Error as e:
+            logger.exception("獲取用戶行程時出錯: %s", e)
+            return []
+
+    def _delete(self, table, user_id, item_id):
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(f'DELETE FROM {table} WHERE id = %s AND user_id = %s', (int(item_id), user_id))
+                deleted = cursor.rowcount > 0
+                if table in TIME_COLUMNS:
+                    cursor.execute(
+                        'DELETE FROM due_items WHERE source_table = %s AND source_id = %s AND user_id = %s',
+                        (table, int(item_id), user_id)
+                    )
+                    # 還沒發送 (或已發送、之後可能被改為稍後提醒) 的訊息一併刪除，dead letter 留著供查詢
+                    cursor.execute(
+                        'DELETE FROM outbox WHERE source_table = %s AND source_id = %s AND user_id = %s AND status != %s',
+                        (table, int(item_id), user_id, OUTBOX_DEAD)
+                    )
+                return deleted
+        except (psycopg2.Error, ValueError) as e:
+            logger.error("刪除資料時出錯: %s", e, extra={'table': table})
+            return False
+
+    def delete_note(self, user_id, note_id):
+        """刪除筆記"""
+        if self._delete('notes', user_id, note_id):
+            from note_index import note_index
+            note_index.remove_note(user_id, int(note_id))
+            return True
+        return False
+
+    def delete_reminder(self, user_id, reminder_id):
+        """刪除提醒"""
+        return self._delete('reminders', user_id, reminder_id)
+
+    def delete_schedule(self, user_id, schedule_id):
+        """刪除行程"""
+        return self._delete('schedules', user_id, schedule_id)
+
+    def map_partitions(self, func):
+        """只有一個分區，由資料庫處理並行"""
+        return [func(0)]
+
+    def get_due_items(self, partition, since, now):
+        """提醒時間落在 (since, now] 的待提醒項目 (連同來源內容與勿擾時段)"""
+        with self._cursor() as cursor:
+            cursor.execute('''
+                SELECT d.id, d.user_id, d.source_table, d.source_id, d.offset_minutes, d.fire_at, d.occurrence, d.rrule,
+                    COALESCE(s.title, r.content) AS title, s.description,
+                    COALESCE(s.priority, r.priority) AS priority, w.quiet_start, w.quiet_end
+                FROM due_items d
+                LEFT JOIN schedules s ON d.source_table = %s AND s.id = d.source_id
+                LEFT JOIN reminders r ON d.source_table = %s AND r.id = d.source_id
+                LEFT JOIN delivery_windows w ON w.user_id = d.user_id
+                WHERE d.fire_at > %s AND d.fire_at <= %s
+            ''', (SCHEDULES, REMINDERS, to_epoch(since), to_epoch(now)))
+            return _rows(cursor.fetchall())
+
+    def get_missed_due_items(self, partition, before):
+        """提醒時間不晚於 before 的待提醒項目"""
+        with self._cursor() as cursor:
+            cursor.execute('''
+                SELECT id, user_id, offset_minutes, occurrence, rrule FROM due_items WHERE fire_at <= %s
+            ''', (to_epoch(before),))
+            return _rows(cursor.fetchall())
+
+    def advance_due_item(self, user_id, item_id, next_time=None, rrule=None):
+        """移除待提醒項目或移到下一次發生時間，並同步來源的時間欄位與已提醒標記"""
+        with self._cursor() as cursor:
+            if next_time is None:
+                cursor.execute(
+                    'DELETE FROM due_items WHERE id = %s AND user_id = %s RETURNING source_table, source_id',
+                    (item_id, user_id)
+                )
+            else:
+                cursor.execute('''
+                    UPDATE due_items SET occurrence = %s, fire_at = %s - offset_minutes * 60, rrule = %s
+                    WHERE id = %s AND user_id = %s RETURNING source_table, source_id
+                ''', (to_epoch(next_time), to_epoch(next_time), rrule, item_id, user_id))
+            item = cursor.fetchone()
+            if item is None:
+                return
+            table = item['source_table']
+            cursor.execute('''
+                SELECT occurrence, rrule FROM due_items
+                WHERE source_table = %s AND source_id = %s
+                ORDER BY occurrence LIMIT 1
+            ''', (table, item['source_id']))
+            upcoming = cursor.fetchone()
+            if upcoming:
+                cursor.execute(
+                    f'UPDATE {table} SET {TIME_COLUMNS[table]} = %s, rrule = %s, reminded = 0 WHERE id = %s',
+                    (upcoming['occurrence'], upcoming['rrule'], item['source_id'])
+                )
+            else:
+                cursor.execute(f'UPDATE {table} SET reminded = 1 WHERE id = %s', (item['source_id'],))
+
+    def get_scan_checkpoint(self, partition):
+        """上一次完整掃描到的時間"""
+        with self._cursor() as cursor:
+            cursor.execute("SELECT value FROM scanner_state WHERE name = 'checkpoint'")
+            row = cursor.fetchone()
+            return row['value'] if row else None
+
+    def set_scan_checkpoint(self, partition, at):
+        """記錄已完整掃描到 at"""
+        with self._cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO scanner_state (name, value) VALUES ('checkpoint', %s)
+                ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+            ''', (to_epoch(at),))
+
+    def enqueue_outbox(self, user_id, source_table, source_id, occurrence, message, send_at=None):
+        """加入待發送的訊息；同一項目的同一次提醒只會加入一次"""
+        now = now_epoch()
+        with self._cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO outbox
+                (user_id, source_table, source_id, occurrence, message, next_attempt_at, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (source_table, source_id, occurrence) DO NOTHING
+            ''', (user_id, source_table, source_id, to_epoch(occurrence), message, to_epoch(send_at) or now, now))
+            return cursor.rowcount > 0
+
+    def claim_outbox(self, partition, now, limit, lease_until):
+        """領取已到發送時間的訊息；FOR UPDATE SKIP LOCKED 讓多個程序同時領取時各自取得不同的訊息"""
+        with self._cursor() as cursor:
+            cursor.execute('''
+                UPDATE outbox SET status = %s, next_attempt_at = %s
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status IN (%s, %s) AND next_attempt_at <= %s
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            ''', (OUTBOX_SENDING, to_epoch(lease_until), OUTBOX_PENDING, OUTBOX_SENDING, to_epoch(now), limit))
+            return _rows(cursor.fetchall())
+
+    def mark_outbox_sent(self, user_id, outbox_id):
+        """標記訊息已發送"""
+        with self._cursor() as cursor:
+            cursor.execute(
+                'UPDATE outbox SET status = %s, sent_at = %s, attempts = attempts + 1 WHERE id = %s AND user_id = %s AND status = %s',
+                (OUTBOX_SENT, now_epoch(), outbox_id, user_id, OUTBOX_SENDING)
+            )
+
+    def mark_outbox_failed(self, user_id, outbox_id, error, retry_at=None):
+        """記錄發送失敗，retry_at 為 None 時轉為 dead letter"""
+        with self._cursor() as cursor:
+            if retry_at is None:
+                cursor.execute(
+                    'UPDATE outbox SET status = %s, attempts = attempts + 1, last_error = %s WHERE id = %s AND user_id = %s AND status = %s',
+                    (OUTBOX_DEAD, error, outbox_id, user_id, OUTBOX_SENDING)
+                )
+            else:
+                cursor.execute('''
+                    UPDATE outbox SET status = %s, attempts = attempts + 1, next_attempt_at = %s, last_error = %s
+                    WHERE id = %s AND user_id = %s AND status = %s
+                ''', (OUTBOX_PENDING, to_epoch(retry_at), error, outbox_id, user_id, OUTBOX_SENDING))
+
+    def purge_outbox(self, partition, before):
+        """刪除在 before 之前已發送的訊息"""
+        with self._cursor() as cursor:
+            cursor.execute('DELETE FROM outbox WHERE status = %s AND sent_at < %s', (OUTBOX_SENT, to_epoch(before)))
+            return cursor.rowcount
+
+    def find_outbox(self, user_id, source_table, occurrence):
+        """用戶在這次提醒收到的訊息"""
+        with self._cursor() as cursor:
+            cursor.execute(
+                'SELECT id, source_id, message, status FROM outbox WHERE user_id = %s AND source_table = %s AND occurrence = %s',
+                (user_id, source_table, to_epoch(occurrence))
+            )
+            return cursor.fetchall()
+
+    def snooze_outbox(self, user_id, outbox_ids, send_at):
+        """把收到的提醒改為在 send_at 再發送一次 (沿用同一筆 outbox，不新增資料)"""
+        with self._cursor() as cursor:
+            cursor.execute('''
+                UPDATE outbox SET status = %s, attempts = 0, next_attempt_at = %s, last_error = NULL
+                WHERE user_id = %s AND id = ANY(%s) AND status IN (%s, %s)
+            ''', (OUTBOX_PENDING, to_epoch(send_at), user_id, list(outbox_ids), OUTBOX_PENDING, OUTBOX_SENT))
+            return cursor.rowcount > 0
+
+    def acknowledge_outbox(self, user_id, outbox_ids):
+        """取消尚未發送的稍後提醒，單次的提醒標記為完成"""
+        with self._cursor() as cursor:
+            cursor.execute(
+                'SELECT source_table, source_id FROM outbox WHERE user_id = %s AND id = ANY(%s)',
+                (user_id, list(outbox_ids))
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                return False
+            cursor.execute(
+                'UPDATE outbox SET status = %s WHERE user_id = %s AND id = ANY(%s) AND status = %s',
+                (OUTBOX_SENT, user_id, list(outbox_ids), OUTBOX_PENDING)
+            )
+            reminder_ids = [row['source_id'] for row in rows if row['source_table'] == REMINDERS]
+            if reminder_ids:
+                cursor.execute(
+                    'UPDATE reminders SET is_done = 1 WHERE user_id = %s AND rrule IS NULL AND id = ANY(%s)',
+                    (user_id, reminder_ids)
+                )
+            return True
+
+    def set_digest_subscription(self, user_id, enabled):
+        """訂閱或取消每日摘要"""
+        with self._cursor() as cursor:
+            if enabled:
+                cursor.execute(
+                    'INSERT INTO digest_subscriptions (user_id, created_at) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING',
+                    (user_id, now_epoch())
+                )
+            else:
+                cursor.execute('DELETE FROM digest_subscriptions WHERE user_id = %s', (user_id,))
+            return cursor.rowcount > 0
+
+    def get_digest_batch(self, partition, start, end, after=None, limit=500):
+        """當天還沒收到摘要的訂閱者及其行程與提醒 (一個查詢)"""
+        start, end = to_epoch(start), to_epoch(end)
+        with self._cursor() as cursor:
+            cursor.execute('''
+                WITH due AS (
+                    SELECT user_id FROM digest_subscriptions
+                    WHERE last_sent < %s AND user_id > %s
+                    ORDER BY user_id
+                    LIMIT %s
+                )
+                SELECT d.user_id, CASE WHEN s.id IS NULL THEN NULL ELSE %s END AS kind,
+                    s.title, s.description, s.scheduled_time AS at, s.rrule
+                FROM due d
+                LEFT JOIN schedules s ON s.user_id = d.user_id
+                    AND s.scheduled_time < %s
+                    AND (s.rrule IS NOT NULL OR s.scheduled_time >= %s)
+                UNION ALL
+                SELECT d.user_id, %s, r.content, NULL, r.remind_time, r.rrule
+                FROM due d
+                JOIN reminders r ON r.user_id = d.user_id
+                    AND r.remind_time < %s
+                    AND (r.rrule IS NOT NULL OR r.remind_time >= %s)
+                ORDER BY 1
+            ''', (start, after or '', limit, SCHEDULES, end, start, REMINDERS, end, start))
+            return _rows(cursor.fetchall())
+
+    def mark_digest_sent(self, user_id, day_start):
+        """記錄用戶已收到那一天的摘要"""
+        with self._cursor() as cursor:
+            cursor.execute(
+                'UPDATE digest_subscriptions SET last_sent = %s WHERE user_id = %s', (to_epoch(day_start), user_id)
+            )
+
+    def iter_items(self, user_id, kind, batch_size=EXPORT_BATCH):
+        """以具名 (伺服器端) 游標逐批讀出，每次只傳回 batch_size 筆；讀取期間佔用一條連線"""
+        unit_conn = getattr(self._unit, 'conn', None)
+        conn = unit_conn or self.pool.getconn()
+        try:
+            with conn.cursor(name=f'export_{kind}', cursor_factory=RealDictCursor) as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(
+                    f"SELECT {', '.join(EXPORT_COLUMNS[kind])} FROM {kind} WHERE user_id = %s ORDER BY {EXPORT_ORDER[kind]}, id",
+                    (user_id,)
+                )
+                for row in cursor:
+                    yield dict(row)
+        finally:
+            if unit_conn is None:
+                # 只有讀取，結束交易後歸還
+                conn.rollback()
+                self.pool.putconn(conn)
+
+    def import_items(self, user_id, kind, rows):
+        """以 executemany 寫入一批資料，行程與提醒接著建立待提醒項目"""
+        columns = IMPORT_COLUMNS[kind]
+        with self._cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {kind} (user_id, {', '.join(columns)}) VALUES ({', '.join(['%s'] * (len(columns) + 1))})",
+                [(user_id, *(row.get(column) for column in columns)) for row in rows]
+            )
+            if kind in TIME_COLUMNS:
+                cursor.execute(_due_items_backfill(kind, per_user=True), (user_id,))
+        return len(rows)
+
+    def add_stats(self, counters, members=()):
+        """成員以一個 INSERT ... ON CONFLICT DO NOTHING RETURNING 去重並計算新增人數，再以 UPSERT 累加計數
+        (依主鍵順序寫入，多個 worker 同時累加相同的列時不會互相死結)
+        """
+        counters = dict(counters)
+        members = sorted(set(members))
+        with self._cursor() as cursor:
+            if members:
+                buckets, metrics, names = zip(*members)
+                cursor.execute('''
+                    WITH added AS (
+                        INSERT INTO stats_members (bucket, metric, member)
+                        SELECT * FROM unnest(%s::bigint[], %s::text[], %s::text[])
+                        ON CONFLICT DO NOTHING
+                        RETURNING bucket, metric
+                    )
+                    SELECT bucket, metric, COUNT(*) AS value FROM added GROUP BY bucket, metric
+                ''', (list(buckets), list(metrics), list(names)))
+                for row in cursor.fetchall():
+                    key = (row['bucket'], row['metric'])
+                    counters[key] = counters.get(key, 0) + row['value']
+            cursor.executemany('''
+                INSERT INTO stats_hourly (bucket, metric, value) VALUES (%s, %s, %s)
+                ON CONFLICT (bucket, metric) DO UPDATE SET value = stats_hourly.value + EXCLUDED.value
+            ''', [(bucket, metric, value) for (bucket, metric), value in sorted(counters.items()) if value])
+
+    def get_stats(self, start, end):
+        """bucket 落在 [start, end) 的彙總計數"""
+        with self._cursor() as cursor:
+            cursor.execute(
+                'SELECT bucket, metric, value FROM stats_hourly WHERE bucket >= %s AND bucket < %s ORDER BY bucket, metric',
+                (to_epoch(start), to_epoch(end))
+            )
+            return _rows(cursor.fetchall())
+
+    def purge_stats_members(self, before):
+        """刪除 bucket 早於 before 的去重成員"""
+        with self._cursor() as cursor:
+            cursor.execute('DELETE FROM stats_members WHERE bucket < %s', (to_epoch(before),))
+            return cursor.rowcount
+
+    def close(self):
+        """連線在每次操作後已歸還連線池，不需要額外處理"""
+
+    def shutdown(self):
+        """關閉連線池中的所有連線"""
+        self.pool.closeall()
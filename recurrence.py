@@ -0,0 +1,179 @@
+from datetime import datetime, timedelta
+
+# RFC 5545 RRULE 的子集：FREQ=DAILY/WEEKLY/MONTHLY/YEARLY，INTERVAL、BYDAY、COUNT、UNTIL
+WEEKDAY_CODES = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+WEEKDAY_NAMES = ['一', '二', '三', '四', '五', '六', '日']
+WORKDAYS = 'MO,TU,WE,TH,FR'
+
+# 往後找下一次發生時間時最多嘗試的次數，避免錯誤的規則造成無窮迴圈
+_MAX_STEPS = 5000
+
+
+def parse_rrule(rule):
+    """解析 RRULE 字串 (可含或不含 'RRULE:' 前綴)
+    Args:
+        rule (str): 例如 'FREQ=WEEKLY;BYDAY=MO,WE;COUNT=10'
+    Returns:
+        dict: {'freq', 'interval', 'byday', 'count', 'until'}
+    """
+    if rule.upper().startswith('RRULE:'):
+        rule = rule[len('RRULE:'):]
+    parts = dict(part.split('=', 1) for part in rule.upper().split(';') if '=' in part)
+    freq = parts.get('FREQ')
+    if freq not in ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY'):
+        raise ValueError(f"不支援的重複規則: {rule}")
+    until = parts.get('UNTIL')
+    return {
+        'freq': freq,
+        'interval': max(int(parts.get('INTERVAL', 1)), 1),
+        'byday': [WEEKDAY_CODES.index(day[-2:]) for day in parts['BYDAY'].split(',')] if parts.get('BYDAY') else None,
+        'count': int(parts['COUNT']) if parts.get('COUNT') else None,
+        'until': datetime.strptime(until.rstrip('Z')[:15], '%Y%m%dT%H%M%S') if until else None,
+    }
+
+
+def format_rrule(parsed):
+    """把 parse_rrule 的結果轉回 RRULE 字串"""
+    parts = [f"FREQ={parsed['freq']}"]
+    if parsed['interval'] != 1:
+        parts.append(f"INTERVAL={parsed['interval']}")
+    if parsed['byday']:
+        parts.append('BYDAY=' + ','.join(WEEKDAY_CODES[day] for day in sorted(parsed['byday'])))
+    if parsed['count'] is not None:
+        parts.append(f"COUNT={parsed['count']}")
+    if parsed['until'] is not None:
+        parts.append(f"UNTIL={parsed['until'].strftime('%Y%m%dT%H%M%S')}")
+    return ';'.join(parts)
+
+
+def _add_months(dt, months):
+    """往後加幾個月，日期不存在 (例如 2 月 30 日) 時回傳 None"""
+    month = dt.month - 1 + months
+    try:
+        return dt.replace(year=dt.year + month // 12, month=month % 12 + 1)
+    except ValueError:
+        return None
+
+
+def _step(parsed, current):
+    """回傳 current 之後的下一次發生時間 (不考慮 COUNT/UNTIL)"""
+    freq, interval = parsed['freq'], parsed['interval']
+    if freq == 'DAILY':
+        return current + timedelta(days=interval)
+    if freq == 'WEEKLY':
+        if not parsed['byday']:
+            return current + timedelta(days=7 * interval)
+        week_start = current.date() - timedelta(days=current.weekday())
+        candidate = current
+        for _ in range(7 * interval + 7):
+            candidate += timedelta(days=1)
+            weeks = (candidate.date() - week_start).days // 7
+            if candidate.weekday() in parsed['byday'] and weeks % interval == 0:
+                return candidate
+        return None
+    months = interval if freq == 'MONTHLY' else 12 * interval
+    for n in range(1, 49):
+        candidate = _add_months(current, months * n)
+        if candidate is not None:
+            return candidate
+    return None
+
+
+def next_occurrence(rule, current, after=None):
+    """計算下一次發生時間，只往後展開到需要的那一次
+    Args:
+        rule (str): RRULE 字串
+        current (datetime): 目前這一次的發生時間
+        after (datetime): 回傳的時間必須晚於此時間，預設為 current
+    Returns:
+        tuple: (下一次發生時間, 更新後的 RRULE 字串)，已沒有下一次時回傳 (None, None)。
+            規則中的 COUNT 表示含目前這次在內剩餘的次數，每往後一次就減一。
+    """
+    parsed = parse_rrule(rule)
+    after = max(after or current, current)
+    occurrence = current
+    for _ in range(_MAX_STEPS):
+        if parsed['count'] is not None:
+            if parsed['count'] <= 1:
+                return None, None
+            parsed['count'] -= 1
+        occurrence = _step(parsed, occurrence)
+        if occurrence is None or (parsed['until'] and occurrence > parsed['until']):
+            return None, None
+        if occurrence > after:
+            return occurrence, format_rrule(parsed)
+    return None, None
+
+
+def upcoming_occurrences(rule, current, limit=3, start=None, end=None):
+    """列出接下來的幾次發生時間，供列表顯示使用
+    Args:
+        rule (str): RRULE 字串
+        current (datetime): 目前這一次的發生時間
+        limit (int): 最多列出幾次
+        start (datetime): 只列出此時間 (含) 之後的發生時間
+        end (datetime): 只列出此時間 (不含) 之前的發生時間
+    Returns:
+        list: datetime 列表
+    """
+    occurrences = []
+    occurrence = current
+    while occurrence is not None and len(occurrences) < limit:
+        if end is not None and occurrence >= end:
+            break
+        if start is None or occurrence >= start:
+            occurrences.append(occurrence)
+        occurrence, rule = next_occurrence(rule, occurrence)
+    return occurrences
+
+
+def first_occurrence(rule, hour, minute, now, month_day=None):
+    """依規則找出晚於 now 的第一次發生時間
+    Args:
+        rule (str): RRULE 字串
+        hour (int): 時
+        minute (int): 分
+        now (datetime): 目前時間
+        month_day (int): 每月重複時的日期
+    Returns:
+        datetime: 第一次發生時間，找不到時回傳 None
+    """
+    parsed = parse_rrule(rule)
+    candidate = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    for _ in range(400):
+        if (
+            candidate > now
+            and (not parsed['byday'] or candidate.weekday() in parsed['byday'])
+            and (month_day is None or candidate.day == month_day)
+        ):
+            return candidate
+        candidate += timedelta(days=1)
+    return None
+
+
+def describe_rrule(rule):
+    """把 RRULE 轉為中文描述，例如「每個工作日」、「每週一、三」"""
+    try:
+        parsed = parse_rrule(rule)
+    except (ValueError, KeyError):
+        return "重複"
+    interval = parsed['interval']
+    if parsed['freq'] == 'DAILY':
+        text = "每天" if interval == 1 else f"每 {interval} 天"
+    elif parsed['freq'] == 'WEEKLY':
+        prefix = "每週" if interval == 1 else f"每 {interval} 週"
+        if parsed['byday'] and sorted(parsed['byday']) == [0, 1, 2, 3, 4] and interval == 1:
+            text = "每個工作日"
+        elif parsed['byday']:
+            text = prefix + "、".join(WEEKDAY_NAMES[day] for day in sorted(parsed['byday']))
+        else:
+            text = prefix
+    elif parsed['freq'] == 'MONTHLY':
+        text = "每月" if interval == 1 else f"每 {interval} 個月"
+    else:
+        text = "每年" if interval == 1 else f"每 {interval} 年"
+    if parsed['count'] is not None:
+        text += f" (剩 {parsed['count']} 次)"
+    elif parsed['until'] is not None:
+        text += f" (至 {parsed['until'].strftime('%Y-%m-%d')})"
+    return text
@@ -1,24 +1,77 @@
+import os
 import threading
 import time
-from datetime import datetime, timedelta
-import pytz
-from linebot.v3.messaging import MessagingApi, ApiClient, Configuration
-from linebot.v3.messaging import TextMessage, PushMessageRequest
-from database import get_db, dict_factory
-import os
+import zlib
+from datetime import timedelta
+from storage import get_storage, SCHEDULES, PRIORITY_URGENT
 from dotenv import load_dotenv
+from logger import get_logger
+from outbox import outbox_sender
+from stats import stats_recorder, REMINDERS_QUEUED, REMINDERS_LATE
+from recurrence import next_occurrence
+from timeutil import from_epoch, TIMEZONE
+import timeutil
 
 load_dotenv()
 
+logger = get_logger(__name__)
+
+# 提醒時間過後多久內仍算準時 (秒)，涵蓋掃描間隔與短暫的延遲
+DUE_GRACE = 300
+# 停機後最多補發多久以前錯過的提醒 (秒)，更早的不再發送
+CATCHUP_LIMIT = 24 * 3600
+# 補發的延遲提醒每秒最多送出幾種不同內容 (相同內容仍會合併成一次 multicast)
+CATCHUP_RATE = 10
+# 一般的提醒在這段時間 (秒) 內錯開發送，攤平整點湧出的推播；緊急的提醒一律準時
+DELIVERY_JITTER = int(os.getenv('REMINDER_JITTER', '60'))
+
+
+def quiet_until(at, quiet_start, quiet_end):
+    """at 落在勿擾時段 (當天第幾分鐘，結束早於開始表示跨過午夜) 內時回傳時段結束的時間，否則回傳 None"""
+    if quiet_start is None or quiet_end is None or quiet_start == quiet_end:
+        return None
+    minute = at.hour * 60 + at.minute
+    if quiet_start < quiet_end:
+        inside = quiet_start <= minute < quiet_end
+    else:
+        inside = minute >= quiet_start or minute < quiet_end
+    if not inside:
+        return None
+    end = at.replace(hour=quiet_end // 60, minute=quiet_end % 60, second=0, microsecond=0)
+    return end if end > at else end + timedelta(days=1)
+
+
+def delivery_time(at, message, quiet_start=None, quiet_end=None):
+    """一般提醒的發送時間：落在勿擾時段時延到時段結束，再依訊息內容錯開 0 到 DELIVERY_JITTER 秒
+    (相同內容錯開的秒數相同，仍會合併成一次 multicast)
+    Returns:
+        tuple: (發送時間, 是否因勿擾時段而延後)
+    """
+    quiet_end_at = quiet_until(at, quiet_start, quiet_end)
+    if quiet_end_at:
+        at = quiet_end_at
+    if DELIVERY_JITTER > 0:
+        at += timedelta(seconds=zlib.crc32(message.encode('utf-8')) % DELIVERY_JITTER)
+    return at, quiet_end_at is not None
+
+
+class _LatePacer:
+    """為一輪掃描中的延遲提醒排定發送時間，讓補發平均分散而不是一次湧出"""
+
+    def __init__(self, start):
+        self.start = start
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def send_at(self, message):
+        with self._lock:
+            slot = self._slots.setdefault(message, len(self._slots))
+        return self.start + timedelta(seconds=slot / CATCHUP_RATE)
+
 class ReminderHandler:
     def __init__(self):
-        self.configuration = Configuration(
-            access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-        )
-        self.messaging_api = MessagingApi(
-            api_client=ApiClient(configuration=self.configuration)
-        )
-        self.timezone = pytz.timezone('Asia/Taipei')
+        self.outbox = outbox_sender
+        self.timezone = TIMEZONE
         self.check_interval = 60  # 每分鐘檢查一次
         self.reminder_thread = None
         self.running = False
@@ -30,12 +83,14 @@ class ReminderHandler:
             self.reminder_thread = threading.Thread(target=self._reminder_loop)
             self.reminder_thread.daemon = True
             self.reminder_thread.start()
+            self.outbox.start()
 
     def stop(self):
         """停止提醒處理器"""
         self.running = False
         if self.reminder_thread:
             self.reminder_thread.join()
+        self.outbox.stop()
 
     def _reminder_loop(self):
         """定時檢查並發送提醒的主循環"""
@@ -44,84 +99,110 @@ class ReminderHandler:
                 self._check_and_send_reminders()
                 time.sleep(self.check_interval)
             except Exception as e:
-                print(f"提醒處理器錯誤: {str(e)}")
+                logger.error("提醒處理器錯誤: %s", e)
 
     def _check_and_send_reminders(self):
-        """檢查並發送提醒"""
-        db = get_db()
-        db.row_factory = dict_factory
-        current_time = datetime.now(self.timezone)
-        
-        # 檢查行程
-        cursor = db.execute("""
-            SELECT user_id, title, scheduled_time, description, remind_before
-            FROM schedules 
-            WHERE reminded = 0 
-            AND datetime(scheduled_time, '-' || remind_before || ' minutes') <= datetime(?)
-            AND datetime(scheduled_time) >= datetime(?)
-        """, (
-            current_time.strftime('%Y-%m-%d %H:%M:%S'),
-            current_time.strftime('%Y-%m-%d %H:%M:%S')
-        ))
-        schedules = cursor.fetchall()
-
-        # 發送行程提醒
-        for schedule in schedules:
-            try:
-                scheduled_time = datetime.strptime(schedule['scheduled_time'], '%Y-%m-%d %H:%M:%S')
-                message = f"提醒：您在 {scheduled_time.strftime('%Y-%m-%d %H:%M')} 有一個行程\n標題：{schedule['title']}"
-                if schedule['description']:
-                    message += f"\n描述：{schedule['description']}"
-
-                self.messaging_api.push_message(
-                    PushMessageRequest(
-                        to=schedule['user_id'],
-                        messages=[TextMessage(text=message)]
-                    )
-                )
-
-                # 更新提醒狀態
-                db.execute(
-                    "UPDATE schedules SET reminded = 1 WHERE user_id = ? AND scheduled_time = ?",
-                    (schedule['user_id'], schedule['scheduled_time'])
-                )
-                db.commit()
-            except Exception as e:
-                print(f"發送提醒時出錯: {str(e)}")
-
-        # 檢查提醒
-        cursor = db.execute("""
-            SELECT user_id, content, remind_time 
-            FROM reminders 
-            WHERE reminded = 0 
-            AND datetime(remind_time) <= datetime(?)
-            AND datetime(remind_time) >= datetime(?)
-        """, (
-            current_time.strftime('%Y-%m-%d %H:%M:%S'),
-            current_time.strftime('%Y-%m-%d %H:%M:%S')
-        ))
-        reminders = cursor.fetchall()
-
-        # 發送一般提醒
-        for reminder in reminders:
-            try:
-                remind_time = datetime.strptime(reminder['remind_time'], '%Y-%m-%d %H:%M:%S')
-                message = f"提醒：{reminder['content']}"
-
-                self.messaging_api.push_message(
-                    PushMessageRequest(
-                        to=reminder['user_id'],
-                        messages=[TextMessage(text=message)]
-                    )
-                )
-
-                # 更新提醒狀態
-                db.execute(
-                    "UPDATE reminders SET reminded = 1 WHERE user_id = ? AND remind_time = ?",
-                    (reminder['user_id'], reminder['remind_time'])
-                )
-                db.commit()
-            except Exception as e:
-                print(f"發送提醒時出錯: {str(e)}")
+        """檢查到期的提醒：各分區平行把到期項目寫入 outbox，再由 outbox 發送"""
+        storage = get_storage()
+        current_time = timeutil.now()
+        pacer = _LatePacer(current_time)
+        queued = storage.map_partitions(lambda partition: self._scan_partition(storage, partition, current_time, pacer))
+        if sum(queued):
+            self.outbox.wake()
+
+    def _scan_partition(self, storage, partition, current_time, pacer):
+        """掃描單一分區，個別分區出錯不影響其他分區
+
+        掃描範圍從上一次完整掃描的進度 (checkpoint) 開始，因此停機或卡住期間到期的提醒
+        會在下一輪一起補發 (標示為延遲)；全部寫入 outbox 後才推進 checkpoint。
+        一般的提醒依用戶的勿擾時段延後並錯開發送時間，緊急的提醒直接發送。
+        Returns:
+            int: 寫入 outbox 的筆數
+        """
+        try:
+            on_time = current_time - timedelta(seconds=DUE_GRACE)
+            checkpoint = storage.get_scan_checkpoint(partition)
+            since = on_time if checkpoint is None else min(from_epoch(checkpoint), on_time)
+            since = max(since, current_time - timedelta(seconds=CATCHUP_LIMIT))
+
+            # 補發範圍之前就錯過的項目：重複的往後推到下一次，單次的不再發送
+            self._skip_missed(storage, partition, since)
+            queued, late, deferred, failed = 0, 0, 0, False
+            for row, remind_at, message in self._collect_due(storage, partition, since, current_time):
+                send_at = None
+                is_late = remind_at <= on_time
+                if is_late:
+                    message = f"（延遲通知，原定 {remind_at.strftime('%m-%d %H:%M')}）\n{message}"
+                    send_at = pacer.send_at(message)
+                    late += 1
+                if row['priority'] != PRIORITY_URGENT:
+                    send_at, is_quiet = delivery_time(send_at or current_time, message, row['quiet_start'], row['quiet_end'])
+                    if is_quiet:
+                        deferred += 1
+                        if not is_late:
+                            message = f"（勿擾時段後通知，原定 {remind_at.strftime('%H:%M')}）\n{message}"
+                try:
+                    queued += self._enqueue(storage, row, remind_at, message, send_at, current_time)
+                except Exception as e:
+                    failed = True
+                    logger.error("寫入 outbox 時出錯: %s", e, extra={'user_id': row['user_id'], 'table': row['source_table']})
+
+            stats_recorder.record(REMINDERS_QUEUED, queued)
+            stats_recorder.record(REMINDERS_LATE, late)
+            if late:
+                logger.warning("補發錯過的提醒", extra={
+                    'partition': partition, 'count': late, 'since': since.strftime('%Y-%m-%d %H:%M:%S'),
+                })
+            if deferred:
+                logger.info("提醒延到勿擾時段之後", extra={'partition': partition, 'count': deferred})
+            # 有項目寫入失敗時不推進，下一輪會再涵蓋到它
+            if not failed:
+                storage.set_scan_checkpoint(partition, current_time)
+            return queued
+        except Exception as e:
+            logger.exception("掃描分區提醒時出錯: %s", e, extra={'partition': partition})
+            return 0
+
+    def _collect_due(self, storage, partition, since, current_time):
+        """收集單一分區提醒時間落在 (since, current_time] 的待提醒項目
+        (行程的每個提前時間各是一個項目，一次查詢取出)
+        Returns:
+            list: (資料列, 提醒時間, 訊息內容) 的列表
+        """
+        items = []
+        for row in storage.get_due_items(partition, since, current_time):
+            if row['source_table'] == SCHEDULES:
+                scheduled_time = from_epoch(row['occurrence'])
+                message = f"提醒：您在 {scheduled_time.strftime('%Y-%m-%d %H:%M')} 有一個行程\n標題：{row['title']}"
+                if row['description']:
+                    message += f"\n描述：{row['description']}"
+            else:
+                message = f"提醒：{row['title']}"
+            items.append((row, from_epoch(row['fire_at']), message))
+        return items
+
+    def _enqueue(self, storage, row, remind_at, message, send_at, current_time):
+        """在同一個交易中寫入 outbox 並推進待提醒項目，兩者必定同時成功或失敗
+        (outbox 以提醒時間區分同一次發生的多個提前提醒)
+        """
+        with storage.unit_of_work(row['user_id']):
+            queued = storage.enqueue_outbox(row['user_id'], row['source_table'], row['source_id'], remind_at, message, send_at)
+            self._advance(storage, row, current_time)
+        return int(queued)
+
+    def _advance(self, storage, row, after):
+        """單次的項目提醒後移除；重複的項目移到提醒時間晚於 after 的下一次發生時間
+        (補發延遲的重複項目時，中間錯過的幾次不會再逐一補發)
+        """
+        next_time, next_rule = None, None
+        if row['rrule']:
+            after = after + timedelta(minutes=row['offset_minutes'])
+            next_time, next_rule = next_occurrence(row['rrule'], from_epoch(row['occurrence']), after)
+        storage.advance_due_item(row['user_id'], row['id'], next_time, next_rule)
+
+    def _skip_missed(self, storage, partition, since):
+        """處理提醒時間不晚於 since 的項目 (落在補發時間內的那一次會在同一輪被發送)"""
+        for row in storage.get_missed_due_items(partition, since):
+            self._advance(storage, row, since)
 
 reminder_handler = ReminderHandler()
@@ -0,0 +1,176 @@
+"""重新分片工具：把資料依 user_id 重新分配到新的分片數量
+
+用法：
+    python reshard.py --from 1 --to 4 --out resharded
+
+會在 --out 目錄下建立新的分片檔案，完成後停止服務、把檔案搬回專案目錄，
+再以新的 DB_SHARDS 啟動即可。原本的資料庫不會被修改。
+"""
+import argparse
+import os
+from collections import defaultdict
+
+from compaction import ensure_archive_tables
+from database import backfill_due_items, init_shard, migrate_epoch_timestamps, SCHEMA_VERSION, STATS_SHARD
+from logger import get_logger
+from sharding import DATABASE, connect, shard_index, shard_paths
+
+logger = get_logger(__name__)
+
+# 依序搬移的資料表 (主鍵為 user_id 的表直接覆蓋，其餘盡量保留原本的 id)
+TABLES = ['user_states', 'delivery_windows', 'digest_subscriptions', 'notes', 'schedules', 'reminders', 'due_items', 'outbox', 'schedules_archive', 'reminders_archive']
+# 以 (source_table, source_id) 參照行程與提醒的資料表，來源被重新配號時跟著改
+REFERENCING_TABLES = ('due_items', 'outbox')
+# 不屬於任何用戶的用量統計，合併到新的第一個分片 (database.STATS_SHARD)
+STATS_MERGE = {
+    'stats_hourly': '''INSERT INTO stats_hourly (bucket, metric, value) VALUES (?, ?, ?)
+        ON CONFLICT (bucket, metric) DO UPDATE SET value = value + excluded.value''',
+    'stats_members': 'INSERT OR IGNORE INTO stats_members (bucket, metric, member) VALUES (?, ?, ?)',
+}
+# 每次寫入的筆數
+BATCH_SIZE = 1000
+
+
+def _columns(db, table):
+    return [row['name'] for row in db.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def _table_exists(db, table):
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def _write_batch(target, table, columns, rows):
+    """寫入一批資料；id 在新分片已被使用時改由資料庫重新配號
+    Returns:
+        dict: {原本的 id: 新的 id}，只含重新配號的資料
+    """
+    names = ', '.join(columns)
+    placeholders = ', '.join('?' * len(columns))
+    if 'id' not in columns:
+        target.executemany(
+            f'INSERT OR REPLACE INTO {table} ({names}) VALUES ({placeholders})',
+            [tuple(row[column] for column in columns) for row in rows]
+        )
+        return {}
+
+    renumbered = {}
+    without_id = [column for column in columns if column != 'id']
+    for row in rows:
+        cursor = target.execute(
+            f'INSERT OR IGNORE INTO {table} ({names}) VALUES ({placeholders})',
+            tuple(row[column] for column in columns)
+        )
+        if cursor.rowcount == 0:
+            cursor = target.execute(
+                f"INSERT INTO {table} ({', '.join(without_id)}) VALUES ({', '.join('?' * len(without_id))})",
+                tuple(row[column] for column in without_id)
+            )
+            renumbered[row['id']] = cursor.lastrowid
+    return renumbered
+
+
+def reshard(source_shards, target_shards, out_dir):
+    """把 source_shards 個分片的資料重新分配到 out_dir 下的 target_shards 個分片
+    Returns:
+        dict: {資料表: {'copied': 筆數, 'renumbered': 重新配號筆數}}
+    """
+    sources = shard_paths(source_shards)
+    targets = shard_paths(target_shards, base=os.path.join(out_dir, DATABASE))
+    if set(map(os.path.abspath, sources)) & set(map(os.path.abspath, targets)):
+        raise ValueError("輸出目錄不能與目前的資料庫檔案相同")
+
+    os.makedirs(out_dir, exist_ok=True)
+    for path in targets:
+        init_shard(path)
+    target_dbs = [connect(path) for path in targets]
+    for target in target_dbs:
+        ensure_archive_tables(target)
+
+    report = defaultdict(lambda: {'copied': 0, 'renumbered': 0})
+    checkpoints = []
+    legacy = False
+    try:
+        for path in sources:
+            if not os.path.exists(path):
+                continue
+            source = connect(path)
+            # 這個來源分片中被重新配號的行程與提醒 {資料表: {原本的 id: 新的 id}}
+            new_ids = defaultdict(dict)
+            try:
+                if source.execute('PRAGMA user_version').fetchone()['user_version'] < SCHEMA_VERSION:
+                    legacy = True
+                if _table_exists(source, 'scanner_state'):
+                    row = source.execute("SELECT value FROM scanner_state WHERE name = 'checkpoint'").fetchone()
+                    if row:
+                        checkpoints.append(row['value'])
+                for table in TABLES:
+                    if not _table_exists(source, table):
+                        continue
+                    columns = [c for c in _columns(source, table) if c in _columns(target_dbs[0], table)]
+                    cursor = source.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+                    while True:
+                        rows = cursor.fetchmany(BATCH_SIZE)
+                        if not rows:
+                            break
+                        batches = defaultdict(list)
+                        for row in rows:
+                            if table in REFERENCING_TABLES and row['source_id'] in new_ids[row['source_table']]:
+                                row['source_id'] = new_ids[row['source_table']][row['source_id']]
+                            batches[shard_index(row['user_id'], target_shards)].append(row)
+                        for index, batch in batches.items():
+                            renumbered = _write_batch(target_dbs[index], table, columns, batch)
+                            new_ids[table].update(renumbered)
+                            report[table]['renumbered'] += len(renumbered)
+                        report[table]['copied'] += len(rows)
+                    for target in target_dbs:
+                        target.commit()
+                for table, statement in STATS_MERGE.items():
+                    if not _table_exists(source, table):
+                        continue
+                    columns = 'bucket, metric, value' if table == 'stats_hourly' else 'bucket, metric, member'
+                    cursor = source.execute(f"SELECT {columns} FROM {table}")
+                    while True:
+                        rows = cursor.fetchmany(BATCH_SIZE)
+                        if not rows:
+                            break
+                        target_dbs[STATS_SHARD].executemany(statement, [tuple(row.values()) for row in rows])
+                        report[table]['copied'] += len(rows)
+                    target_dbs[STATS_SHARD].commit()
+            finally:
+                source.close()
+
+        # 舊版資料庫的時間欄位仍是台北時間字串，原樣複製後在新分片上轉為 epoch 秒 (來源不做修改)；
+        # 再為還沒有待提醒項目的行程與提醒補上 due_items，掃描器才會繼續觸發既有的提醒
+        for target in target_dbs:
+            if legacy:
+                migrate_epoch_timestamps(target)
+            backfill_due_items(target)
+            target.commit()
+
+        # 提醒掃描進度沒有 user_id，新分片一律從最舊的進度開始，停機期間的提醒才不會漏掉
+        if checkpoints:
+            for target in target_dbs:
+                target.execute(
+                    "INSERT OR REPLACE INTO scanner_state (name, value) VALUES ('checkpoint', ?)", (min(checkpoints),)
+                )
+                target.commit()
+    finally:
+        for target in target_dbs:
+            target.close()
+
+    logger.info("重新分片完成", extra={'source_shards': source_shards, 'target_shards': target_shards})
+    return dict(report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="依 user_id 重新分配資料庫分片")
+    parser.add_argument('--from', dest='source', type=int, required=True, help="目前的分片數量")
+    parser.add_argument('--to', dest='target', type=int, required=True, help="新的分片數量")
+    parser.add_argument('--out', default='resharded', help="輸出目錄")
+    args = parser.parse_args()
+
+    for table, counts in reshard(args.source, args.target, args.out).items():
+        print(f"{table}: 複製 {counts['copied']} 筆，重新配號 {counts['renumbered']} 筆")
+    print(f"新的分片已寫入 {args.out}/，停止服務後搬回並設定 DB_SHARDS={args.target}")
@@ -1,57 +1,352 @@
-from linebot.models import (
-    RichMenu, RichMenuArea, RichMenuBounds, RichMenuSize,
-    PostbackAction, MessageAction, URIAction
-)
-from linebot import LineBotApi
+"""圖文選單的宣告與同步
+
+選單以 MENUS 宣告 (按鈕依 columns 由左到右、由上到下排成格狀)，
+sync_rich_menus() 依宣告內容與圖片的雜湊值決定要沿用或建立哪些選單：
+內容沒變時不會重新建立或上傳圖片，不再使用的選單與別名會被刪除，
+重複部署不會一直累積新的選單。
+
+用戶也可以個別切換到其他選單 (例如「行程模式」)：menu_switcher.switch()
+把請求累積起來，每隔 LINK_INTERVAL 秒以 bulk link API 一次連結多位用戶。
+"""
+import hashlib
+import json
 import os
+import threading
+import time
+
 from dotenv import load_dotenv
+from logger import get_logger
 
 load_dotenv()
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-
-def create_rich_menu():
-    # 創建圖文選單
-    rich_menu_to_create = RichMenu(
-        size=RichMenuSize(width=2500, height=1686),
-        selected=True,
-        name="Nice rich menu",
-        chat_bar_text="點擊開啟選單",
-        areas=[
-            RichMenuArea(
-                bounds=RichMenuBounds(x=0, y=0, width=833, height=843),
-                action=PostbackAction(label='記事', data='action=note')
-            ),
-            RichMenuArea(
-                bounds=RichMenuBounds(x=833, y=0, width=833, height=843),
-                action=PostbackAction(label='行程', data='action=schedule')
-            ),
-            RichMenuArea(
-                bounds=RichMenuBounds(x=1666, y=0, width=833, height=843),
-                action=PostbackAction(label='提醒', data='action=reminder')
-            ),
-            RichMenuArea(
-                bounds=RichMenuBounds(x=0, y=843, width=833, height=843),
-                action=PostbackAction(label='查看記事', data='action=view_notes')
-            ),
-            RichMenuArea(
-                bounds=RichMenuBounds(x=833, y=843, width=833, height=843),
-                action=PostbackAction(label='查看行程', data='action=view_schedules')
-            ),
-            RichMenuArea(
-                bounds=RichMenuBounds(x=1666, y=843, width=833, height=843),
-                action=PostbackAction(label='查看提醒', data='action=view_reminders')
+
+logger = get_logger(__name__)
+
+# LINE 圖文選單的尺寸
+MENU_WIDTH = 2500
+MENU_HEIGHT = 1686
+# bulk link / unlink 一次最多 500 位用戶
+LINK_BATCH = 500
+# 切換選單的請求累積多久後一起送出 (秒)
+LINK_INTERVAL = 2
+# 選單圖片所在的目錄
+MENU_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 選單別名 (同時作為 LINE 的 rich menu alias ID)
+MAIN_MENU = 'main'
+SCHEDULE_MENU = 'schedule-mode'
+
+# 用戶輸入這些文字時切換選單
+MENU_COMMANDS = {'行程模式': SCHEDULE_MENU, '主選單': MAIN_MENU}
+
+# 按鈕的動作：data 為 postback，text 為送出文字訊息，switch 為切換到另一個選單別名
+MENUS = [
+    {
+        'alias': MAIN_MENU,
+        'default': True,
+        'chat_bar_text': '點擊開啟選單',
+        'image': 'rich_menu_image.png',
+        'columns': 3,
+        'buttons': [
+            {'label': '記事', 'data': 'action=note'},
+            {'label': '行程', 'data': 'action=schedule'},
+            {'label': '提醒', 'data': 'action=reminder'},
+            {'label': '查看記事', 'data': 'action=view_notes'},
+            {'label': '查看行程', 'data': 'action=view_schedules'},
+            {'label': '查看提醒', 'data': 'action=view_reminders'},
+        ],
+    },
+    {
+        'alias': SCHEDULE_MENU,
+        'chat_bar_text': '行程模式',
+        'image': 'rich_menu_schedule.png',
+        'columns': 3,
+        'buttons': [
+            {'label': '新增行程', 'data': 'action=schedule'},
+            {'label': '查看行程', 'data': 'action=view_schedules'},
+            {'label': '今日摘要', 'text': '今天有什麼行程'},
+            {'label': '新增提醒', 'data': 'action=reminder'},
+            {'label': '勿擾時段', 'text': '勿擾'},
+            {'label': '返回主選單', 'switch': MAIN_MENU},
+        ],
+    },
+]
+
+
+def button_bounds(menu):
+    """依格狀排列算出每個按鈕的範圍，最後一欄與最後一列補足除不盡的像素
+    Returns:
+        list: [(按鈕, (x, y, 寬, 高))]
+    """
+    columns = menu['columns']
+    rows = -(-len(menu['buttons']) // columns)
+    width, height = MENU_WIDTH // columns, MENU_HEIGHT // rows
+    bounds = []
+    for i, button in enumerate(menu['buttons']):
+        row, col = divmod(i, columns)
+        x, y = col * width, row * height
+        w = MENU_WIDTH - x if col == columns - 1 else width
+        h = MENU_HEIGHT - y if row == rows - 1 else height
+        bounds.append((button, (x, y, w, h)))
+    return bounds
+
+
+def _action(button):
+    if 'switch' in button:
+        return {'type': 'richmenuswitch', 'label': button['label'],
+                'richMenuAliasId': button['switch'], 'data': f"action=menu&menu={button['switch']}"}
+    if 'text' in button:
+        return {'type': 'message', 'label': button['label'], 'text': button['text']}
+    return {'type': 'postback', 'label': button['label'], 'data': button['data']}
+
+
+def menu_definition(menu):
+    """選單宣告轉為 LINE API 的 rich menu 物件 (不含 name)"""
+    return {
+        'size': {'width': MENU_WIDTH, 'height': MENU_HEIGHT},
+        'selected': True,
+        'chatBarText': menu['chat_bar_text'],
+        'areas': [
+            {'bounds': {'x': x, 'y': y, 'width': w, 'height': h}, 'action': _action(button)}
+            for button, (x, y, w, h) in button_bounds(menu)
+        ],
+    }
+
+
+def menu_name(menu, image):
+    """選單名稱帶有定義與圖片的雜湊值，內容相同的選單名稱也相同"""
+    digest = hashlib.sha256(json.dumps(menu_definition(menu), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    digest.update(image)
+    return f"{menu['alias']}#{digest.hexdigest()[:16]}"
+
+
+def _content_type(image):
+    """依檔案內容判斷格式 (create_menu_image 壓縮不到 1 MB 時會改存 JPEG，檔名不變)"""
+    return 'image/png' if image.startswith(b'\x89PNG') else 'image/jpeg'
+
+
+class RichMenuClient:
+    """LINE 圖文選單 API，第一次使用時才載入 SDK (上傳圖片的 data API 由 SDK 固定連到 api-data.line.me)"""
+
+    def __init__(self):
+        self._api = None
+        self._blob_api = None
+        self._lock = threading.Lock()
+
+    def _api_client(self):
+        from linebot.v3.messaging import ApiClient, Configuration
+        return ApiClient(Configuration(
+            host=os.getenv('LINE_API_HOST', 'https://api.line.me'),
+            access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN'),
+        ))
+
+    @property
+    def api(self):
+        if self._api is None:
+            with self._lock:
+                if self._api is None:
+                    from linebot.v3.messaging import MessagingApi
+                    self._api = MessagingApi(self._api_client())
+        return self._api
+
+    @property
+    def blob_api(self):
+        if self._blob_api is None:
+            with self._lock:
+                if self._blob_api is None:
+                    from linebot.v3.messaging import MessagingApiBlob
+                    self._blob_api = MessagingApiBlob(self._api_client())
+        return self._blob_api
+
+
+rich_menu_client = RichMenuClient()
+
+
+def sync_rich_menus(menus=MENUS, menu_dir=MENU_DIR, dry_run=False, client=rich_menu_client):
+    """讓頻道上的圖文選單與 menus 的宣告一致 (可重複執行)
+
+    名稱 (含雜湊值) 相同的選單直接沿用，否則建立新選單並上傳圖片；
+    接著更新別名與預設選單，最後刪除不在宣告中的選單與別名。
+    Returns:
+        dict: {'created': [...], 'reused': [...], 'deleted': [...], 'aliases': [...], 'default': 選單 ID}
+    """
+    from linebot.v3.messaging import CreateRichMenuAliasRequest, RichMenuRequest, UpdateRichMenuAliasRequest
+    api = client.api
+    report = {'created': [], 'reused': [], 'deleted': [], 'aliases': [], 'default': None}
+
+    # 先確認所有圖片都在，避免同步到一半才失敗
+    images = {}
+    for menu in menus:
+        path = os.path.join(menu_dir, menu['image'])
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"找不到選單圖片 {path}，請先執行 python create_menu_image.py")
+        with open(path, 'rb') as f:
+            images[menu['alias']] = f.read()
+
+    existing = {menu.name: menu.rich_menu_id for menu in api.get_rich_menu_list().richmenus}
+    menu_ids = {}
+    for menu in menus:
+        image = images[menu['alias']]
+        name = menu_name(menu, image)
+        if name in existing:
+            menu_ids[menu['alias']] = existing[name]
+            report['reused'].append(name)
+            continue
+        report['created'].append(name)
+        if dry_run:
+            menu_ids[menu['alias']] = None
+            continue
+        rich_menu_id = api.create_rich_menu(RichMenuRequest.from_dict({**menu_definition(menu), 'name': name})).rich_menu_id
+        client.blob_api.set_rich_menu_image(rich_menu_id, body=image, _headers={'Content-Type': _content_type(image)})
+        menu_ids[menu['alias']] = rich_menu_id
+        logger.info("已建立圖文選單", extra={'menu': name, 'rich_menu_id': rich_menu_id})
+
+    aliases = {alias.rich_menu_alias_id: alias.rich_menu_id for alias in api.get_rich_menu_alias_list().aliases}
+    for alias, rich_menu_id in menu_ids.items():
+        if aliases.get(alias) == rich_menu_id and rich_menu_id is not None:
+            continue
+        report['aliases'].append(alias)
+        if dry_run:
+            continue
+        if alias in aliases:
+            api.update_rich_menu_alias(alias, UpdateRichMenuAliasRequest(richMenuId=rich_menu_id))
+        else:
+            api.create_rich_menu_alias(CreateRichMenuAliasRequest(richMenuAliasId=alias, richMenuId=rich_menu_id))
+
+    default = next((menu['alias'] for menu in menus if menu.get('default')), None)
+    if default:
+        report['default'] = menu_ids[default]
+        try:
+            current_default = api.get_default_rich_menu_id().rich_menu_id
+        except Exception as e:
+            # 尚未設定預設選單時 LINE 回應 404
+            if getattr(e, 'status', None) != 404:
+                raise
+            current_default = None
+        if current_default != menu_ids[default] and not dry_run:
+            api.set_default_rich_menu(menu_ids[default])
+
+    # 先把別名與預設選單指到新選單，才能刪除舊的
+    wanted = set(menu_ids.values())
+    for alias, rich_menu_id in aliases.items():
+        if alias not in menu_ids and rich_menu_id not in wanted and not dry_run:
+            api.delete_rich_menu_alias(alias)
+    for name, rich_menu_id in existing.items():
+        if rich_menu_id in wanted:
+            continue
+        report['deleted'].append(name)
+        if not dry_run:
+            api.delete_rich_menu(rich_menu_id)
+
+    logger.info("圖文選單同步完成", extra={
+        'created_menus': len(report['created']), 'reused_menus': len(report['reused']),
+        'deleted_menus': len(report['deleted']), 'default_menu': report['default'],
+    })
+    return report
+
+
+class MenuSwitcher:
+    """為個別用戶切換圖文選單：請求先累積起來，再依選單分組以 bulk API 一次送出
+
+    切換到預設選單時改為解除個別連結，讓用戶回到預設選單 (預設選單更新後也會跟著變)。
+    同一位用戶在送出前多次切換時只保留最後一次。
+    """
+
+    def __init__(self, interval=LINK_INTERVAL, client=rich_menu_client, menus=MENUS):
+        self.interval = interval
+        self.client = client
+        self.default_alias = next((menu['alias'] for menu in menus if menu.get('default')), None)
+        self.thread = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._menu_ids = {}
+
+    def switch(self, user_id, alias):
+        """排入切換請求，稍後與其他用戶一起送出"""
+        with self._lock:
+            self._pending[user_id] = alias
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait()
+            # 等一小段時間，讓同時間的切換請求合併成一次呼叫
+            time.sleep(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("切換圖文選單時出錯: %s", e)
+
+    def _menu_id(self, alias):
+        if alias not in self._menu_ids:
+            self._menu_ids[alias] = self.client.api.get_rich_menu_alias(alias).rich_menu_id
+        return self._menu_ids[alias]
+
+    def flush(self):
+        """送出所有排入的切換請求，暫時失敗的用戶留到下一次
+        Returns:
+            int: 成功切換的用戶數
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        groups = {}
+        for user_id, alias in pending.items():
+            groups.setdefault(alias, []).append(user_id)
+
+        switched = 0
+        for alias, user_ids in groups.items():
+            count, retry = self.link(alias, user_ids)
+            switched += count
+            if retry:
+                with self._lock:
+                    for user_id in retry:
+                        self._pending.setdefault(user_id, alias)
+                self._wake.set()
+        if switched:
+            logger.info("已切換圖文選單", extra={'count': switched, 'menus': len(groups)})
+        return switched
+
+    def link(self, alias, user_ids):
+        """立即把用戶切換到 alias，每 LINK_BATCH 位用戶呼叫一次 bulk API
+        Returns:
+            tuple: (成功切換的用戶數, 暫時失敗、可以重試的用戶)
+        """
+        from outbox import is_permanent
+        switched, retry = 0, []
+        for i in range(0, len(user_ids), LINK_BATCH):
+            batch = user_ids[i:i + LINK_BATCH]
+            try:
+                try:
+                    self._link_batch(alias, batch)
+                except Exception as e:
+                    # 快取的選單 ID 可能已在重新同步時刪除 (找不到或無效的選單)：重新查詢別名後再試一次
+                    if alias == self.default_alias or not is_permanent(e):
+                        raise
+                    self._menu_ids.pop(alias, None)
+                    self._link_batch(alias, batch)
+                switched += len(batch)
+            except Exception as e:
+                # 選單可能已被重新同步，下次重新查詢別名
+                self._menu_ids.pop(alias, None)
+                if is_permanent(e):
+                    logger.error("切換圖文選單失敗: %s", e, extra={'alias': alias, 'count': len(batch)})
+                else:
+                    logger.warning("切換圖文選單失敗，稍後重試: %s", e, extra={'alias': alias, 'count': len(batch)})
+                    retry.extend(batch)
+        return switched, retry
+
+    def _link_batch(self, alias, batch):
+        """以一次 bulk API 把一批用戶連結到 alias (預設選單改為解除個別連結)"""
+        from linebot.v3.messaging import RichMenuBulkLinkRequest, RichMenuBulkUnlinkRequest
+        if alias == self.default_alias:
+            self.client.api.unlink_rich_menu_id_from_users(RichMenuBulkUnlinkRequest(userIds=batch))
+        else:
+            self.client.api.link_rich_menu_id_to_users(
+                RichMenuBulkLinkRequest(richMenuId=self._menu_id(alias), userIds=batch)
             )
-        ]
-    )
-    
-    # 創建圖文選單
-    rich_menu_id = line_bot_api.create_rich_menu(rich_menu=rich_menu_to_create)
-    
-    # 上傳圖文選單圖片
-    with open("rich_menu_image.png", 'rb') as f:
-        line_bot_api.set_rich_menu_image(rich_menu_id, "image/png", f)
-    
-    # 將圖文選單設為預設
-    line_bot_api.set_default_rich_menu(rich_menu_id)
-    
-    return rich_menu_id
+
+menu_switcher = MenuSwitcher()
@@ -1,18 +1,47 @@
-from rich_menu import create_rich_menu
-from create_menu_image import create_rich_menu_image
+"""同步圖文選單 (可重複執行，內容沒變時不會重新建立)
+
+用法:
+    python setup_rich_menu.py                          # 產生選單圖片 (沒有變更時沿用) 並依 rich_menu.MENUS 同步
+    python setup_rich_menu.py --dry-run                # 只列出會做的變更
+    python setup_rich_menu.py link schedule-mode U1 U2 # 把用戶切換到指定的選單別名
+"""
+import argparse
+
+from create_menu_image import render_menu_images
+from rich_menu import MenuSwitcher, sync_rich_menus
+
 
 def main():
-    print("開始設置圖文選單...")
-    
-    # 1. 創建圖文選單圖片
-    print("正在創建圖文選單圖片...")
-    # create_rich_menu_image()
-    print("圖文選單圖片已創建")
-    
-    # 2. 創建並設置圖文選單
-    print("正在設置圖文選單...")
-    rich_menu_id = create_rich_menu()
-    print(f"圖文選單已設置完成！ID: {rich_menu_id}")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help="只列出會做的變更")
+    parser.add_argument('--skip-images', action='store_true', help="不產生選單圖片，直接使用現有的檔案")
+    subparsers = parser.add_subparsers(dest='command')
+    link = subparsers.add_parser('link', help="把用戶切換到指定的選單別名")
+    link.add_argument('alias')
+    link.add_argument('user_ids', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'link':
+        switched, failed = MenuSwitcher().link(args.alias, args.user_ids)
+        print(f"已切換 {switched} 位用戶到 {args.alias}" + (f"，{len(failed)} 位失敗" if failed else ""))
+        return
+
+    if not args.skip_images:
+        for path, result in render_menu_images().items():
+            print(f"{'沿用圖片' if result == 'cached' else '已產生圖片'}: {path}")
+
+    print("正在同步圖文選單...")
+    report = sync_rich_menus(dry_run=args.dry_run)
+    for name in report['reused']:
+        print(f"沿用: {name}")
+    for name in report['created']:
+        print(f"建立: {name}")
+    for name in report['deleted']:
+        print(f"刪除: {name}")
+    if report['aliases']:
+        print(f"更新別名: {', '.join(report['aliases'])}")
+    print(f"預設選單: {report['default']}" + (" (未實際變更)" if args.dry_run else ""))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from group_commit import group_committer
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+DATABASE = 'line_bot.db'
+# 分片數量，1 表示只使用 line_bot.db 單一檔案
+DB_SHARDS = int(os.getenv('DB_SHARDS', '1'))
+# 等待其他連線釋放寫入鎖的秒數
+BUSY_TIMEOUT = 10
+# 提交的持久性：
+#   full   每次提交都 fsync (預設)
+#   group  提交後等待群組提交執行緒 fsync，同一時間窗內的提交共用一次 fsync，持久性與 full 相同
+#   normal 提交不等待 fsync，斷電時可能遺失最後幾筆交易，但資料庫不會損毀
+DB_DURABILITY = os.getenv('DB_DURABILITY', 'full')
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def dict_factory(cursor, row):
+    """將資料庫查詢結果轉換為字典格式"""
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+def shard_index(user_id, shards=None):
+    """依 user_id 的雜湊值決定所在的分片"""
+    shards = shards or DB_SHARDS
+    if shards == 1:
+        return 0
+    return zlib.crc32(user_id.encode('utf-8')) % shards
+
+
+def shard_path(index, shards=None, base=DATABASE):
+    """分片的資料庫檔案路徑，例如 line_bot.shard0.db；只有一個分片時沿用 line_bot.db"""
+    shards = shards or DB_SHARDS
+    if shards == 1:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{index}{ext}"
+
+
+def shard_paths(shards=None, base=DATABASE):
+    """所有分片的資料庫檔案路徑"""
+    shards = shards or DB_SHARDS
+    return [shard_path(index, shards, base) for index in range(shards)]
+
+
+class ShardConnection(sqlite3.Connection):
+    """分片的資料庫連接，支援工作單元與群組提交"""
+
+    def __init__(self, path, *args, **kwargs):
+        super().__init__(path, *args, **kwargs)
+        self.path = path
+        # 巢狀工作單元的層數，大於 0 時 commit() 延到最外層工作單元結束才執行
+        self.unit_depth = 0
+        # 交易提交後才執行的工作 (例如更新記憶體內的索引)，回滾時捨棄
+        self.after_commit = []
+
+    def on_commit(self, callback):
+        """登記在目前的交易提交後執行的工作 (工作單元中則等到最外層提交)"""
+        self.after_commit.append(callback)
+
+    def commit(self):
+        if self.unit_depth:
+            return
+        super().commit()
+        if DB_DURABILITY == 'group':
+            group_committer.wait(self.path)
+        callbacks, self.after_commit = self.after_commit, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("提交後的工作執行失敗: %s", e)
+
+    def rollback(self):
+        self.after_commit = []
+        super().rollback()
+
+
+def connect(path):
+    """開啟資料庫連接"""
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, factory=ShardConnection)
+    db.row_factory = dict_factory
+    if DB_DURABILITY != 'full':
+        # WAL 模式下 NORMAL 只在 checkpoint 時 fsync，提交的 fsync 交給群組提交執行緒
+        db.execute('PRAGMA synchronous = NORMAL')
+    return db
+
+
+def get_connection(index=0):
+    """取得目前執行緒在指定分片上的連接 (每個執行緒、每個分片各一個)"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if index not in connections:
+        connections[index] = connect(shard_path(index))
+    return connections[index]
+
+
+def connection_for(user_id):
+    """取得用戶所在分片的連接"""
+    return get_connection(shard_index(user_id))
+
+
+def close_connections():
+    """關閉目前執行緒的所有分片連接"""
+    connections = getattr(_local, 'connections', None)
+    if connections:
+        for db in connections.values():
+            db.close()
+        connections.clear()
+
+
+def map_shards(func):
+    """對每個分片平行執行 func(index)，回傳各分片的結果列表"""
+    global _executor
+    if DB_SHARDS == 1:
+        return [func(0)]
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DB_SHARDS, thread_name_prefix='shard')
+    return list(_executor.map(func, range(DB_SHARDS)))
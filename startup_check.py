@@ -0,0 +1,110 @@
+"""啟動時間檢查
+
+以 `python -X importtime` 量測 import line_bot 的時間 (多次量測取中位數)，並確認 import 時沒有載入
+LINE / Gemini SDK；接著量測 create_app() 與背景預熱 SDK 各花多少時間。
+
+用法:
+    python startup_check.py                 # 預設預算: 扣除 Flask 後 60ms
+    python startup_check.py --budget-ms 40
+    python startup_check.py --runs 11
+"""
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# import line_bot 時不應載入的重量級套件
+HEAVY_MODULES = ('linebot', 'google.generativeai', 'google.ai', 'grpc', 'numpy', 'psycopg2')
+
+# 在全新的直譯器內建立應用程式，量測 create_app()、第一個請求與背景預熱 SDK 完成的時間
+FACTORY_SCRIPT = """
+import time
+start = time.perf_counter()
+import line_bot
+imported = time.perf_counter()
+app = line_bot.create_app()
+created = time.perf_counter()
+assert app.test_client().get('/').status_code == 200
+served = time.perf_counter()
+line_bot.warm_up()
+warmed = time.perf_counter()
+print(f"{(imported - start) * 1000:.1f} {(created - imported) * 1000:.1f} "
+      f"{(served - created) * 1000:.1f} {(warmed - created) * 1000:.1f}")
+"""
+
+
+def run(args, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT, LINE_CHANNEL_ACCESS_TOKEN='x', LINE_CHANNEL_SECRET='x')
+    return subprocess.run(
+        [sys.executable] + args, cwd=cwd, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def import_times(module, cwd):
+    """解析 -X importtime 輸出，回傳 {模組: 累計微秒}"""
+    result = run(['-X', 'importtime', '-c', f'import {module}'], cwd)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def median_of(module, cwd, runs):
+    """取多次量測的中位數 (以扣除 Flask 後的時間排序)，降低磁碟快取與排程的雜訊"""
+    samples = sorted(
+        (import_times(module, cwd) for _ in range(runs)),
+        key=lambda times: times[module] - times.get('flask', 0),
+    )
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=60,
+                        help='import line_bot 扣除 Flask 本身後允許的毫秒數')
+    parser.add_argument('--runs', type=int, default=7, help='量測次數，取中位數')
+    args = parser.parse_args()
+
+    # 先編譯 .pyc：剛修改過的模組在 PYTHONDONTWRITEBYTECODE 下每次 import 都會重新編譯，與部署後的狀態不同
+    compileall.compile_dir(ROOT, maxlevels=0, quiet=1)
+    with tempfile.TemporaryDirectory() as workdir:
+        times = median_of('line_bot', workdir, args.runs)
+        flask = times['flask']
+        total = times['line_bot']
+        own = total - flask
+
+        print(f"import line_bot: {total / 1000:.1f}ms (Flask {flask / 1000:.1f}ms，其餘 {own / 1000:.1f}ms)")
+        top = sorted(
+            ((cumulative, name) for name, cumulative in times.items() if '.' not in name),
+            reverse=True,
+        )[1:9]
+        for cumulative, name in top:
+            print(f"  {name:<24} {cumulative / 1000:7.1f}ms")
+
+        failures = []
+        heavy = sorted(
+            name for name in times
+            if any(name == module or name.startswith(module + '.') for module in HEAVY_MODULES)
+        )
+        if heavy:
+            failures.append(f"import 時載入了重量級套件: {', '.join(heavy[:5])}")
+        if own / 1000 > args.budget_ms:
+            failures.append(f"超出預算: {own / 1000:.1f}ms > {args.budget_ms:.0f}ms")
+
+        imported, created, served, warmed = run(['-c', FACTORY_SCRIPT], workdir).stdout.split()
+        print(f"create_app(): {created}ms，第一個請求 {served}ms，背景預熱 SDK 於 {warmed}ms 後完成 (不阻塞 worker)")
+
+    for failure in failures:
+        print(f"失敗: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
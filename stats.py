@@ -0,0 +1,188 @@
+"""用量統計的每小時彙總 (rollup)
+
+處理函式與背景排程以 stats_recorder.record() / record_active() 在記憶體中累加，背景執行緒每 STATS_FLUSH_INTERVAL 秒
+把增量以 UPSERT 寫入 stats_hourly，一次交易只有幾十列，不必每則訊息都寫入資料庫。多個 worker 各自累加再寫入，
+計數會正確相加。活躍用戶 (不重複人數) 先在程序內去重，再由 stats_members 跨 worker 去重，只有第一次出現的用戶讓計數加一。
+
+/admin/stats 只讀取 stats_hourly，不會查詢筆記、行程等熱資料表。
+"""
+import atexit
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from logger import get_logger
+from storage import get_storage
+from timeutil import from_epoch, day_range, TIMEZONE
+import timeutil
+
+logger = get_logger(__name__)
+
+# 寫入彙總表的間隔 (秒)；程序異常結束時最多遺失這段時間的計數
+STATS_FLUSH_INTERVAL = int(os.getenv('STATS_FLUSH_INTERVAL', '10'))
+# 去重成員保留天數 (需涵蓋一整天，當天的活躍用戶才不會重複計算)
+STATS_MEMBER_RETENTION_DAYS = 2
+# /admin/stats 一次最多查詢的天數
+STATS_MAX_DAYS = 92
+
+HOUR = 3600
+
+# 指標
+MESSAGES = 'messages'                        # 文字訊息
+ATTACHMENTS = 'attachments'                  # 圖片與檔案訊息
+POSTBACKS = 'postbacks'                      # 按鈕與選單的 postback
+AI_CALLS = 'ai_calls'                        # Gemini 呼叫次數
+AI_ERRORS = 'ai_errors'                      # Gemini 呼叫失敗次數
+REMINDERS_QUEUED = 'reminders_queued'        # 掃描後寫入 outbox 的提醒
+REMINDERS_LATE = 'reminders_late'            # 其中補發的延遲提醒
+REMINDERS_SENT = 'reminders_sent'            # outbox 推播成功
+REMINDERS_RETRIED = 'reminders_retried'      # outbox 推播失敗，稍後重試
+REMINDERS_DEAD = 'reminders_dead'            # outbox 推播失敗，不再重試
+DIGESTS_SENT = 'digests_sent'                # 每日摘要推播成功
+ACTIVE_USERS = 'active_users'                # 每小時的不重複用戶
+DAILY_ACTIVE_USERS = 'daily_active_users'    # 每天的不重複用戶 (bucket 為當天開始的時間)
+
+# 不重複人數不能跨時段相加
+DISTINCT_METRICS = (ACTIVE_USERS, DAILY_ACTIVE_USERS)
+GRANULARITIES = ('hour', 'day')
+
+
+def hour_bucket(epoch):
+    """epoch 所在整點的開始時間 (台北時區與 UTC 相差整數小時，直接取整即可)"""
+    return epoch - epoch % HOUR
+
+
+def day_bucket(epoch):
+    """epoch 所在那一天 (台北時間) 的開始時間"""
+    return day_range(from_epoch(epoch).date())[0]
+
+
+def summarize(rows, granularity='hour'):
+    """把 get_stats 的結果整理為各指標的時間序列
+    granularity 為 'day' 時每小時的計數加總到當天，每小時的活躍用戶不能相加，改看 DAILY_ACTIVE_USERS
+    Returns:
+        dict: {'series': {metric: [{'at': ISO 時間, 'value'}]}, 'totals': {metric: 總和}} (totals 不含不重複人數)
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"不支援的時間單位: {granularity}")
+    buckets = {}
+    for row in rows:
+        metric, bucket = row['metric'], row['bucket']
+        if granularity == 'day':
+            if metric == ACTIVE_USERS:
+                continue
+            bucket = day_bucket(bucket)
+        values = buckets.setdefault(metric, {})
+        values[bucket] = values.get(bucket, 0) + row['value']
+
+    series, totals = {}, {}
+    for metric in sorted(buckets):
+        values = buckets[metric]
+        series[metric] = [
+            {'at': datetime.fromtimestamp(bucket, TIMEZONE).isoformat(), 'value': value}
+            for bucket, value in sorted(values.items())
+        ]
+        if metric not in DISTINCT_METRICS:
+            totals[metric] = sum(values.values())
+    return {'series': series, 'totals': totals}
+
+
+class StatsRecorder:
+    """在記憶體中累加計數，定期寫入彙總表"""
+
+    def __init__(self, interval=STATS_FLUSH_INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        self._members = []
+        # 本程序已記錄過的活躍用戶 {(bucket, metric): {user_id}}，同一時段只寫入一次
+        self._seen = {}
+        self._last_purge = None
+        self._atexit = False
+
+    def record(self, metric, count=1, at=None):
+        """把 metric 在 at (epoch 秒，預設現在) 那個小時的計數加 count"""
+        if not count:
+            return
+        bucket = hour_bucket(timeutil.now_epoch() if at is None else at)
+        with self._lock:
+            self._counters[(bucket, metric)] += count
+
+    def record_active(self, user_id, at=None):
+        """記錄用戶在這個小時與這一天有活動"""
+        at = timeutil.now_epoch() if at is None else at
+        keys = ((hour_bucket(at), ACTIVE_USERS), (day_bucket(at), DAILY_ACTIVE_USERS))
+        with self._lock:
+            for key in keys:
+                seen = self._seen.setdefault(key, set())
+                if user_id not in seen:
+                    seen.add(user_id)
+                    self._members.append((*key, user_id))
+
+    def start(self):
+        """啟動寫入執行緒；程序結束前會寫入最後一批"""
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+            if not self._atexit:
+                atexit.register(self.stop)
+                self._atexit = True
+
+    def stop(self):
+        """停止寫入執行緒並寫入尚未寫入的計數"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("寫入用量統計時出錯: %s", e)
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.flush()
+                self._purge()
+            except Exception as e:
+                logger.exception("寫入用量統計時出錯: %s", e)
+
+    def flush(self):
+        """把累加的計數寫入彙總表，失敗時放回下次再寫
+        Returns:
+            int: 寫入的計數與成員筆數
+        """
+        now = timeutil.now_epoch()
+        current = {ACTIVE_USERS: hour_bucket(now), DAILY_ACTIVE_USERS: day_bucket(now)}
+        with self._lock:
+            counters, members = self._counters, self._members
+            self._counters, self._members = Counter(), []
+            # 只保留目前時段的去重記錄
+            self._seen = {key: users for key, users in self._seen.items() if key[0] >= current[key[1]]}
+        if not counters and not members:
+            return 0
+        try:
+            get_storage().add_stats(counters, members)
+        except Exception:
+            with self._lock:
+                self._counters.update(counters)
+                self._members.extend(members)
+            raise
+        return len(counters) + len(members)
+
+    def _purge(self):
+        """每小時清除一次保留期限外的去重成員"""
+        now = timeutil.now()
+        if self._last_purge and now - self._last_purge < timedelta(hours=1):
+            return
+        self._last_purge = now
+        purged = get_storage().purge_stats_members(now - timedelta(days=STATS_MEMBER_RETENTION_DAYS))
+        if purged:
+            logger.info("已清除舊的活躍用戶記錄", extra={'count': purged})
+
+
+stats_recorder = StatsRecorder()
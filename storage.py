@@ -0,0 +1,292 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+
+# 設定為 postgresql://... 時使用 PostgreSQL，否則使用本機 SQLite 分片
+DATABASE_URL = os.getenv('DATABASE_URL', '')
+
+# 待提醒項目 (due_items) 的來源資料表與其時間欄位
+SCHEDULES = 'schedules'
+REMINDERS = 'reminders'
+TIME_COLUMNS = {SCHEDULES: 'scheduled_time', REMINDERS: 'remind_time'}
+NOTES = 'notes'
+
+# 匯出/匯入的欄位 (不含 user_id)；匯出依 EXPORT_ORDER, id 排序，剛好走各表的 (user_id, 時間) 索引不需額外排序
+EXPORT_COLUMNS = {
+    NOTES: ('id', 'content', 'created_at'),
+    SCHEDULES: ('id', 'title', 'description', 'scheduled_time', 'remind_before', 'rrule', 'priority', 'created_at'),
+    REMINDERS: ('id', 'content', 'remind_time', 'rrule', 'priority', 'is_done', 'created_at'),
+}
+EXPORT_ORDER = {NOTES: 'created_at', **TIME_COLUMNS}
+# 匯入時寫入的欄位：不沿用原本的 id，reminded 由匯入端依時間決定 (已過去的單次項目不再提醒)
+IMPORT_COLUMNS = {
+    NOTES: ('content', 'created_at'),
+    SCHEDULES: ('title', 'description', 'scheduled_time', 'remind_before', 'rrule', 'priority', 'created_at', 'reminded'),
+    REMINDERS: ('content', 'remind_time', 'rrule', 'priority', 'is_done', 'created_at', 'reminded'),
+}
+# 匯出時伺服器端游標每次取回的筆數
+EXPORT_BATCH = 500
+
+# 提醒的優先順序：一般的提醒可以延到勿擾時段之後並錯開發送，緊急的一律準時
+PRIORITY_NORMAL = 0
+PRIORITY_URGENT = 1
+
+# 推播佇列 (outbox) 的狀態
+OUTBOX_PENDING = 'pending'
+OUTBOX_SENDING = 'sending'   # 已被某個發送執行緒領取，租約到期前其他程序不會再領取
+OUTBOX_SENT = 'sent'
+OUTBOX_DEAD = 'dead'
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def remind_offsets(remind_before):
+    """把 add_schedule 的 remind_before (分鐘數或其列表) 整理為不重複、由大到小的提前分鐘數"""
+    if remind_before is None:
+        return [0]
+    if isinstance(remind_before, int):
+        remind_before = [remind_before]
+    return sorted({max(int(minutes), 0) for minutes in remind_before}, reverse=True) or [0]
+
+
+class Storage(ABC):
+    """資料存取介面，SQLite 與 PostgreSQL 後端都實作這組方法
+
+    時間欄位一律以 UTC epoch 秒 (整數) 回傳 (以 timeutil 轉換)，查詢結果為 dict，
+    讓呼叫端不需要知道實際使用的資料庫。時間參數可以是台北時間的 datetime、字串或 epoch 秒。
+    """
+
+    # 後端名稱
+    name = None
+
+    @abstractmethod
+    def init_schema(self):
+        """建立資料表與索引 (可重複執行)"""
+
+    @abstractmethod
+    def unit_of_work(self, user_id):
+        """工作單元 (context manager)：區塊內該用戶的所有寫入在同一個交易中，
+        結束時一次提交，發生例外時全部回滾。可以巢狀使用，由最外層提交。
+        """
+
+    # 用戶狀態
+    @abstractmethod
+    def get_user_state(self, user_id):
+        """獲取用戶狀態"""
+
+    @abstractmethod
+    def set_user_state(self, user_id, state_data):
+        """設置用戶狀態"""
+
+    @abstractmethod
+    def clear_user_state(self, user_id):
+        """清除用戶狀態"""
+
+    @abstractmethod
+    def get_delivery_window(self, user_id):
+        """用戶的勿擾時段 {'quiet_start', 'quiet_end'} (當天第幾分鐘)，沒有設定時回傳 None"""
+
+    @abstractmethod
+    def set_delivery_window(self, user_id, quiet_start, quiet_end):
+        """設定勿擾時段 (當天第幾分鐘，結束早於開始表示跨過午夜)；兩者為 None 時清除"""
+
+    # 新增
+    @abstractmethod
+    def add_schedule(self, user_id, title, description, scheduled_time, remind_before=5, rrule=None,
+                     priority=PRIORITY_NORMAL):
+        """添加行程，回傳是否成功；remind_before 可以是多個提前分鐘數 (例如 [1440, 10])，每個各提醒一次
+        在 unit_of_work 中出錯時拋出例外 (由工作單元回滾)，不會回傳 False
+        """
+
+    @abstractmethod
+    def add_reminder(self, user_id, content, remind_time, rrule=None, priority=PRIORITY_NORMAL):
+        """添加提醒，回傳是否成功 (在 unit_of_work 中出錯時拋出例外，同 add_schedule)"""
+
+    @abstractmethod
+    def add_note(self, user_id, content, attachment=None, attachment_type=None, attachment_name=None):
+        """添加筆記，回傳是否成功；圖片或檔案筆記的 attachment 為內容的 SHA-256 (見 attachments.AttachmentStore)，
+        attachment_type 為 MIME 類型，attachment_name 為檔名；在 unit_of_work 中出錯時拋出例外 (同 add_schedule)，
+        語意索引在交易提交後才更新
+        """
+
+    # 查詢
+    @abstractmethod
+    def get_schedules(self, user_id):
+        """獲取用戶的所有行程"""
+
+    @abstractmethod
+    def get_reminders(self, user_id):
+        """獲取用戶的所有提醒"""
+
+    @abstractmethod
+    def get_notes(self, user_id):
+        """獲取用戶的所有筆記 (新的在前)，含 attachment、attachment_type、attachment_name 欄位"""
+
+    @abstractmethod
+    def search_notes(self, user_id, keyword, limit=10, offset=0):
+        """搜尋包含所有關鍵字的筆記"""
+
+    @abstractmethod
+    def get_relevant_notes(self, user_id, query, k=3):
+        """取得與問題最相關的前 k 則筆記"""
+
+    @abstractmethod
+    def get_upcoming_reminders(self, user_id, start=None, end=None):
+        """獲取用戶即將到來的提醒"""
+
+    @abstractmethod
+    def get_today_schedules(self, user_id):
+        """獲取用戶今天的行程"""
+
+    @abstractmethod
+    def get_schedule_by_id(self, user_id, schedule_id):
+        """根據ID獲取行程，不存在時回傳 None"""
+
+    @abstractmethod
+    def get_user_schedules(self, user_id, start=None, end=None):
+        """獲取用戶即將到來的行程 (重複行程已展開)"""
+
+    # 刪除
+    @abstractmethod
+    def delete_note(self, user_id, note_id):
+        """刪除筆記，回傳是否成功"""
+
+    @abstractmethod
+    def delete_reminder(self, user_id, reminder_id):
+        """刪除提醒 (連同待提醒項目與 outbox 中的訊息，dead letter 除外)，回傳是否成功"""
+
+    @abstractmethod
+    def delete_schedule(self, user_id, schedule_id):
+        """刪除行程 (連同待提醒項目與 outbox 中的訊息，dead letter 除外)，回傳是否成功"""
+
+    # 提醒掃描
+    @abstractmethod
+    def map_partitions(self, func):
+        """對每個資料分區平行執行 func(partition)，回傳結果列表"""
+
+    @abstractmethod
+    def get_due_items(self, partition, since, now):
+        """分區內提醒時間 (fire_at) 落在 (since, now] 的待提醒項目，行程與提醒共用同一個查詢
+        回傳 [{'id', 'user_id', 'source_table', 'source_id', 'offset_minutes', 'fire_at', 'occurrence', 'rrule',
+        'title', 'description', 'priority', 'quiet_start', 'quiet_end'}]，title 為行程標題或提醒內容
+        """
+
+    @abstractmethod
+    def get_missed_due_items(self, partition, before):
+        """分區內提醒時間不晚於 before 的待提醒項目，回傳 [{'id', 'user_id', 'offset_minutes', 'occurrence', 'rrule'}]"""
+
+    @abstractmethod
+    def advance_due_item(self, user_id, item_id, next_time=None, rrule=None):
+        """提醒完成後移除待提醒項目，重複項目則移到下一次發生時間 next_time (rrule 為剩下的規則)；
+        同時把來源的時間欄位更新為最近一次待提醒的發生時間，全部提醒完時標記來源已提醒
+        """
+
+    @abstractmethod
+    def get_scan_checkpoint(self, partition):
+        """分區上一次完整掃描到的時間 (epoch 秒)，從未掃描過時回傳 None"""
+
+    @abstractmethod
+    def set_scan_checkpoint(self, partition, at):
+        """記錄分區已完整掃描到 at"""
+
+    # 推播佇列 (outbox)：與標記已提醒在同一個工作單元內寫入，再由 outbox.OutboxSender 發送
+    @abstractmethod
+    def enqueue_outbox(self, user_id, source_table, source_id, occurrence, message, send_at=None):
+        """加入待發送的訊息 (send_at 之後才發送，預設立即)；occurrence 為這次提醒的時間，
+        同一項目的同一次提醒只會加入一次，回傳是否新增
+        """
+
+    @abstractmethod
+    def claim_outbox(self, partition, now, limit, lease_until):
+        """領取分區內最多 limit 筆已到發送時間的訊息 (含租約已過期、未完成的發送中訊息)，
+        標記為發送中並以 lease_until 為租約期限；多個程序同時領取時每筆只會交給其中一個
+        """
+
+    @abstractmethod
+    def mark_outbox_sent(self, user_id, outbox_id):
+        """標記領取的訊息已發送 (只更新發送中的訊息)"""
+
+    @abstractmethod
+    def mark_outbox_failed(self, user_id, outbox_id, error, retry_at=None):
+        """記錄領取的訊息發送失敗；retry_at 為下次重試時間 (改回待發送)，None 表示不再重試 (dead letter)"""
+
+    @abstractmethod
+    def purge_outbox(self, partition, before):
+        """刪除在 before 之前已發送的訊息，回傳刪除筆數"""
+
+    @abstractmethod
+    def find_outbox(self, user_id, source_table, occurrence):
+        """用戶在 occurrence 這次提醒收到的訊息 (id, source_id, message, status)，供提醒下方的按鈕找回自己的那幾筆"""
+
+    @abstractmethod
+    def snooze_outbox(self, user_id, outbox_ids, send_at):
+        """稍後提醒：把用戶的這幾筆訊息改為在 send_at 再發送一次 (發送中的不受影響)，回傳是否有更新"""
+
+    @abstractmethod
+    def acknowledge_outbox(self, user_id, outbox_ids):
+        """用戶按下完成：取消這幾筆尚未發送的稍後提醒，單次的提醒標記為完成 (is_done)，回傳是否找到"""
+
+    # 每日摘要
+    @abstractmethod
+    def set_digest_subscription(self, user_id, enabled):
+        """訂閱或取消每日摘要，回傳訂閱狀態是否有改變"""
+
+    @abstractmethod
+    def get_digest_batch(self, partition, start, end, after=None, limit=500):
+        """一次查出分區內當天 ([start, end)) 還沒收到摘要的訂閱者 (依 user_id 排序，從 after 之後取 limit 位)
+        及其在這段時間內的行程與提醒，重複項目的時間為下一次發生時間 (由呼叫端展開)。
+        回傳 [{'user_id', 'kind', 'title', 'description', 'at', 'rrule'}]，kind 為 SCHEDULES 或 REMINDERS；
+        沒有任何項目的訂閱者只有一列，kind 為 None
+        """
+
+    @abstractmethod
+    def mark_digest_sent(self, user_id, day_start):
+        """記錄用戶已收到 day_start 那一天的摘要"""
+
+    # 匯出/匯入
+    @abstractmethod
+    def iter_items(self, user_id, kind, batch_size=EXPORT_BATCH):
+        """逐筆產生用戶的筆記、行程或提醒 (kind 為 NOTES、SCHEDULES 或 REMINDERS，欄位見 EXPORT_COLUMNS)，
+        以游標每次取回 batch_size 筆，不會一次載入全部；呼叫端應把產生器讀完或關閉以釋放游標
+        """
+
+    @abstractmethod
+    def import_items(self, user_id, kind, rows):
+        """以 executemany 寫入一批資料 (dict，欄位見 IMPORT_COLUMNS) 並建立待提醒項目，回傳寫入筆數；
+        在 unit_of_work 中呼叫時多批資料在同一個交易內，出錯時全部回滾
+        """
+
+    # 用量統計 (見 stats.py)：彙總表不屬於任何用戶，只供 /admin/stats 讀取，不需要查詢其他資料表
+    @abstractmethod
+    def add_stats(self, counters, members=()):
+        """在同一個交易中累加每小時的計數 counters ({(bucket, metric): 增量})，並記錄不重複的成員
+        members ([(bucket, metric, member)])：第一次出現的成員讓 (bucket, metric) 的計數加一
+        """
+
+    @abstractmethod
+    def get_stats(self, start, end):
+        """bucket 落在 [start, end) 的彙總計數，回傳 [{'bucket', 'metric', 'value'}] (依 bucket 排序)"""
+
+    @abstractmethod
+    def purge_stats_members(self, before):
+        """刪除 bucket 早於 before 的去重成員 (計數保留)，回傳刪除筆數"""
+
+    def close(self):
+        """釋放目前執行緒持有的資源"""
+
+
+def get_storage():
+    """取得依 DATABASE_URL 設定的後端 (整個程序共用一個實例)"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if DATABASE_URL.startswith(('postgres://', 'postgresql://')):
+                    # 只有使用 PostgreSQL 時才需要安裝 psycopg2
+                    from postgres_storage import PostgresDatabase
+                    _storage = PostgresDatabase(DATABASE_URL)
+                else:
+                    from database import Database
+                    _storage = Database()
+    return _storage
@@ -0,0 +1,658 @@
+"""資料庫後端一致性與效能檢查
+
+用法：
+    python storage_conformance.py                      # 只檢查 SQLite (1 個與 3 個分片)
+    python storage_conformance.py --postgres DSN       # 另外檢查指定的 PostgreSQL
+    python storage_conformance.py --start-postgres     # 用 initdb/pg_ctl 啟動暫時的 PostgreSQL 後檢查
+
+每個後端跑同一組檢查，全部通過時結束碼為 0。
+"""
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import sharding
+import timeutil
+from outbox import find_reminder_outbox, message_key
+from storage import SCHEDULES, REMINDERS, NOTES, PRIORITY_NORMAL, PRIORITY_URGENT, OUTBOX_DEAD, OUTBOX_SENDING
+from timeutil import to_epoch
+
+# 效能檢查：PERF_USERS 位用戶共 PERF_NOTES 則筆記，受測用戶的 PERF_ADD_NOTES 則逐筆以 add_note 新增，
+# 其他用戶的以 import_items 批次寫入
+PERF_NOTES = 100_000
+PERF_USERS = 50
+PERF_ADD_NOTES = 2000
+# 效能檢查的筆記用字 (每則 8 個字，常見的字出現在約三成的筆記中，是全文檢索最慢的情況)
+PERF_WORDS = (
+    'laptop', 'meeting', 'project', 'budget', 'review', 'coffee', 'travel', 'invoice', 'client', 'design',
+    'deadline', 'report', '會議紀錄', '專案進度', '預算', '出差', '客戶', '設計稿', '伺服器', '報告',
+)
+
+
+class Checker:
+    def __init__(self, backend):
+        self.backend = backend
+        self.failures = []
+
+    def check(self, condition, message):
+        if not condition:
+            self.failures.append(message)
+            print(f"  [FAIL] {self.backend}: {message}")
+
+
+def check_user_state(storage, c, user):
+    storage.set_user_state(user, {'state': 'waiting_for_schedule', 'data': {'step': 1}})
+    state = storage.get_user_state(user)
+    c.check(state and state['state'] == 'waiting_for_schedule', "讀回用戶狀態")
+    c.check(state and state['data'] == {'step': 1}, "用戶狀態的 data 以 dict 讀回")
+    storage.set_user_state(user, {'state': 'waiting_for_note'})
+    c.check(storage.get_user_state(user)['state'] == 'waiting_for_note', "覆寫用戶狀態")
+    storage.clear_user_state(user)
+    c.check(storage.get_user_state(user) is None, "清除用戶狀態")
+
+
+def check_unit_of_work(storage, c, user):
+    with storage.unit_of_work(user):
+        storage.add_note(user, "工作單元內的筆記")
+        storage.set_user_state(user, {'state': 'waiting_for_note'})
+        with storage.unit_of_work(user):
+            storage.clear_user_state(user)
+    c.check(len(storage.get_notes(user)) == 1 and storage.get_user_state(user) is None, "工作單元提交")
+
+    try:
+        with storage.unit_of_work(user):
+            storage.add_note(user, "會被回滾的筆記")
+            raise RuntimeError("rollback")
+    except RuntimeError:
+        pass
+    c.check(len(storage.get_notes(user)) == 1, "工作單元發生例外時回滾")
+
+    # 新增失敗時整個工作單元回滾，不會只回滾前面的寫入後繼續提交
+    storage.set_user_state(user, {'state': 'waiting_for_schedule'})
+    try:
+        with storage.unit_of_work(user):
+            storage.add_note(user, "失敗前的筆記")
+            storage.add_schedule(user, None, None, timeutil.now())
+            storage.clear_user_state(user)
+        c.check(False, "工作單元中新增失敗時拋出例外")
+    except Exception:
+        pass
+    c.check(len(storage.get_notes(user)) == 1, "新增失敗時工作單元內的筆記一併回滾")
+    c.check((storage.get_user_state(user) or {}).get('state') == 'waiting_for_schedule', "新增失敗時不清除用戶狀態")
+    c.check(storage.add_schedule(user, None, None, timeutil.now()) is False, "工作單元外新增失敗時回傳 False")
+    storage.clear_user_state(user)
+
+
+def check_notes(storage, c, user, other):
+    for content in ("Buy milk and eggs", "會議紀錄：季度預算討論", "buy a new laptop"):
+        c.check(storage.add_note(user, content), f"新增筆記 {content}")
+    storage.add_note(other, "buy milk for other user")
+
+    notes = storage.get_notes(user)
+    c.check([note['content'] for note in notes][0] == "buy a new laptop", "筆記新的在前")
+    c.check(set(notes[0]) >= {'id', 'user_id', 'content', 'created_at'}, "筆記欄位")
+
+    found = {note['content'] for note in storage.search_notes(user, "BUY milk")}
+    c.check(found == {"Buy milk and eggs"}, f"多關鍵字且不分大小寫的搜尋: {found}")
+    found = {note['content'] for note in storage.search_notes(user, "預算")}
+    c.check(found == {"會議紀錄：季度預算討論"}, f"兩個中文字的搜尋: {found}")
+    c.check(len(storage.search_notes(user, "buy", limit=1)) == 1, "搜尋分頁 limit")
+    c.check(len(storage.search_notes(user, "buy", limit=10, offset=1)) == 1, "搜尋分頁 offset")
+    c.check(storage.search_notes(user, "   ") == [], "空白關鍵字")
+
+    relevant = storage.get_relevant_notes(user, "買新的 laptop", k=1)
+    c.check(relevant and relevant[0][1] == "buy a new laptop", f"相關筆記: {relevant}")
+
+    digest = 'ab' * 32
+    c.check(storage.add_note(other, "📷 圖片筆記", digest, 'image/jpeg', 'photo.jpg'), "新增附件筆記")
+    attached = storage.get_notes(other)[0]
+    c.check((attached['attachment'], attached['attachment_type'], attached['attachment_name']) == (digest, 'image/jpeg', 'photo.jpg'),
+            f"讀回筆記附件: {attached}")
+    c.check(notes[0]['attachment'] is None, "一般筆記沒有附件")
+
+    note_id = notes[0]['id']
+    # 各分片各自配號，其他用戶可能剛好有相同 id 的筆記，檢查的是這位用戶的筆記仍在
+    storage.delete_note(other, note_id)
+    c.check(any(note['id'] == note_id for note in storage.get_notes(user)), "不能刪除其他用戶的筆記")
+    c.check(storage.delete_note(user, note_id), "刪除筆記")
+    c.check(len(storage.get_notes(user)) == 2, "刪除後剩下兩則筆記")
+
+
+def check_schedules(storage, c, user, other, now):
+    today = now.replace(hour=23, minute=0, second=0, microsecond=0)
+    tomorrow = today + timedelta(days=1)
+    c.check(storage.add_schedule(user, "晚餐", "和朋友", today.strftime('%Y-%m-%dT%H:%M')), "新增 ISO 格式時間的行程")
+    c.check(storage.add_schedule(user, "站會", None, tomorrow.strftime('%Y-%m-%d 09:30:00'), 10, 'FREQ=DAILY;COUNT=3'), "新增重複行程")
+
+    schedules = storage.get_schedules(user)
+    c.check([s['title'] for s in schedules] == ["晚餐", "站會"], "行程依時間排序")
+    c.check(schedules[0]['scheduled_time'] == to_epoch(today), f"時間以 epoch 秒回傳: {schedules[0]['scheduled_time']}")
+    c.check(isinstance(schedules[0]['created_at'], int), "建立時間以 epoch 秒回傳")
+    c.check(schedules[1]['remind_before'] == 10 and schedules[1]['rrule'] == 'FREQ=DAILY;COUNT=3', "行程欄位")
+
+    schedule_id = schedules[0]['id']
+    c.check(storage.get_schedule_by_id(user, schedule_id)['title'] == "晚餐", "依ID取得行程")
+    c.check(storage.get_schedule_by_id(other, schedule_id) is None, "不能取得其他用戶的行程")
+    c.check([s['title'] for s in storage.get_today_schedules(user)] == ["晚餐"], "今天的行程")
+
+    upcoming = storage.get_user_schedules(user, start=now, end=now + timedelta(days=7))
+    c.check([s['title'] for s in upcoming] == ["晚餐", "站會", "站會", "站會"], f"重複行程展開: {[s['title'] for s in upcoming]}")
+    c.check(upcoming[1]['repeat'] and upcoming[0]['repeat'] is None, "重複描述")
+
+    c.check(not storage.delete_schedule(other, schedule_id), "不能刪除其他用戶的行程")
+    c.check(storage.delete_schedule(user, schedule_id), "刪除行程")
+    c.check(len(storage.get_schedules(user)) == 1, "刪除後剩下一個行程")
+
+
+def check_reminders(storage, c, user, now):
+    soon = now + timedelta(hours=1)
+    later = now + timedelta(days=3)
+    storage.add_reminder(user, "喝水", soon.strftime('%Y-%m-%d %H:%M:%S'))
+    storage.add_reminder(user, "繳費", later.strftime('%Y-%m-%d %H:%M:%S'))
+    storage.add_reminder(user, "過去的提醒", (now - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'))
+
+    c.check(len(storage.get_reminders(user)) == 3, "所有提醒")
+    upcoming = storage.get_upcoming_reminders(user, start=now, end=now + timedelta(days=1))
+    c.check([r['content'] for r in upcoming] == ["喝水"], f"時間範圍內的提醒: {[r['content'] for r in upcoming]}")
+    c.check(len(storage.get_upcoming_reminders(user, start=now)) == 2, "沒有結束時間的提醒查詢")
+
+    reminder_id = upcoming[0]['id']
+    c.check(storage.delete_reminder(user, reminder_id), "刪除提醒")
+    c.check(not storage.delete_reminder(user, reminder_id), "重複刪除提醒")
+
+
+def check_scanner(storage, c, user, now):
+    scan_time = now.replace(microsecond=0)
+    since = scan_time - timedelta(minutes=5)
+    due = scan_time + timedelta(minutes=3)
+    storage.add_schedule(user, "馬上開始", None, due.strftime('%Y-%m-%d %H:%M:%S'), 5)
+    storage.add_schedule(user, "還沒到", None, (scan_time + timedelta(minutes=30)).strftime('%Y-%m-%d %H:%M:%S'), 5)
+    # 同一個行程提前 1 天與 10 分鐘各提醒一次，只有提前 1 天的那一次到期
+    interview = scan_time + timedelta(days=1, minutes=-1)
+    storage.add_schedule(user, "兩次提醒", None, interview, [10, 1440])
+    # 提醒時間剛過 (上一輪掃描之後) 的提醒仍要發送，不再要求時間剛好等於掃描的那一秒
+    storage.add_reminder(user, "剛過的提醒", (scan_time - timedelta(seconds=40)).strftime('%Y-%m-%d %H:%M:%S'),
+                         priority=PRIORITY_URGENT)
+    storage.add_reminder(user, "太久以前", (scan_time - timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S'))
+    missed = scan_time - timedelta(hours=2)
+    storage.add_reminder(user, "錯過的重複提醒", missed.strftime('%Y-%m-%d %H:%M:%S'), 'FREQ=DAILY')
+
+    def scan(func):
+        return [row for rows in storage.map_partitions(func) for row in rows if row['user_id'] == user]
+
+    def source(title):
+        return next(row for row in storage.get_schedules(user) + storage.get_reminders(user)
+                    if row.get('title', row.get('content')) == title)
+
+    c.check(storage.get_delivery_window(user) is None, "沒有設定勿擾時段")
+    storage.set_delivery_window(user, 22 * 60, 8 * 60)
+    c.check(storage.get_delivery_window(user) == {'quiet_start': 1320, 'quiet_end': 480}, "讀回勿擾時段")
+
+    items = sorted(scan(lambda p: storage.get_due_items(p, since, scan_time)), key=lambda row: row['title'])
+    c.check([(i['source_table'], i['title']) for i in items] == [(SCHEDULES, "兩次提醒"), (REMINDERS, "剛過的提醒"), (SCHEDULES, "馬上開始")],
+            f"到期的項目: {items}")
+    first, urgent, starting = items if len(items) == 3 else (None, None, None)
+    c.check(starting and (starting['priority'], starting['quiet_start'], starting['quiet_end']) == (PRIORITY_NORMAL, 1320, 480),
+            f"到期的行程帶有優先順序與勿擾時段: {starting}")
+    c.check(starting and starting['fire_at'] == to_epoch(due) - 300 and starting['occurrence'] == to_epoch(due), f"提醒時間與發生時間: {starting}")
+    c.check(first and first['offset_minutes'] == 1440 and first['occurrence'] == to_epoch(interview), f"提前 1 天的提醒: {first}")
+    c.check(urgent and urgent['priority'] == PRIORITY_URGENT, f"緊急的提醒: {urgent}")
+    storage.set_delivery_window(user, None, None)
+    c.check(storage.get_delivery_window(user) is None, "清除勿擾時段")
+    items = scan(lambda p: storage.get_due_items(p, since, scan_time))
+    c.check(items and all(i['quiet_start'] is None for i in items), f"清除後不再帶有勿擾時段: {items}")
+    missed_rows = sorted(scan(lambda p: storage.get_missed_due_items(p, since)), key=lambda row: row['occurrence'])
+    c.check([(r['occurrence'], r['rrule']) for r in missed_rows] == [(to_epoch(missed), 'FREQ=DAILY'), (to_epoch(scan_time - timedelta(minutes=10)), None)],
+            f"錯過的項目: {missed_rows}")
+
+    # 行程的一個提醒完成後，另一個提醒仍在；全部完成後來源標記為已提醒
+    storage.advance_due_item(user, first['id'])
+    c.check(source("兩次提醒")['reminded'] == 0, "還有其他提前提醒的行程不算已提醒")
+    storage.advance_due_item(user, starting['id'])
+    c.check(source("馬上開始")['reminded'] == 1, "單次的行程提醒後標記已提醒")
+    remaining = scan(lambda p: storage.get_due_items(p, since, scan_time + timedelta(days=2)))
+    c.check(sorted(i['title'] for i in remaining) == ["兩次提醒", "剛過的提醒", "還沒到"], f"提醒後不再出現: {remaining}")
+    storage.advance_due_item(user, missed_rows[0]['id'], missed + timedelta(days=1), 'FREQ=DAILY')
+    storage.advance_due_item(user, missed_rows[1]['id'])
+    c.check(not scan(lambda p: storage.get_missed_due_items(p, since)), "處理後不再是錯過的項目")
+    c.check(source("錯過的重複提醒")['remind_time'] == to_epoch(missed + timedelta(days=1)), "重複項目的時間欄位移到下一次")
+    storage.delete_schedule(user, source("還沒到")['id'])
+    remaining = scan(lambda p: storage.get_due_items(p, since, scan_time + timedelta(days=2)))
+    c.check("還沒到" not in [i['title'] for i in remaining], "刪除行程時一併刪除待提醒項目")
+
+    for checkpoint in (since, scan_time):
+        storage.map_partitions(lambda p: storage.set_scan_checkpoint(p, checkpoint))
+        saved = storage.map_partitions(storage.get_scan_checkpoint)
+        c.check(saved == [to_epoch(checkpoint)] * len(saved), f"掃描進度: {saved}")
+
+
+def check_outbox(storage, c, user, now):
+    occurrence = now.replace(microsecond=0)
+
+    def claim(at, lease=timedelta(minutes=5)):
+        return [row for rows in storage.map_partitions(lambda p: storage.claim_outbox(p, at, 100, at + lease))
+                for row in rows if row['user_id'] == user]
+
+    with storage.unit_of_work(user):
+        c.check(storage.enqueue_outbox(user, REMINDERS, 1, occurrence, "提醒：開會"), "加入 outbox")
+        c.check(not storage.enqueue_outbox(user, REMINDERS, 1, occurrence, "提醒：開會"), "同一次發生不重複加入")
+    storage.enqueue_outbox(user, REMINDERS, 2, occurrence, "提醒：喝水")
+    storage.enqueue_outbox(user, REMINDERS, 3, occurrence, "（延遲通知）提醒：吃藥", now + timedelta(seconds=30))
+    # enqueue_outbox 以寫入時的時間為發送時間
+    claimed_at = timeutil.now()
+    rows = sorted(claim(claimed_at), key=lambda r: r['source_id'])
+    c.check([(r['message'], r['status']) for r in rows] == [("提醒：開會", OUTBOX_SENDING), ("提醒：喝水", OUTBOX_SENDING)],
+            f"領取待發送的訊息: {rows}")
+    c.check(not [r for r in claim(claimed_at) if r['source_id'] != 3], "已領取的訊息不會被重複領取")
+
+    first, second = rows
+    storage.mark_outbox_sent(user, first['id'])
+    storage.mark_outbox_failed(user, second['id'], "HTTP 500", now + timedelta(minutes=1))
+    c.check(not claim(now), "已發送與等待重試的訊息不會立即取出")
+    retry = [r for r in claim(now + timedelta(minutes=2)) if r['source_id'] != 3]
+    c.check([(r['id'], r['attempts'], r['last_error']) for r in retry] == [(second['id'], 1, "HTTP 500")],
+            f"到了重試時間再次取出: {retry}")
+    storage.mark_outbox_failed(user, second['id'], "HTTP 400")
+    # 吃藥那一筆在上面被領取後沒有標記結果，租約到期後再次取出
+    c.check(not claim(now + timedelta(minutes=3)), "租約期間不會再取出")
+    delayed = claim(now + timedelta(days=1))
+    c.check([r['message'] for r in delayed] == ["（延遲通知）提醒：吃藥"], f"dead letter 不再取出，租約到期的訊息再次取出: {delayed}")
+
+    # 稍後提醒：由 postback 找回用戶收到的那一則 (同一時間的其他提醒不受影響)，改為稍後再發送一次，按下完成後取消
+    def postback(message, at=occurrence):
+        data = {'src': REMINDERS, 'at': str(to_epoch(at)), 'key': message_key(message)}
+        return find_reminder_outbox(storage, user, data)
+
+    later = now + timedelta(minutes=10)
+    meeting = postback("提醒：開會")
+    c.check(meeting == [first['id']], f"由 postback 找回同一時間的其中一則提醒: {meeting}")
+    c.check(not postback("提醒：開會", occurrence + timedelta(minutes=1)), "找不到其他時間的提醒")
+    c.check(not storage.snooze_outbox(user, [], later), "稍後提醒找不到的提醒")
+    c.check(storage.snooze_outbox(user, meeting, later), "稍後提醒")
+    c.check(not [r for r in claim(now) if r['source_id'] == 1], "稍後提醒到時間前不會取出")
+    c.check(storage.acknowledge_outbox(user, meeting), "完成提醒")
+    c.check(not [r for r in claim(later) if r['source_id'] == 1], "完成後取消稍後提醒")
+    statuses = {r['source_id']: r['status'] for r in storage.find_outbox(user, REMINDERS, occurrence)}
+    c.check(statuses.get(2) == OUTBOX_DEAD, f"同一時間的另一則提醒不受影響: {statuses}")
+    storage.snooze_outbox(user, meeting, later)
+    snoozed = [r for r in claim(later) if r['source_id'] == 1]
+    c.check([(r['id'], r['attempts']) for r in snoozed] == [(first['id'], 0)], f"稍後提醒到時間才取出: {snoozed}")
+    # 發送中的訊息不能改為稍後提醒，否則同一批會再發送一次
+    c.check(not storage.snooze_outbox(user, meeting, later + timedelta(minutes=10)), "發送中的訊息不改為稍後提醒")
+    storage.mark_outbox_sent(user, first['id'])
+    c.check(not [r for r in claim(later + timedelta(minutes=10)) if r['source_id'] == 1], "發送完成後不會再發送")
+    reminder_time = occurrence - timedelta(minutes=1)
+    storage.add_reminder(user, "單次提醒", reminder_time)
+    storage.add_reminder(user, "同時的另一個提醒", reminder_time)
+    reminder_ids = {r['content']: r['id'] for r in storage.get_reminders(user)}
+    for content, reminder_id in reminder_ids.items():
+        storage.enqueue_outbox(user, REMINDERS, reminder_id, reminder_time, f"提醒：{content}")
+    storage.acknowledge_outbox(user, postback("提醒：單次提醒", reminder_time))
+    done = {r['content']: r['is_done'] for r in storage.get_reminders(user)}
+    c.check(done == {"單次提醒": 1, "同時的另一個提醒": 0}, f"只完成按下的那一個提醒: {done}")
+
+    # 刪除行程或提醒後，還沒發送的訊息不會再發送
+    storage.add_reminder(user, "要刪除的提醒", reminder_time)
+    storage.add_schedule(user, "要刪除的行程", None, reminder_time, 0)
+    deleted = [
+        (REMINDERS, next(r['id'] for r in storage.get_reminders(user) if r['content'] == "要刪除的提醒")),
+        (SCHEDULES, next(s['id'] for s in storage.get_schedules(user) if s['title'] == "要刪除的行程")),
+    ]
+    for source_table, source_id in deleted:
+        storage.enqueue_outbox(user, source_table, source_id, reminder_time, "提醒：要刪除的項目")
+    storage.delete_reminder(user, deleted[0][1])
+    storage.delete_schedule(user, deleted[1][1])
+    left = [(source_table, row['source_id']) for source_table, _ in deleted
+            for row in storage.find_outbox(user, source_table, reminder_time)]
+    c.check(not set(left) & set(deleted), f"刪除後一併刪除 outbox 中的訊息: {left}")
+
+    purged = sum(storage.map_partitions(lambda p: storage.purge_outbox(p, now + timedelta(days=1))))
+    c.check(purged >= 1, f"清除已發送的訊息: {purged}")
+
+
+def check_digest(storage, c, user, other, now):
+    day = now.date()
+    start, end = timeutil.day_range(day)
+    at = datetime(day.year, day.month, day.day, 9, 0)
+    storage.add_schedule(user, "晨會", "三樓", at, 5)
+    storage.add_schedule(user, "明天的行程", None, at + timedelta(days=1), 5)
+    storage.add_reminder(user, "吃藥", at - timedelta(days=3), 'FREQ=DAILY')
+    storage.add_reminder(user, "下週的重複提醒", at + timedelta(days=7), 'FREQ=DAILY')
+    c.check(storage.set_digest_subscription(user, True), "訂閱每日摘要")
+    c.check(not storage.set_digest_subscription(user, True), "重複訂閱不改變狀態")
+    storage.set_digest_subscription(other, True)
+
+    def batch(after=None, limit=500):
+        return [row for rows in storage.map_partitions(lambda p: storage.get_digest_batch(p, start, end, after, limit))
+                for row in rows if row['user_id'] in (user, other)]
+
+    rows = batch()
+    items = sorted((row['user_id'], row['kind'], row['title']) for row in rows if row['user_id'] == user)
+    c.check(items == [(user, REMINDERS, "吃藥"), (user, SCHEDULES, "晨會")], f"訂閱者當天的項目: {items}")
+    empty = [(row['kind'], row['at']) for row in rows if row['user_id'] == other]
+    c.check(empty == [(None, None)], f"沒有項目的訂閱者: {empty}")
+    c.check(all(row['user_id'] > min(user, other) for row in batch(after=min(user, other))), "依 user_id 分批")
+
+    storage.mark_digest_sent(user, start)
+    c.check({row['user_id'] for row in batch()} == {other}, "已收到摘要的用戶不再取出")
+    c.check(storage.set_digest_subscription(other, False), "取消每日摘要")
+    c.check(not batch(), "取消後不再取出")
+
+
+def check_export_import(storage, c, user, other, now):
+    import io
+    from export import export_stream, import_stream
+    at = now.replace(second=0, microsecond=0) + timedelta(days=2)
+    storage.add_note(user, "第一則, 含逗號的筆記")
+    storage.add_note(user, "第二則\n多行筆記")
+    storage.add_schedule(user, "週會", "會議室", at, [60, 10], 'FREQ=WEEKLY;COUNT=4', PRIORITY_URGENT)
+    storage.add_schedule(user, "已過去的行程", None, now - timedelta(days=1), 5)
+    storage.add_reminder(user, "繳房租", at)
+
+    rows = list(storage.iter_items(user, NOTES, batch_size=1))
+    c.check([row['content'] for row in rows] == ["第一則, 含逗號的筆記", "第二則\n多行筆記"], "逐批讀出筆記 (依建立時間)")
+    c.check(set(rows[0]) == {'id', 'content', 'created_at'}, f"匯出欄位: {set(rows[0])}")
+    items = storage.iter_items(user, SCHEDULES)
+    c.check(next(items)['title'] == "已過去的行程", "逐批讀出行程 (依時間)")
+    items.close()
+
+    def imported(fmt, kind='all'):
+        data = ''.join(export_stream(storage, user, kind, fmt))
+        target = f"{other}{fmt}"
+        counts = import_stream(storage, target, io.StringIO(data, newline=''), fmt, kind)
+        return target, counts
+
+    target, counts = imported('ndjson')
+    c.check(counts == {NOTES: 2, SCHEDULES: 2, REMINDERS: 1}, f"NDJSON 匯入筆數: {counts}")
+    schedules = storage.get_schedules(target)
+    c.check([(s['title'], s['scheduled_time'], s['rrule'], s['priority']) for s in schedules] == [
+        ("已過去的行程", to_epoch(now.replace(microsecond=0) - timedelta(days=1)), None, PRIORITY_NORMAL),
+        ("週會", to_epoch(at), 'FREQ=WEEKLY;COUNT=4', PRIORITY_URGENT),
+    ], f"NDJSON 匯入的行程: {schedules}")
+    c.check([s['reminded'] for s in schedules] == [1, 0], "已過去的行程匯入後不再提醒")
+    due = [row for rows in storage.map_partitions(lambda p: storage.get_due_items(p, to_epoch(now), to_epoch(at))) for row in rows
+           if row['user_id'] == target]
+    c.check(sorted(row['title'] for row in due) == ["繳房租", "週會"], f"匯入的項目建立待提醒項目: {[row['title'] for row in due]}")
+
+    target, counts = imported('csv', NOTES)
+    c.check([n['content'] for n in storage.get_notes(target)] == ["第二則\n多行筆記", "第一則, 含逗號的筆記"], "CSV 匯入筆記")
+    if importlib.util.find_spec('icalendar'):
+        target, counts = imported('ics')
+        c.check(counts == {NOTES: 2, SCHEDULES: 2, REMINDERS: 1}, f"ICS 匯入筆數: {counts}")
+        c.check([s['title'] for s in storage.get_schedules(target)] == ["已過去的行程", "週會"], "ICS 匯入行程")
+    else:
+        print(f"  {c.backend}: 未安裝 icalendar，略過 ICS 匯入")
+
+    bad = '{"kind": "notes", "content": "會被回滾"}\n{"kind": "schedules", "title": "缺少時間"}\n'
+    try:
+        import_stream(storage, f"{other}bad", io.StringIO(bad), 'ndjson')
+        c.check(False, "有誤的資料應該匯入失敗")
+    except ValueError as e:
+        c.check("第 2 筆" in str(e), f"錯誤訊息含筆數: {e}")
+    c.check(storage.get_notes(f"{other}bad") == [], "匯入失敗時整批回滾")
+
+    from export import export_token, verify_export_token, IMPORT
+    c.check(verify_export_token(export_token(user)) == user, "匯出權杖")
+    c.check(verify_export_token(export_token(user), IMPORT) is None, "匯出權杖不能用來匯入")
+    c.check(verify_export_token(export_token(user, IMPORT), IMPORT) == user, "匯入權杖")
+
+
+def check_stats(storage, c, user, other, now):
+    from stats import summarize, DAILY_ACTIVE_USERS
+    hour = to_epoch(now.replace(minute=0, second=0, microsecond=0))
+    start = hour - 48 * 3600
+    # 以每次執行不同的指標名稱區分 (PostgreSQL 可能保留之前的資料)
+    counted, distinct = f"test_count_{user}", f"test_users_{user}"
+    storage.add_stats({(hour, counted): 3, (hour - 3600, counted): 1})
+    storage.add_stats({(hour, counted): 2}, [(hour, distinct, user), (hour, distinct, other)])
+    storage.add_stats({}, [(hour, distinct, user), (hour - 3600, distinct, user)])
+    rows = [row for row in storage.get_stats(start, hour + 3600) if row['metric'] in (counted, distinct)]
+    c.check([(row['bucket'], row['metric'], row['value']) for row in rows] == [
+        (hour - 3600, counted, 1), (hour - 3600, distinct, 1), (hour, counted, 5), (hour, distinct, 2),
+    ], f"累加計數與不重複成員: {rows}")
+    c.check(not [row for row in storage.get_stats(hour + 3600, hour + 7200) if row['metric'] == counted],
+            "查詢範圍不含結束時間")
+
+    day = summarize(rows, 'day')
+    c.check(day['totals'] == {counted: 6, distinct: 3}, f"依天加總: {day['totals']}")
+    c.check(summarize([{'bucket': hour, 'metric': DAILY_ACTIVE_USERS, 'value': 4}])['totals'] == {},
+            "不重複人數不列入總和")
+
+    c.check(storage.purge_stats_members(hour) >= 1, "清除舊的去重成員")
+    storage.add_stats({}, [(hour - 3600, distinct, user)])
+    rows = {row['bucket']: row['value'] for row in storage.get_stats(start, hour + 3600) if row['metric'] == distinct}
+    c.check(rows == {hour - 3600: 2, hour: 2}, f"清除後的成員重新計算，計數保留: {rows}")
+
+
+def check_performance(storage, c, user):
+    rng = random.Random(0)
+
+    def content(i):
+        return f"{' '.join(rng.choice(PERF_WORDS) for _ in range(8))} #{i}"
+
+    start = time.perf_counter()
+    for i in range(PERF_ADD_NOTES):
+        storage.add_note(user, content(i))
+    insert = time.perf_counter() - start
+
+    # 其他用戶的筆記讓常見字的索引遍布所有用戶，搜尋時不能只靠關鍵字縮小範圍
+    created_at = to_epoch(timeutil.now())
+    per_user = PERF_NOTES // PERF_USERS
+    for _ in range(PERF_USERS - 1):
+        other = f"U{uuid.uuid4().hex}"
+        for offset in range(0, per_user, 1000):
+            storage.import_items(other, NOTES, [
+                {'content': content(i), 'created_at': created_at} for i in range(offset, min(offset + 1000, per_user))
+            ])
+
+    searches = {}
+    for label, keyword in (('常見字', 'laptop'), ('兩個關鍵字', '伺服器 budget'), ('沒有結果', 'xyzzy')):
+        storage.search_notes(user, keyword)
+        start = time.perf_counter()
+        for _ in range(50):
+            found = storage.search_notes(user, keyword)
+        searches[label] = (time.perf_counter() - start) / 50
+        c.check(all(note['user_id'] == user for note in found), f"效能檢查只搜尋到自己的筆記: {keyword}")
+
+    start = time.perf_counter()
+    for _ in range(100):
+        storage.get_user_schedules(user)
+    schedules = (time.perf_counter() - start) / 100
+
+    search = '，'.join(f"{label} {seconds * 1000:.2f}ms" for label, seconds in searches.items())
+    print(f"  {c.backend}: 新增 {PERF_ADD_NOTES} 則筆記 {insert:.2f}s，"
+          f"在 {PERF_USERS} 位用戶共 {PERF_NOTES} 則筆記中搜尋 ({search})，查詢行程 {schedules * 1000:.2f}ms/次")
+
+
+def run(storage, backend):
+    """對一個後端執行所有檢查"""
+    c = Checker(backend)
+    storage.init_schema()
+    run_id = uuid.uuid4().hex[:8]
+    user, other = f"U{run_id}a", f"U{run_id}b"
+    now = timeutil.now()
+    for check in (
+        lambda: check_user_state(storage, c, user),
+        lambda: check_unit_of_work(storage, c, f"U{run_id}e"),
+        lambda: check_notes(storage, c, user, other),
+        lambda: check_schedules(storage, c, user, other, now),
+        lambda: check_reminders(storage, c, user, now),
+        lambda: check_scanner(storage, c, f"U{run_id}c", now),
+        lambda: check_outbox(storage, c, f"U{run_id}f", now),
+        lambda: check_digest(storage, c, f"U{run_id}g", f"U{run_id}h", now),
+        lambda: check_export_import(storage, c, f"U{run_id}i", f"U{run_id}j", now),
+        lambda: check_stats(storage, c, f"U{run_id}k", f"U{run_id}l", now),
+        lambda: check_performance(storage, c, f"U{run_id}d"),
+    ):
+        try:
+            check()
+        except Exception as e:
+            c.check(False, f"例外 {type(e).__name__}: {e}")
+    print(f"{backend}: {'通過' if not c.failures else f'{len(c.failures)} 項失敗'}")
+    return c.failures
+
+
+def check_sqlite_migration():
+    """舊版以台北時間字串儲存的資料庫，初始化後時間欄位轉為 epoch 秒，並建立待提醒項目"""
+    import sqlite3
+    from database import init_db
+
+    c = Checker("sqlite 遷移")
+    db = sqlite3.connect(sharding.DATABASE)
+    db.executescript('''
+        CREATE TABLE notes (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, content TEXT NOT NULL, created_at DATETIME NOT NULL);
+        CREATE TABLE reminders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, content TEXT NOT NULL,
+            remind_time DATETIME NOT NULL, created_at DATETIME NOT NULL, is_done INTEGER DEFAULT 0, reminded INTEGER DEFAULT 0);
+        INSERT INTO notes (user_id, content, created_at) VALUES ('U1', '舊筆記', '2024-05-01 09:30:00');
+        INSERT INTO reminders (user_id, content, remind_time, created_at) VALUES ('U1', '舊提醒', '2024-05-02T08:00', '2024-05-01 09:30');
+        CREATE VIRTUAL TABLE notes_fts USING fts5(content, user_id UNINDEXED, content='notes', content_rowid='id', tokenize='trigram');
+        INSERT INTO notes_fts (notes_fts) VALUES ('rebuild');
+    ''')
+    db.commit()
+    db.close()
+    init_db()
+    db = sqlite3.connect(sharding.DATABASE)
+    created_at, = db.execute("SELECT created_at FROM notes").fetchone()
+    remind_time, = db.execute("SELECT remind_time FROM reminders").fetchone()
+    version, = db.execute("PRAGMA user_version").fetchone()
+    due_items = db.execute("SELECT source_table, occurrence, fire_at FROM due_items").fetchall()
+    fts_sql, = db.execute("SELECT sql FROM sqlite_master WHERE name = 'notes_fts'").fetchone()
+    fts_rows = db.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'content : \"舊筆記\"'").fetchall()
+    init_db()
+    backfilled_again, = db.execute("SELECT COUNT(*) FROM due_items").fetchone()
+    db.close()
+    # 2024-05-01 09:30 台北時間 = 2024-05-01 01:30 UTC
+    c.check(created_at == 1714527000, f"筆記時間轉換: {created_at}")
+    c.check(remind_time == 1714608000, f"提醒時間轉換: {remind_time}")
+    c.check(version >= 1, "結構版本")
+    c.check(due_items == [(REMINDERS, 1714608000, 1714608000)], f"為舊提醒建立待提醒項目: {due_items}")
+    c.check(backfilled_again == 1, "重複初始化不會重複建立待提醒項目")
+    c.check('UNINDEXED' not in fts_sql and fts_rows == [(1,)], f"重建全文檢索索引並為 user_id 建立索引: {fts_sql} {fts_rows}")
+    print(f"sqlite 遷移: {'通過' if not c.failures else f'{len(c.failures)} 項失敗'}")
+    return c.failures
+
+
+def check_reshard_legacy():
+    """把還沒遷移的舊版資料庫重新分片，新分片的時間欄位要轉為 epoch 秒"""
+    import sqlite3
+    from database import Database, close_db
+    from reshard import reshard
+
+    c = Checker("sqlite 重新分片舊資料庫")
+    cwd = os.getcwd()
+    previous = sharding.DB_SHARDS
+    os.mkdir('legacy')
+    os.chdir('legacy')
+    try:
+        db = sqlite3.connect(sharding.DATABASE)
+        db.executescript('''
+            CREATE TABLE schedules (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, title TEXT NOT NULL,
+                description TEXT, scheduled_time DATETIME NOT NULL, remind_before INTEGER DEFAULT 5,
+                created_at DATETIME NOT NULL, ics_file TEXT, reminded INTEGER DEFAULT 0);
+            CREATE TABLE reminders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, content TEXT NOT NULL,
+                remind_time DATETIME NOT NULL, created_at DATETIME NOT NULL, is_done INTEGER DEFAULT 0, reminded INTEGER DEFAULT 0);
+            INSERT INTO schedules (user_id, title, scheduled_time, created_at) VALUES ('U1', '舊行程', '2099-05-02 08:00:00', '2024-05-01 09:30:00');
+            INSERT INTO schedules (user_id, title, scheduled_time, created_at) VALUES ('U2', '舊行程', '2099-05-02 08:00:00', '2024-05-01 09:30:00');
+            INSERT INTO reminders (user_id, content, remind_time, created_at) VALUES ('U1', '舊提醒', '2099-05-02T08:00', '2024-05-01 09:30');
+        ''')
+        db.commit()
+        db.close()
+        reshard(1, 2, 'out')
+        os.chdir('out')
+        close_db()
+        sharding.DB_SHARDS = 2
+        types = set()
+        due_items = 0
+        for path in sharding.shard_paths():
+            db = sqlite3.connect(path)
+            types.update(db.execute("SELECT typeof(scheduled_time) FROM schedules").fetchall())
+            types.update(db.execute("SELECT typeof(remind_time) FROM reminders").fetchall())
+            due_items += db.execute("SELECT COUNT(*) FROM due_items").fetchone()[0]
+            db.close()
+        storage = Database()
+        schedules = storage.get_schedules('U1') + storage.get_schedules('U2')
+        # 2099-05-02 08:00 台北時間 = 2099-05-02 00:00 UTC
+        expected = to_epoch(datetime(2099, 5, 2, 8, 0))
+        c.check(types == {('integer',)}, f"新分片的時間欄位為整數: {types}")
+        c.check([s['scheduled_time'] for s in schedules] == [expected, expected], f"讀取行程時間: {schedules}")
+        c.check(due_items == 3, f"新分片為行程與提醒建立待提醒項目: {due_items}")
+    finally:
+        close_db()
+        sharding.DB_SHARDS = previous
+        os.chdir(cwd)
+    print(f"sqlite 重新分片舊資料庫: {'通過' if not c.failures else f'{len(c.failures)} 項失敗'}")
+    return c.failures
+
+
+def run_sqlite(shards):
+    from database import Database, close_db
+
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    previous = sharding.DB_SHARDS
+    os.chdir(workdir)
+    sharding.DB_SHARDS = shards
+    try:
+        failures = check_sqlite_migration() + check_reshard_legacy() if shards == 1 else []
+        return failures + run(Database(), f"sqlite ({shards} 個分片)")
+    finally:
+        close_db()
+        sharding.DB_SHARDS = previous
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_postgres(dsn):
+    from postgres_storage import PostgresDatabase
+
+    storage = PostgresDatabase(dsn)
+    try:
+        return run(storage, "postgres")
+    finally:
+        storage.shutdown()
+
+
+@contextmanager
+def temporary_postgres():
+    """以 initdb/pg_ctl 在暫存目錄啟動一個只給這次檢查使用的 PostgreSQL"""
+    if not shutil.which('initdb') or not shutil.which('pg_ctl'):
+        raise RuntimeError("找不到 initdb/pg_ctl，請安裝 PostgreSQL 或改用 --postgres 指定連線")
+    datadir = tempfile.mkdtemp()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    subprocess.run(['initdb', '-D', datadir, '-U', 'postgres', '-A', 'trust'], check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(
+        ['pg_ctl', '-D', datadir, '-o', f'-p {port} -k {datadir}', '-w', 'start'],
+        check=True, stdout=subprocess.DEVNULL
+    )
+    try:
+        yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run(['pg_ctl', '-D', datadir, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(datadir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="檢查各資料庫後端的行為是否一致")
+    parser.add_argument('--postgres', help="PostgreSQL 連線字串")
+    parser.add_argument('--start-postgres', action='store_true', help="啟動暫時的 PostgreSQL 進行檢查")
+    args = parser.parse_args()
+
+    failures = run_sqlite(1) + run_sqlite(3)
+    if args.postgres:
+        failures += run_postgres(args.postgres)
+    elif args.start_postgres:
+        with temporary_postgres() as dsn:
+            failures += run_postgres(dsn)
+    sys.exit(1 if failures else 0)
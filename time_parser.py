@@ -0,0 +1,362 @@
+import re
+from datetime import datetime, timedelta
+
+from recurrence import WEEKDAY_CODES, WORKDAYS, first_occurrence
+import timeutil
+
+REMINDER = 'reminder'
+SCHEDULE = 'schedule'
+
+_DIGITS = {'零': 0, '〇': 0, '一': 1, '二': 2, '兩': 2, '两': 2, '三': 3, '四': 4,
+           '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_WEEKDAYS = {'一': 0, '二': 1, '三': 2, '四': 3, '五': 4, '六': 5, '日': 6, '天': 6,
+             '1': 0, '2': 1, '3': 2, '4': 3, '5': 4, '6': 5, '7': 6}
+# 只提到時段沒有提到幾點時使用的預設時間
+_PERIOD_DEFAULT_HOUR = {'凌晨': 6, '清晨': 6, '早上': 9, '早晨': 9, '上午': 9, '中午': 12,
+                        '下午': 15, '傍晚': 18, '晚上': 20, '夜裡': 22, '半夜': 0}
+_AFTERNOON_PERIODS = {'下午', '傍晚', '晚上', '夜裡'}
+_DEFAULT_HOUR = 9
+
+_NUM = r'[0-9零〇一二兩两三四五六七八九十百]+'
+
+_RELATIVE_RE = re.compile(
+    rf'(?P<num>{_NUM}|半)(?:個|个)?(?P<half>半)?(?P<unit>分鐘|分钟|分|小時|小时|鐘頭|钟头|天)(?:之)?[後后]'
+)
+_DAY_RE = re.compile(r'(?P<day>大後天|大后天|今天|今日|今晚|今早|明天|明日|明早|明晚|後天|后天)')
+_WEEKDAY_RE = re.compile(r'(?P<prefix>下下|下|這|这|本)?(?:個|个)?(?:週|周|星期|禮拜|礼拜)(?P<weekday>[一二三四五六日天1-7])')
+_DATE_RE = re.compile(rf'(?:(?P<month>{_NUM})月(?P<mday>{_NUM})(?:日|號|号)|(?P<month2>\d{{1,2}})/(?P<mday2>\d{{1,2}}))')
+_PERIOD_RE = re.compile(r'(?P<period>凌晨|清晨|早上|早晨|上午|中午|下午|傍晚|晚上|夜裡|半夜)')
+_CLOCK_RE = re.compile(
+    rf'(?:(?P<hh>\d{{1,2}})[:：](?P<mm>\d{{2}})'
+    rf'|(?P<hour>{_NUM})(?:點|点|時|时)(?:(?P<half>半)|(?P<quarter>[一三])刻|(?P<minute>{_NUM})分?)?)'
+)
+_OFFSET_UNIT = r'分鐘|分钟|分|小時|小时|鐘頭|钟头|天'
+_OFFSET_RE = re.compile(rf'(?P<num>{_NUM}|半)(?:個|个)?(?P<unit>{_OFFSET_UNIT})')
+# 「提前1小時提醒」，也可以列出多個提前時間：「提前1天和10分鐘提醒」
+_OFFSET = rf'(?:{_NUM}|半)(?:個|个)?(?:{_OFFSET_UNIT})'
+_REMIND_BEFORE_RE = re.compile(rf'提前(?P<offsets>{_OFFSET}(?:[和與与跟及、,，]{_OFFSET})*)(?:提醒)?')
+
+_RECURRENCE_RE = re.compile(
+    rf'每(?:個|个)?(?:(?P<daily>天|日|晚|早)|(?P<workday>工作日|平日)'
+    rf'|(?:週|周|星期|禮拜|礼拜)(?P<weekdays>[一二三四五六日天1-7、,和與跟到至-]*)'
+    rf'|月(?P<mday>{_NUM})(?:日|號|号)|(?P<monthly>月))'
+)
+# 標示緊急的字眼：緊急的提醒在勿擾時段也會準時發送
+_URGENT_RE = re.compile(r'緊急|急件|務必|[!！]{2,}')
+# 「勿擾時段 22:00-08:00」
+_QUIET_HOURS_RE = re.compile(
+    r'^勿擾(?:時段)?\s*(?P<start_h>\d{1,2})[:：](?P<start_m>\d{2})\s*[-~～到至]\s*(?P<end_h>\d{1,2})[:：](?P<end_m>\d{2})$'
+)
+_REMINDER_WORD_RE = re.compile(r'(?:請|请)?(?:記得|记得)?提醒我?')
+_QUESTION_RE = re.compile(r'[嗎吗？?呢]|什麼|什么|幾|几|哪|是否|有沒有|有没有')
+_FILLER_RE = re.compile(r'^[\s，,。.：:、要去的在]+|[\s，,。.！!]+$')
+
+
+def parse_number(text):
+    """把阿拉伯數字或中文數字 (例如「二十五」) 轉為整數"""
+    if text.isdigit():
+        return int(text)
+    total, current = 0, 0
+    for ch in text:
+        if ch in _DIGITS:
+            current = _DIGITS[ch]
+        elif ch == '十':
+            total += (current or 1) * 10
+            current = 0
+        elif ch == '百':
+            total += (current or 1) * 100
+            current = 0
+        elif ch.isdigit():
+            current = current * 10 + int(ch)
+    return total + current
+
+
+def _minutes(num, unit, half=False):
+    amount = 0.5 if num == '半' else parse_number(num)
+    if half:
+        amount += 0.5
+    if unit.startswith('分'):
+        return amount
+    if unit == '天':
+        return amount * 1440
+    return amount * 60
+
+
+def _remove(text, match):
+    return text[:match.start()] + ' ' + text[match.end():]
+
+
+def _resolve_day(text, now):
+    """解析日期部分，回傳 (日期, 隱含時段, 剩餘文字)"""
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    match = _DAY_RE.search(text)
+    if match:
+        day = match.group('day')
+        offsets = {'今': 0, '明': 1, '後': 2, '后': 2, '大': 3}
+        implied = '晚上' if day.endswith('晚') else '早上' if day.endswith('早') else None
+        return today + timedelta(days=offsets[day[0]]), implied, _remove(text, match)
+
+    match = _WEEKDAY_RE.search(text)
+    if match:
+        weekday = _WEEKDAYS[match.group('weekday')]
+        prefix = match.group('prefix')
+        week_start = today - timedelta(days=today.weekday())
+        if prefix == '下':
+            day = week_start + timedelta(days=7 + weekday)
+        elif prefix == '下下':
+            day = week_start + timedelta(days=14 + weekday)
+        elif prefix:
+            day = week_start + timedelta(days=weekday)
+        else:
+            # 只說「週三」時取今天之後最近的一個
+            day = today + timedelta(days=(weekday - today.weekday()) % 7)
+        return day, None, _remove(text, match)
+
+    match = _DATE_RE.search(text)
+    if match:
+        month = parse_number(match.group('month') or match.group('month2'))
+        mday = parse_number(match.group('mday') or match.group('mday2'))
+        try:
+            day = today.replace(month=month, day=mday)
+        except ValueError:
+            return None, None, text
+        if day < today:
+            day = day.replace(year=day.year + 1)
+        return day, None, _remove(text, match)
+
+    return None, None, text
+
+
+def parse_time(text, now=None, literal=False):
+    """解析中文時間表達式
+    Args:
+        text (str): 用戶訊息，例如「明天下午三點開會」、「30分鐘後提醒我喝水」
+        now (datetime): 目前時間，預設為台北時間
+        literal (bool): 只解析字面上的時間，不會因時間已過而往後推 (重複項目使用)
+    Returns:
+        dict: {'time': datetime, 'has_date': bool, 'has_clock': bool, 'rest': 去除時間後的文字}，
+            找不到時間時回傳 None
+    """
+    now = (now or timeutil.now()).replace(second=0, microsecond=0)
+
+    match = _RELATIVE_RE.search(text)
+    if match:
+        delta = _minutes(match.group('num'), match.group('unit'), bool(match.group('half')))
+        return {
+            'time': now + timedelta(minutes=delta),
+            'has_date': True,
+            'has_clock': True,
+            'rest': _remove(text, match),
+        }
+
+    day, period, rest = _resolve_day(text, now)
+    weekday_match = _WEEKDAY_RE.search(text)
+
+    match = _PERIOD_RE.search(rest)
+    if match:
+        period = match.group('period')
+        rest = _remove(rest, match)
+
+    hour = minute = None
+    match = _CLOCK_RE.search(rest)
+    if match:
+        if match.group('hh'):
+            hour, minute = int(match.group('hh')), int(match.group('mm'))
+        else:
+            hour = parse_number(match.group('hour'))
+            if match.group('half'):
+                minute = 30
+            elif match.group('quarter'):
+                minute = 15 * parse_number(match.group('quarter'))
+            elif match.group('minute'):
+                minute = parse_number(match.group('minute'))
+            else:
+                minute = 0
+        rest = _remove(rest, match)
+
+    if day is None and period is None and hour is None:
+        return None
+
+    has_clock = hour is not None
+    if hour is None:
+        hour, minute = _PERIOD_DEFAULT_HOUR.get(period, _DEFAULT_HOUR), 0
+    elif period in _AFTERNOON_PERIODS and hour < 12:
+        hour += 12
+    elif period == '中午' and hour < 6:
+        hour += 12
+    elif period in ('凌晨', '半夜') and hour == 12:
+        hour = 0
+
+    extra_days = 0
+    if hour == 24:
+        hour, extra_days = 0, 1
+    if hour > 23 or minute > 59:
+        return None
+
+    has_date = day is not None
+    base = day if has_date else now.replace(hour=0, minute=0)
+    result = base.replace(hour=hour, minute=minute) + timedelta(days=extra_days)
+
+    if literal:
+        return {'time': result, 'has_date': has_date, 'has_clock': has_clock, 'rest': rest}
+
+    if not has_date and result <= now:
+        # 沒有說日期：「三點」在早上說時多半是指下午，否則順延到明天
+        if period is None and hour < 12 and result + timedelta(hours=12) > now:
+            result += timedelta(hours=12)
+        else:
+            result += timedelta(days=1)
+    elif result <= now and weekday_match and not weekday_match.group('prefix'):
+        # 今天就是「週三」但時間已過，改為下一個週三
+        result += timedelta(days=7)
+
+    return {'time': result, 'has_date': has_date, 'has_clock': has_clock, 'rest': rest}
+
+
+def parse_recurrence(text):
+    """解析「每天」、「每個工作日」、「每週一三五」、「每月15號」這類重複描述
+    Returns:
+        tuple: (RRULE 字串, 每月的日期, 剩餘文字)，沒有重複描述時 RRULE 為 None
+    """
+    match = _RECURRENCE_RE.search(text)
+    if not match:
+        return None, None, text
+    rest = _remove(text, match)
+    if match.group('daily'):
+        # 「每晚」、「每早」同時隱含時段
+        implied = {'晚': '晚上', '早': '早上'}.get(match.group('daily'), '')
+        return 'FREQ=DAILY', None, implied + rest
+    if match.group('workday'):
+        return f'FREQ=WEEKLY;BYDAY={WORKDAYS}', None, rest
+    if match.group('mday'):
+        return 'FREQ=MONTHLY', parse_number(match.group('mday')), rest
+    if match.group('monthly'):
+        return 'FREQ=MONTHLY', None, rest
+
+    days = []
+    weekdays = match.group('weekdays') or ''
+    for range_match in re.finditer(r'([一二三四五六日天1-7])[到至-]([一二三四五六日天1-7])', weekdays):
+        first, last = _WEEKDAYS[range_match.group(1)], _WEEKDAYS[range_match.group(2)]
+        days.extend(range(first, last + 1))
+    days.extend(_WEEKDAYS[ch] for ch in weekdays if ch in _WEEKDAYS)
+    if not days:
+        return 'FREQ=WEEKLY', None, rest
+    return 'FREQ=WEEKLY;BYDAY=' + ','.join(WEEKDAY_CODES[day] for day in sorted(set(days))), None, rest
+
+
+def _clean(text):
+    text = re.sub(r'\s+', ' ', text).strip()
+    previous = None
+    while previous != text:
+        previous = text
+        text = _FILLER_RE.sub('', text)
+    return text
+
+
+def parse_quiet_hours(text):
+    """解析「勿擾時段 22:00-08:00」
+    Returns:
+        tuple: (開始, 結束)，以當天第幾分鐘表示；格式不符時回傳 None
+    """
+    match = _QUIET_HOURS_RE.match(text.strip())
+    if not match:
+        return None
+    start_h, start_m, end_h, end_m = (int(match.group(name)) for name in ('start_h', 'start_m', 'end_h', 'end_m'))
+    if start_h > 23 or end_h > 23 or start_m > 59 or end_m > 59:
+        return None
+    return start_h * 60 + start_m, end_h * 60 + end_m
+
+
+def parse_command(text, now=None):
+    """把一句話解析成新增提醒或行程的指令
+    Args:
+        text (str): 用戶訊息
+        now (datetime): 目前時間，預設為台北時間
+    Returns:
+        dict: {'kind': REMINDER/SCHEDULE, 'time': datetime 或 None, 'title': str,
+            'remind_before': 提前分鐘數的列表或 None, 'rrule': 重複規則或 None, 'urgent': bool}，不是新增指令時回傳 None。
+            提醒指令解析不出時間時 'time' 為 None，由呼叫端改用時間選擇器。
+    """
+    now = (now or timeutil.now()).replace(second=0, microsecond=0)
+    text = text.strip()
+    urgent = _URGENT_RE.search(text) is not None
+    text = re.sub(r'[!！]{2,}', '', text)
+
+    remind_before = None
+    match = _REMIND_BEFORE_RE.search(text)
+    if match:
+        remind_before = [
+            int(_minutes(offset.group('num'), offset.group('unit')))
+            for offset in _OFFSET_RE.finditer(match.group('offsets'))
+        ]
+        text = _remove(text, match)
+
+    reminder_word = _REMINDER_WORD_RE.search(text)
+    is_reminder = reminder_word is not None and '提醒我' in reminder_word.group(0)
+    if is_reminder:
+        text = _remove(text, reminder_word)
+    elif _QUESTION_RE.search(text):
+        return None
+
+    rrule, month_day, text = parse_recurrence(text)
+    parsed = parse_time(text, now, literal=rrule is not None)
+    if rrule:
+        # 重複項目只取時、分，第一次發生時間依規則計算
+        if parsed is None:
+            parsed = {'time': now.replace(hour=_DEFAULT_HOUR, minute=0), 'has_clock': False, 'rest': text}
+        first = first_occurrence(rrule, parsed['time'].hour, parsed['time'].minute, now, month_day)
+        parsed = {'time': first, 'has_date': True, 'has_clock': parsed['has_clock'], 'rest': parsed['rest']}
+
+    if parsed is None or parsed['time'] is None or parsed['time'] <= now:
+        if is_reminder:
+            return {'kind': REMINDER, 'time': None, 'title': _clean(text), 'remind_before': remind_before,
+                    'rrule': None, 'urgent': urgent}
+        return None
+
+    command = {
+        'kind': REMINDER,
+        'time': parsed['time'],
+        'title': _clean(parsed['rest']),
+        'remind_before': remind_before,
+        'rrule': rrule,
+        'urgent': urgent,
+    }
+    if is_reminder:
+        return command
+
+    # 沒有「提醒我」時，只有同時說出日期 (或重複規則) 和幾點，並帶有事項名稱，才視為新增行程
+    if not (parsed['has_date'] and parsed['has_clock']) or not command['title'] or len(command['title']) > 50:
+        return None
+    command['kind'] = SCHEDULE
+    return command
+
+
+if __name__ == "__main__":
+    now = datetime(2024, 5, 15, 10, 0)  # 週三
+    examples = [
+        "明天下午三點開會",
+        "30分鐘後提醒我喝水",
+        "半小時後提醒我關火",
+        "一個半小時後提醒我出門",
+        "提醒我下週一早上九點半交報告",
+        "週五晚上7:30跟朋友吃飯",
+        "6月1日上午10點看牙醫",
+        "提醒我買牛奶",
+        "明天會下雨嗎",
+        "明天下午三點有什麼行程",
+        "今天好累",
+        "明晚八點看電影 提前1小時提醒",
+        "下週一早上九點面試 提前1天和10分鐘提醒",
+        "每天早上八點提醒我吃藥",
+        "每個工作日09:00站立會議",
+        "每週一到五晚上七點提醒我運動",
+        "每週二四下午兩點瑜珈課",
+        "每月15號提醒我繳房租",
+        "明天早上六點提醒我緊急 交報告",
+        "提醒我10分鐘後關瓦斯!!",
+    ]
+    for example in examples:
+        print(f"{example} -> {parse_command(example, now)}")
+    for example in ("勿擾時段 22:00-08:00", "勿擾 23:30～7:00", "勿擾時段 25:00-08:00"):
+        print(f"{example} -> {parse_quiet_hours(example)}")
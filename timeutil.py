@@ -0,0 +1,75 @@
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+# 資料庫以 UTC epoch 秒 (整數) 儲存時間；程式內與用戶看到的時間一律是台北當地時間 (naive datetime)
+TIMEZONE = pytz.timezone('Asia/Taipei')
+DISPLAY_FORMAT = '%Y-%m-%d %H:%M'
+STORAGE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 舊資料與用戶輸入可能出現的時間字串格式
+_INPUT_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M',
+    '%Y/%m/%d %H:%M:%S',
+    '%Y/%m/%d %H:%M',
+    '%Y-%m-%d %H:%M:%S.%f',
+)
+
+
+def now():
+    """目前的台北時間 (naive)，不受主機時區影響"""
+    return datetime.now(TIMEZONE).replace(tzinfo=None)
+
+
+def now_epoch():
+    """目前的 UTC epoch 秒"""
+    return int(time.time())
+
+
+def parse_local(text):
+    """解析台北時間字串為 naive datetime"""
+    for fmt in _INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"無法解析日期時間: {text}")
+
+
+def to_epoch(value):
+    """把時間轉為 UTC epoch 秒
+    Args:
+        value: epoch 整數、台北時間字串、naive datetime (視為台北時間) 或帶時區的 datetime
+    Returns:
+        int: epoch 秒，value 為 None 時回傳 None
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = parse_local(value)
+    if value.tzinfo is None:
+        value = TIMEZONE.localize(value)
+    return int(value.timestamp())
+
+
+def from_epoch(epoch):
+    """把 UTC epoch 秒轉為台北時間 (naive datetime)"""
+    return datetime.fromtimestamp(epoch, TIMEZONE).replace(tzinfo=None)
+
+
+def format_epoch(epoch, fmt=DISPLAY_FORMAT, default="未設定"):
+    """把 UTC epoch 秒格式化為台北時間字串"""
+    if epoch is None:
+        return default
+    return from_epoch(epoch).strftime(fmt)
+
+
+def day_range(day=None):
+    """某一天 (台北時間) 的起訖 epoch 秒，結束時間不含"""
+    day = day or now().date()
+    start = datetime(day.year, day.month, day.day)
+    return to_epoch(start), to_epoch(start + timedelta(days=1))